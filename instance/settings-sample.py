@@ -24,8 +24,120 @@ CACHE_TYPE = 'redis'
 
 #: For RQ
 RQ_REDIS_URL = 'redis://localhost:6379/0'
+#: How often (in seconds) `./manage.py rqscheduler` queues delayed jobs that are due
 RQ_SCHEDULER_INTERVAL = 1
 
+#: Client notices: timeouts (in seconds) for connecting and reading, the maximum
+#: number of concurrent requests to a host across all workers, and retries with
+#: exponential backoff (starting at NOTICE_RETRY_DELAY seconds, up to
+#: NOTICE_RETRY_MAX_DELAY) up to a total of NOTICE_MAX_ATTEMPTS attempts. A
+#: notice to a busy host is deferred up to NOTICE_MAX_DEFERRALS times before each
+#: further wait counts as an attempt.
+#: Connections are reused only by workers that don't fork per job, such as
+#: `rqworker -w rq.worker.SimpleWorker`
+NOTICE_CONNECT_TIMEOUT = 3.05
+NOTICE_READ_TIMEOUT = 10
+NOTICE_HOST_CONCURRENCY = 4
+NOTICE_RETRY_DELAY = 30
+NOTICE_RETRY_MAX_DELAY = 3600
+NOTICE_MAX_ATTEMPTS = 6
+NOTICE_MAX_DEFERRALS = 60
+
+#: Changes to a user are sent to each client together with other changes in the
+#: next NOTICE_COALESCE_WINDOW seconds (0 to send each change immediately)
+NOTICE_COALESCE_WINDOW = 5
+
+#: Clients that accept batched notices get them as a JSON array, with up to
+#: NOTICE_BATCH_SIZE notices, at most NOTICE_BATCH_INTERVAL seconds after the
+#: first notice in the batch
+NOTICE_BATCH_SIZE = 100
+NOTICE_BATCH_INTERVAL = 10
+
+#: Notices are written to an outbox table in the request's transaction and sent
+#: by `./manage.py outbox --loop`, which checks for messages every
+#: OUTBOX_POLL_INTERVAL seconds. A failed message is tried again after a delay
+#: that doubles from OUTBOX_RETRY_DELAY seconds up to OUTBOX_RETRY_MAX_DELAY, and
+#: is given up on after OUTBOX_MAX_ATTEMPTS failures
+OUTBOX_POLL_INTERVAL = 1
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETRY_DELAY = 5
+OUTBOX_RETRY_MAX_DELAY = 3600
+
+#: Where OAuth authorization codes are kept: 'sql' (the auth_code table) or
+#: 'redis' (with a native expiry, saving a database insert and delete per login)
+AUTH_CODE_BACKEND = 'sql'
+
+#: `./manage.py periodic sweep` removes rows past their retention period in
+#: batches of SWEEP_BATCH_SIZE rows, pausing SWEEP_PAUSE seconds between batches.
+#: Retention periods can be changed per policy, in seconds
+SWEEP_BATCH_SIZE = 1000
+SWEEP_PAUSE = 0.1
+SWEEP_RETENTION = {
+    'auth_code': 3600,
+    'auth_password_reset_request': 86400,
+    'user_phone_claim': 3600,
+    'auth_token': 86400,
+    'user_session': 30 * 86400,
+    'sms_message': 90 * 86400,
+    'outbox_message': 30 * 86400,
+}
+
+#: Account merges run as a job that moves this many rows per transaction. A merge
+#: that has made no progress in USER_MERGE_STALL_TIMEOUT seconds is queued again
+#: when the user retries it
+USER_MERGE_CHUNK_SIZE = 1000
+USER_MERGE_STALL_TIMEOUT = 600
+
+#: Bearer token validation cache: timeouts (in seconds) for the shared cache, the
+#: per-worker cache, and unknown tokens; and the size of the per-worker cache
+AUTHTOKEN_CACHE_TIMEOUT = 300
+AUTHTOKEN_CACHE_LOCAL_TIMEOUT = 10
+AUTHTOKEN_CACHE_UNKNOWN_TIMEOUT = 30
+AUTHTOKEN_CACHE_SIZE = 1024
+
+#: Timeout (in seconds) for cached userinfo projections; 0 disables the cache
+USERINFO_CACHE_TIMEOUT = 300
+
+#: Maximum number of users returned by /api/1/user/autocomplete, and the timeout
+#: (in seconds) for cached results. Results are discarded when a user's status
+#: changes, but may not include other changes to users until they expire
+USER_AUTOCOMPLETE_LIMIT = 100
+USER_AUTOCOMPLETE_CACHE_TIMEOUT = 60
+
+#: Timeout (in seconds) for cached user session lookups
+USERSESSION_CACHE_TIMEOUT = 300
+
+#: Session and client activity timestamps are buffered and saved every
+#: ACTIVITY_FLUSH_INTERVAL seconds by a background thread in each worker process
+#: (0 to save at the end of every request instead), skipping rows saved within
+#: the last ACTIVITY_TOUCH_WINDOW seconds. uWSGI needs --enable-threads for this
+ACTIVITY_FLUSH_INTERVAL = 10
+ACTIVITY_TOUCH_WINDOW = 60
+
+#: Daily bitmaps of active users for the dashboard are kept this many days
+ACTIVITY_BITMAP_DAYS = 400
+
+#: Maximum number of tokens accepted by /api/1/token/verify_many
+TOKEN_VERIFY_MANY_LIMIT = 100
+
+#: Clients and credentials are held in memory by each worker and reloaded when
+#: they change. Records of changes expire after this many seconds, after which
+#: workers that missed them reload everything
+CLIENT_REGISTRY_CHANGES_TIMEOUT = 3600
+
+#: Password checks run in a pool of PASSWORD_CHECK_WORKERS threads per worker
+#: process, with up to PASSWORD_CHECK_QUEUE more waiting. Further logins are
+#: refused with a 503 asking the client to retry after PASSWORD_CHECK_RETRY_AFTER
+#: seconds
+PASSWORD_CHECK_WORKERS = 4
+PASSWORD_CHECK_QUEUE = 16
+PASSWORD_CHECK_RETRY_AFTER = 5
+
+#: bcrypt cost for password hashes. Hashes with a lower cost or a legacy scheme
+#: are upgraded at the next login. Use `./manage.py passwordbench` to pick a cost
+#: for a latency budget and `./manage.py passwordreport` to see current hashes
+PASSWORD_BCRYPT_ROUNDS = 12
+
 #: Secret key
 SECRET_KEY = 'make this something random'
 
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from threading import Lock, Thread
+from time import sleep
+import atexit
+import os
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from flask import current_app, request
+
+from coaster.utils import utcnow
+
+from .models import AuthClientCredential, UserSession, db
+from .models.user_session import auth_client_user_session
+
+__all__ = ['ActivityTracker', 'activity_tracker']
+
+
+class ActivityTracker(object):
+    """
+    Write-behind buffer for the last seen timestamps of user sessions, client
+    sessions and client credentials.
+
+    Requests record activity here instead of updating rows and committing. Rows
+    are written in batched UPDATEs once every ``ACTIVITY_FLUSH_INTERVAL`` seconds
+    (default 10) by a background thread in each worker process, and when the
+    process exits, so that requests don't wait on them. If the interval is 0, rows
+    are written at the end of every request instead. Activity on a row already
+    recorded within ``ACTIVITY_TOUCH_WINDOW`` seconds (default 60) is skipped.
+    Changes that are not timestamps, such as a new IP address or a client's first
+    use of a session, are written immediately.
+
+    Timestamps from a flush that fails are kept for the next flush. A flush never
+    moves a timestamp backwards (PostgreSQL's ``greatest`` also ignores nulls).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        #: Pending timestamps by kind of row, keyed by row
+        self._pending = {'session': {}, 'client_session': {}, 'credential': {}}
+        #: Timestamps recorded within the touch window, keyed by (kind, row)
+        self._seen = {}
+        #: Process that the flush thread runs in
+        self._pid = None
+        self._exit_registered = False
+
+    @property
+    def window(self):
+        return timedelta(seconds=current_app.config.get('ACTIVITY_TOUCH_WINDOW', 60))
+
+    def _seen_recently(self, kind, key):
+        seen_at = self._seen.get((kind, key))
+        return seen_at is not None and utcnow() - seen_at < self.window
+
+    def _touch(self, kind, key, last_seen=None, pending=True):
+        """
+        Record activity on a row unless it was recorded within the window. If
+        ``pending`` is False, the row was just written and is only marked as seen.
+        """
+        now = utcnow()
+        window = self.window
+        if last_seen is not None and now - last_seen < window:
+            return
+        with self._lock:
+            seen_at = self._seen.get((kind, key))
+            if seen_at is not None and now - seen_at < window:
+                return
+            self._seen[(kind, key)] = now
+            if pending:
+                self._pending[kind][key] = now
+                if self._pid != os.getpid():
+                    self._start()
+
+    def _start(self):
+        # Called with the lock held. A worker forked from a process that started
+        # the thread does not have it, so each process starts its own
+        app = current_app._get_current_object()
+        self._pid = os.getpid()
+        if not app.config.get('ACTIVITY_FLUSH_INTERVAL', 10):
+            return
+        Thread(
+            target=self._run, args=(app,), name='activity-flush', daemon=True
+        ).start()
+        if not self._exit_registered:
+            # Also runs in forked workers
+            atexit.register(self._flush_at_exit, app)
+            self._exit_registered = True
+
+    def _run(self, app):
+        while True:
+            sleep(app.config.get('ACTIVITY_FLUSH_INTERVAL', 10) or 1)
+            with app.app_context():
+                self.flush_safely()
+
+    def _flush_at_exit(self, app):
+        with app.app_context():
+            self.flush_safely()
+
+    def session_accessed(self, user_session):
+        """
+        Mark a user session as currently active, from a browser request. Calls
+        :meth:`UserSession.access` and commits if the IP address or user agent
+        changed.
+        """
+        ipaddr = request.remote_addr or ''
+        user_agent = str(request.user_agent.string[:250]) or ''
+        if user_session.ipaddr != ipaddr or user_session.user_agent != user_agent:
+            user_session.access()
+            db.session.commit()
+            self._touch('session', user_session.id, pending=False)
+        else:
+            self._touch('session', user_session.id, user_session.accessed_at)
+
+    def client_session_accessed(self, user_session, auth_client):
+        """
+        Mark a user session as currently active in an API call from a client. Calls
+        :meth:`UserSession.access` and commits if the client has not used this
+        session before.
+        """
+        key = (auth_client.id, user_session.id)
+        if self._seen_recently('client_session', key):
+            return
+        if auth_client not in user_session.auth_clients:
+            user_session.access(auth_client=auth_client)
+            db.session.commit()
+            self._touch('client_session', key, pending=False)
+            self._touch('session', user_session.id, pending=False)
+        else:
+            self._touch('client_session', key)
+            self._touch('session', user_session.id, user_session.accessed_at)
+
+    def credential_accessed(self, credential):
+        """Mark a client credential as used"""
+        self._touch('credential', credential.id, credential.accessed_at)
+
+    def flush(self):
+        """
+        Write pending timestamps. Returns the number of rows written. If the
+        database fails, the timestamps are kept for the next flush and the error
+        is raised.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {kind: {} for kind in pending}
+            # Forget rows that are outside the window, to keep this bounded
+            threshold = utcnow() - self.window
+            self._seen = {
+                key: seen_at
+                for key, seen_at in self._seen.items()
+                if seen_at >= threshold
+            }
+        sessions = pending['session']
+        client_sessions = pending['client_session']
+        credentials = pending['credential']
+        if not (sessions or client_sessions or credentials):
+            return 0
+
+        try:
+            self._write(sessions, client_sessions, credentials)
+        except SQLAlchemyError:
+            self._requeue(pending)
+            raise
+        return len(sessions) + len(client_sessions) + len(credentials)
+
+    def _requeue(self, pending):
+        # Keep the newer timestamp of rows that were recorded again meanwhile
+        with self._lock:
+            for kind, rows in pending.items():
+                current = self._pending[kind]
+                for key, accessed_at in rows.items():
+                    if key not in current or current[key] < accessed_at:
+                        current[key] = accessed_at
+
+    def _write(self, sessions, client_sessions, credentials):
+        session_table = UserSession.__table__
+        credential_table = AuthClientCredential.__table__
+        # Rows are updated in key order to avoid deadlocks between workers. A row
+        # locked by an open transaction fails the flush instead of blocking it
+        with db.engine.begin() as connection:
+            connection.execute(db.text("SET LOCAL lock_timeout = '2s'"))
+            if sessions:
+                connection.execute(
+                    session_table.update()
+                    .where(session_table.c.id == db.bindparam('_id'))
+                    .values(
+                        accessed_at=db.func.greatest(
+                            session_table.c.accessed_at, db.bindparam('_accessed_at')
+                        )
+                    ),
+                    [
+                        {'_id': key, '_accessed_at': sessions[key]}
+                        for key in sorted(sessions)
+                    ],
+                )
+            if client_sessions:
+                connection.execute(
+                    auth_client_user_session.update()
+                    .where(
+                        auth_client_user_session.c.auth_client_id
+                        == db.bindparam('_auth_client_id')
+                    )
+                    .where(
+                        auth_client_user_session.c.user_session_id
+                        == db.bindparam('_user_session_id')
+                    )
+                    .values(
+                        accessed_at=db.func.greatest(
+                            auth_client_user_session.c.accessed_at,
+                            db.bindparam('_accessed_at'),
+                        )
+                    ),
+                    [
+                        {
+                            '_auth_client_id': key[0],
+                            '_user_session_id': key[1],
+                            '_accessed_at': client_sessions[key],
+                        }
+                        for key in sorted(client_sessions)
+                    ],
+                )
+            if credentials:
+                connection.execute(
+                    credential_table.update()
+                    .where(credential_table.c.id == db.bindparam('_id'))
+                    .values(
+                        accessed_at=db.func.greatest(
+                            credential_table.c.accessed_at,
+                            db.bindparam('_accessed_at'),
+                        )
+                    ),
+                    [
+                        {'_id': key, '_accessed_at': credentials[key]}
+                        for key in sorted(credentials)
+                    ],
+                )
+
+    def flush_safely(self):
+        """Flush, logging the error if the database fails"""
+        try:
+            self.flush()
+        except SQLAlchemyError:
+            current_app.logger.exception("Could not save activity timestamps")
+
+
+#: Activity tracker for this process
+activity_tracker = ActivityTracker()
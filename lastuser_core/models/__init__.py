@@ -7,8 +7,13 @@ from coaster.sqlalchemy import BaseMixin, BaseScopedNameMixin, TimestampMixin, U
 
 TimestampMixin.__with_timezone__ = True
 
+from .cached import *  # isort:skip
 from .user import *  # isort:skip
+from .autocomplete import *  # isort:skip
 from .user_session import *  # isort:skip
 from .auth_client import *  # isort:skip
 from .notification import *  # isort:skip
+from .outbox import *  # isort:skip
+from .rollup import *  # isort:skip
 from .helpers import *  # isort:skip
+from .merge import *  # isort:skip
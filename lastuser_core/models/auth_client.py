@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from datetime import timedelta
+from functools import lru_cache
 from hashlib import sha256
 import urllib.parse
 
@@ -26,6 +27,44 @@ __all__ = [
 ]
 
 
+@lru_cache(maxsize=4096)
+def compile_scope(value):
+    """
+    Return the tokens in a scope string as a frozenset. Results are cached, so
+    scope strings that are seen repeatedly are parsed once and share one set.
+    """
+    if not value:
+        return frozenset()
+    return frozenset(value.split())
+
+
+@lru_cache(maxsize=4096)
+def _sorted_scope(value):
+    if not value:
+        return ()
+    return tuple(sorted(value.split()))
+
+
+@lru_cache(maxsize=4096)
+def _merge_scopes(scope1, scope2):
+    merged = scope1 | scope2
+    return merged, tuple(sorted(merged))
+
+
+@lru_cache(maxsize=1024)
+def _split_redirect_uris(value):
+    return tuple(value.split()) if value else ()
+
+
+@lru_cache(maxsize=1024)
+def _redirect_netlocs(redirect_uris, website):
+    """Netlocs of a client's redirect URIs and website, parsed once per value"""
+    return frozenset(
+        urllib.parse.urlsplit(r).netloc
+        for r in _split_redirect_uris(redirect_uris) + (website,)
+    )
+
+
 class ScopeMixin(object):
     __scope_null_allowed__ = False
 
@@ -34,10 +73,7 @@ class ScopeMixin(object):
         return db.Column('scope', db.UnicodeText, nullable=cls.__scope_null_allowed__)
 
     def _scope_get(self):
-        if not self._scope:
-            return ()
-        else:
-            return tuple(sorted(self._scope.split()))
+        return _sorted_scope(self._scope)
 
     def _scope_set(self, value):
         if isinstance(value, str):
@@ -48,12 +84,74 @@ class ScopeMixin(object):
     def scope(cls):
         return db.synonym('_scope', descriptor=property(cls._scope_get, cls._scope_set))
 
+    @property
+    def compiled_scope(self):
+        """Scope as a frozenset, for constant-time membership tests"""
+        return compile_scope(self._scope)
+
     def add_scope(self, additional):
         if isinstance(additional, str):
             additional = [additional]
         self.scope = list(set(self.scope).union(set(additional)))
 
 
+def _migrate_user_merging_tokens(table, column, olduser, newuser, limit=None):
+    """
+    Move rows from olduser to newuser in a table with one row per user and client.
+    Where both users have a row for a client, the space-separated tokens in
+    ``column`` are merged into newuser's row and olduser's row is removed. If a
+    limit is given, only that many of olduser's rows are moved or removed.
+    Returns the number of rows moved or removed.
+    """
+    db.session.flush()
+    params = {'olduser_id': olduser.id, 'newuser_id': newuser.id}
+    selected = ''
+    if limit is not None:
+        params['ids'] = [
+            row[0]
+            for row in db.session.execute(
+                db.select([table.c.id])
+                .where(table.c.user_id == olduser.id)
+                .order_by(table.c.id)
+                .limit(limit)
+            )
+        ]
+        if not params['ids']:
+            return 0
+        selected = 'AND {table}.id = ANY(:ids) '
+    db.session.execute(
+        db.text(
+            'UPDATE {table} SET {column} = ('
+            'SELECT coalesce(string_agg(DISTINCT token, \' \' ORDER BY token), \'\') '
+            'FROM unnest(string_to_array({table}.{column}, \' \') '
+            '|| string_to_array(old.{column}, \' \')) AS token '
+            'WHERE token != \'\') '
+            'FROM {table} AS old '
+            'WHERE {table}.user_id = :newuser_id AND old.user_id = :olduser_id '
+            'AND old.auth_client_id = {table}.auth_client_id '.format(
+                table=table.name, column=column
+            )
+            + selected.format(table='old')
+        ),
+        params,
+    )
+    count = db.session.execute(
+        db.text(
+            'DELETE FROM {table} USING {table} AS new '
+            'WHERE {table}.user_id = :olduser_id AND new.user_id = :newuser_id '
+            'AND new.auth_client_id = {table}.auth_client_id '.format(table=table.name)
+            + selected.format(table=table.name)
+        ),
+        params,
+    ).rowcount
+    statement = (
+        table.update().where(table.c.user_id == olduser.id).values(user_id=newuser.id)
+    )
+    if limit is not None:
+        statement = statement.where(table.c.id.in_(params['ids']))
+    return count + db.session.execute(statement).rowcount
+
+
 class AuthClient(ScopeMixin, UuidMixin, BaseMixin, db.Model):
     """OAuth client applications"""
 
@@ -89,6 +187,8 @@ class AuthClient(ScopeMixin, UuidMixin, BaseMixin, db.Model):
     )
     #: Back-end notification URI
     notification_uri = db.Column(db.UnicodeText, nullable=True, default='')
+    #: Collect notices and POST them together as a JSON array
+    notification_batch = db.Column(db.Boolean, nullable=False, default=False)
     #: Active flag
     active = db.Column(db.Boolean, nullable=False, default=True)
     #: Allow anyone to login to this app?
@@ -129,7 +229,7 @@ class AuthClient(ScopeMixin, UuidMixin, BaseMixin, db.Model):
 
     @property
     def redirect_uris(self):
-        return tuple(self._redirect_uris.split())
+        return _split_redirect_uris(self._redirect_uris)
 
     @redirect_uris.setter
     def redirect_uris(self, value):
@@ -144,10 +244,7 @@ class AuthClient(ScopeMixin, UuidMixin, BaseMixin, db.Model):
     def host_matches(self, url):
         netloc = urllib.parse.urlsplit(url or '').netloc
         if netloc:
-            return netloc in (
-                urllib.parse.urlsplit(r).netloc
-                for r in (self.redirect_uris + (self.website,))
-            )
+            return netloc in _redirect_netlocs(self._redirect_uris, self.website)
         return False
 
     @property
@@ -385,9 +482,16 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
             user=repr(self.user)[1:-1],
         )
 
+    @property
+    def compiled_effective_scope(self):
+        """Effective scope as a frozenset, for constant-time membership tests"""
+        return _merge_scopes(self.compiled_scope, self.auth_client.compiled_scope)[0]
+
     @property
     def effective_scope(self):
-        return sorted(set(self.scope) | set(self.auth_client.scope))
+        return list(
+            _merge_scopes(self.compiled_scope, self.auth_client.compiled_scope)[1]
+        )
 
     def refresh(self):
         """
@@ -422,27 +526,13 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
         return True
 
     @classmethod
-    def migrate_user(cls, olduser, newuser):
+    def migrate_user(cls, olduser, newuser, limit=None):
         if not olduser or not newuser:
-            return  # Don't mess with client-only tokens
-        oldtokens = cls.query.filter_by(user=olduser).all()
-        newtokens = {}  # AuthClient: token mapping
-        for token in cls.query.filter_by(user=newuser).all():
-            newtokens.setdefault(token.auth_client_id, []).append(token)
-
-        for token in oldtokens:
-            merge_performed = False
-            if token.auth_client_id in newtokens:
-                for newtoken in newtokens[token.auth_client_id]:
-                    if newtoken.user == newuser:
-                        # There's another token for newuser with the same client.
-                        # Just extend the scope there
-                        newtoken.scope = set(newtoken.scope) | set(token.scope)
-                        db.session.delete(token)
-                        merge_performed = True
-                        break
-            if merge_performed is False:
-                token.user = newuser  # Reassign this token to newuser
+            return 0  # Don't mess with client-only tokens
+        # Where both users have a token for a client, extend the scope of newuser's
+        return _migrate_user_merging_tokens(
+            cls.__table__, 'scope', olduser, newuser, limit
+        )
 
     @classmethod
     def get(cls, token):
@@ -456,6 +546,23 @@ class AuthToken(ScopeMixin, BaseMixin, db.Model):
         )
         return query.one_or_none()
 
+    @classmethod
+    def get_many(cls, tokens):
+        """
+        Return a dictionary of AuthToken instances matching the given tokens, keyed
+        by token. Unknown tokens are not included.
+
+        :param tokens: Tokens to lookup
+        """
+        if not tokens:
+            return {}
+        query = cls.query.filter(cls.token.in_(set(tokens))).options(
+            db.joinedload(cls.auth_client).load_only('id', '_scope'),
+            db.joinedload(cls._user),
+            db.joinedload(cls.user_session).joinedload(UserSession.user),
+        )
+        return {authtoken.token: authtoken for authtoken in query}
+
     @classmethod
     def get_for(cls, auth_client, user=None, user_session=None):
         require_one_of(user=user, user_session=user_session)
@@ -531,21 +638,11 @@ class AuthClientUserPermissions(BaseMixin, db.Model):
         return self.user.buid
 
     @classmethod
-    def migrate_user(cls, olduser, newuser):
-        for operm in olduser.client_permissions:
-            merge_performed = False
-            for nperm in newuser.client_permissions:
-                if nperm.auth_client == operm.auth_client:
-                    # Merge permission strings
-                    tokens = set(operm.access_permissions.split(' '))
-                    tokens.update(set(nperm.access_permissions.split(' ')))
-                    if ' ' in tokens:
-                        tokens.remove(' ')
-                    nperm.access_permissions = ' '.join(sorted(tokens))
-                    db.session.delete(operm)
-                    merge_performed = True
-            if not merge_performed:
-                operm.user = newuser
+    def migrate_user(cls, olduser, newuser, limit=None):
+        # Where both users have permissions on a client, merge them into newuser's
+        return _migrate_user_merging_tokens(
+            cls.__table__, 'permissions', olduser, newuser, limit
+        )
 
     @classmethod
     def get(cls, auth_client, user):
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import and_, event as sqla_event, inspect
+
+from . import db
+from .user import AccountName, User, UserEmail, UserExternalId, user_autocomplete
+
+__all__ = ['rebuild_autocomplete']
+
+
+#: Ranks for each kind of token. Lower ranks are listed first. External ids and
+#: email addresses are only matched by queries that look like them, and are
+#: listed ahead of names when they match
+AUTOCOMPLETE_RANKS = {
+    'buid': 0,
+    'extid': 0,
+    'email': 0,
+    'username': 1,
+    'fullname': 2,
+    'word': 3,
+}
+
+
+def _autocomplete_tokens(connection, user_ids):
+    """Compute autocomplete rows for the given users from their current data"""
+    tokens = set()
+    for user_id, buid, fullname in connection.execute(
+        db.select([User.id, User.buid, User.fullname]).where(User.id.in_(user_ids))
+    ):
+        tokens.add((user_id, 'buid', buid))
+        fullname = (fullname or '').strip().lower()
+        if fullname:
+            tokens.add((user_id, 'fullname', fullname))
+            for word in fullname.split()[1:]:
+                tokens.add((user_id, 'word', word))
+    for user_id, name in connection.execute(
+        db.select([AccountName.user_id, AccountName.name]).where(
+            AccountName.user_id.in_(user_ids)
+        )
+    ):
+        tokens.add((user_id, 'username', name.lower()))
+    for user_id, email in connection.execute(
+        db.select([UserEmail.user_id, UserEmail.email]).where(
+            UserEmail.user_id.in_(user_ids)
+        )
+    ):
+        tokens.add((user_id, 'email', email.lower()))
+    for user_id, service, username in connection.execute(
+        db.select(
+            [UserExternalId.user_id, UserExternalId.service, UserExternalId.username]
+        ).where(
+            and_(
+                UserExternalId.user_id.in_(user_ids),
+                UserExternalId.username.isnot(None),
+            )
+        )
+    ):
+        tokens.add((user_id, '@' + service, username.lower()))
+    return [
+        {
+            'user_id': user_id,
+            'kind': kind,
+            'token': token,
+            'rank': AUTOCOMPLETE_RANKS['extid' if kind.startswith('@') else kind],
+        }
+        for user_id, kind, token in tokens
+    ]
+
+
+def rebuild_autocomplete(connection, user_ids):
+    """
+    Replace autocomplete rows for the given users. This is called on flush for
+    users whose data changed, and may be called in batches to backfill the table.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    connection.execute(
+        user_autocomplete.delete().where(user_autocomplete.c.user_id.in_(user_ids))
+    )
+    rows = _autocomplete_tokens(connection, user_ids)
+    if rows:
+        connection.execute(user_autocomplete.insert(), rows)
+
+
+def _history_values(obj, attr):
+    """Return current and previous values of an attribute, during a flush"""
+    values = set(inspect(obj).attrs[attr].history.sum())
+    values.add(getattr(obj, attr))
+    values.discard(None)
+    return values
+
+
+@sqla_event.listens_for(db.session, 'after_flush')
+def _update_autocomplete(session, flush_context):
+    # Session state is still pre-flush here, so attribute history shows both the
+    # old and new owner of rows that moved between users
+    user_ids = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, User):
+            if (
+                obj in session.new
+                or obj in session.deleted
+                or inspect(obj).attrs.fullname.history.has_changes()
+            ):
+                user_ids.add(obj.id)
+        elif isinstance(obj, (AccountName, UserEmail, UserExternalId)):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            user_ids.update(_history_values(obj, 'user_id'))
+    if user_ids:
+        rebuild_autocomplete(session.connection(), user_ids)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import db
+
+__all__ = ['instance_data', 'merge_instance_data']
+
+
+def instance_data(obj):
+    """
+    Return the column values of a model instance as a dictionary keyed by
+    attribute name, for storage in a cache.
+    """
+    return {
+        attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs
+    }
+
+
+def merge_instance_data(model, data):
+    """
+    Return a persistent instance of the model built from :func:`instance_data`,
+    added to the database session without a query. Values are taken as the
+    committed state of the row, so the data must be current. If the row is already
+    in the session, that instance is returned instead.
+    """
+    mapper = inspect(model)
+    identity_key = mapper.identity_key_from_primary_key(
+        [
+            data[mapper.get_property_by_column(column).key]
+            for column in mapper.primary_key
+        ]
+    )
+    # An instance already in the session may have changes that must be kept
+    existing = db.session.identity_map.get(identity_key)
+    if existing is not None:
+        return existing
+    obj = mapper.class_manager.new_instance()
+    for key, value in data.items():
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
@@ -1,16 +1,25 @@
 # -*- coding: utf-8 -*-
 
+from .auth_client import AuthClientTeamPermissions, AuthClientUserPermissions
 from .user import (
-    USER_STATUS,
+    AccountName,
+    Team,
     User,
     UserEmail,
     UserEmailClaim,
     UserExternalId,
     UserOldId,
     db,
+    team_membership,
 )
 
-__all__ = ['getuser', 'getextid', 'merge_users']
+__all__ = [
+    'UserinfoData',
+    'getuser',
+    'getuser_many',
+    'getextid',
+    'load_userinfo_data',
+]
 
 
 def getuser(name):
@@ -36,46 +45,186 @@ def getuser(name):
         return User.get(username=name)
 
 
+def getuser_many(names):
+    """
+    Bulk variant of :func:`getuser`. Returns a dictionary of name to user for all
+    names that resolve to an active user, in the order the names were supplied.
+    Each class of name (Twitter handle, email address, username) is resolved with
+    one query, with merged accounts resolved in the same query.
+    """
+    handles = set()
+    emails = set()
+    usernames = set()
+    for name in names:
+        if '@' in name:
+            if name.startswith('@'):
+                handles.add(name[1:])
+            else:
+                emails.add(name)
+        else:
+            usernames.add(name)
+
+    found = {}
+    if handles:
+        # TODO: As with getuser, this is for Twitter only
+        for extid in UserExternalId.query.filter(
+            UserExternalId.service == 'twitter', UserExternalId.username.in_(handles)
+        ).options(db.joinedload(UserExternalId.user)):
+            if extid.user.is_active:
+                found['@' + extid.username] = extid.user
+
+    if emails:
+        # Email addresses are stored in lowercase
+        lowered = {email: email.lower() for email in emails}
+        by_email = {}
+        for useremail in UserEmail.query.filter(
+            UserEmail.email.in_(set(lowered.values()))
+        ).options(db.joinedload(UserEmail.user)):
+            if useremail.user is not None and useremail.user.is_active:
+                by_email[useremail.email] = useremail.user
+        # No verified email id with an active user? Look for an unverified id, using
+        # the oldest claim
+        claimed = set(lowered.values()) - set(by_email)
+        if claimed:
+            for claim in (
+                UserEmailClaim.query.filter(UserEmailClaim.email.in_(claimed))
+                .options(db.joinedload(UserEmailClaim.user))
+                .order_by(UserEmailClaim.id.desc())
+            ):
+                by_email[claim.email] = claim.user
+        for email, lower in lowered.items():
+            user = by_email.get(lower)
+            if user is not None and user.is_active:
+                found[email] = user
+
+    if usernames:
+        for user in (
+            User.query.join(AccountName)
+            .filter(AccountName.name.in_(usernames))
+            .options(User.merged_user_option())
+        ):
+            merged_user = user.merged_user()
+            if merged_user.is_active:
+                found[user.username] = merged_user
+
+    return {name: found[name] for name in names if name in found}
+
+
 def getextid(service, userid):
     return UserExternalId.get(service=service, userid=userid)
 
 
-def merge_users(user1, user2):
+class UserinfoData(object):
     """
-    Merge two user accounts and return the new user account.
+    Rows required to assemble userinfo for one user, as loaded in bulk by
+    :func:`load_userinfo_data`. Attributes that were not requested are left empty.
     """
-    # Always keep the older account and merge from the newer account
-    if user1.created_at < user2.created_at:
-        keep_user, merge_user = user1, user2
-    else:
-        keep_user, merge_user = user2, user1
-
-    # 1. Release the username
-    if not keep_user.username:
-        if merge_user.username:
-            # Flush before re-assigning to avoid dupe name constraint
-            username = merge_user.username
-            merge_user.username = None
-            db.session.flush()
-            keep_user.username = username
-    merge_user.username = None
-
-    # 2. Inspect all tables for foreign key references to merge_user and switch to keep_user.
-    for model in db.Model.__subclasses__():
-        if model != User:
-            # a. This is a model and it's not the User model. Does it have a migrate_user classmethod?
-            if hasattr(model, 'migrate_user'):
-                model.migrate_user(olduser=merge_user, newuser=keep_user)
-            # b. No migrate_user? Does it have a user_id column?
-            elif hasattr(model, 'user_id') and hasattr(model, 'query'):
-                for row in model.query.filter_by(user_id=merge_user.id).all():
-                    row.user_id = keep_user.id
-    # 3. Add merge_user's uuid to olduserids. Commit session.
-    db.session.add(UserOldId(id=merge_user.uuid, user=keep_user))
-    # 4. Mark merge_user as merged. Commit session.
-    merge_user.status = USER_STATUS.MERGED
-    # 5. Commit all of this
-    db.session.commit()
-
-    # 6. Return keep_user.
-    return keep_user
+
+    def __init__(self):
+        #: UserOldId instances for accounts merged into this user
+        self.oldids = []
+        #: Teams this user is a member of, with organizations loaded
+        self.teams = []
+        #: Organizations this user is a member of, sorted by title
+        self.organizations_memberof = []
+        #: Organizations this user is an owner of, sorted by title
+        self.organizations_owned = []
+        #: Teams in the organizations this user owns, sorted by organization and title
+        self.owned_org_teams = []
+        #: Permissions granted to this user on the client, or None
+        self.permissions = None
+
+
+def load_userinfo_data(
+    users, auth_client=None, oldids=True, teams=True, owned_teams=True
+):
+    """
+    Load the rows required by userinfo for all given users, using a fixed number of
+    queries regardless of the number of users, teams or organizations. Returns a
+    dictionary of :class:`UserinfoData` keyed by user id.
+
+    :param users: Users to load data for
+    :param auth_client: Load permissions granted on this client, if specified
+    :param bool oldids: Load old ids of merged accounts
+    :param bool teams: Load team memberships and organizations
+    :param bool owned_teams: Load all teams in organizations owned by the user
+    """
+    data = {user.id: UserinfoData() for user in users}
+    if not data:
+        return data
+    user_ids = list(data)
+
+    if oldids:
+        for oldid in UserOldId.query.filter(UserOldId.user_id.in_(user_ids)):
+            data[oldid.user_id].oldids.append(oldid)
+
+    # Team permissions need team memberships
+    if (
+        teams
+        or owned_teams
+        or (auth_client is not None and auth_client.user_id is None)
+    ):
+        memberships = (
+            db.session.query(team_membership.c.user_id, Team)
+            .join(Team, Team.id == team_membership.c.team_id)
+            .filter(team_membership.c.user_id.in_(user_ids))
+            .options(db.joinedload(Team.organization))
+        )
+        for user_id, team in memberships:
+            data[user_id].teams.append(team)
+        for userdata in data.values():
+            userdata.organizations_memberof = sorted(
+                {team.organization for team in userdata.teams}, key=lambda o: o.title
+            )
+            userdata.organizations_owned = sorted(
+                {
+                    team.organization
+                    for team in userdata.teams
+                    if team.organization.owners_id == team.id
+                },
+                key=lambda o: o.title,
+            )
+
+    if owned_teams:
+        owned_org_ids = {
+            org.id for userdata in data.values() for org in userdata.organizations_owned
+        }
+        org_teams = {}
+        if owned_org_ids:
+            for team in (
+                Team.query.filter(Team.organization_id.in_(owned_org_ids))
+                .options(db.joinedload(Team.organization))
+                .order_by(Team.title)
+            ):
+                org_teams.setdefault(team.organization_id, []).append(team)
+        for userdata in data.values():
+            userdata.owned_org_teams = [
+                team
+                for org in userdata.organizations_owned
+                for team in org_teams.get(org.id, [])
+            ]
+
+    if auth_client is not None:
+        if auth_client.user_id is not None:
+            for perms in AuthClientUserPermissions.query.filter(
+                AuthClientUserPermissions.auth_client == auth_client,
+                AuthClientUserPermissions.user_id.in_(user_ids),
+            ):
+                data[perms.user_id].permissions = perms.access_permissions.split(' ')
+        else:
+            team_users = {}
+            for user_id, userdata in data.items():
+                for team in userdata.teams:
+                    team_users.setdefault(team.id, []).append(user_id)
+            permsets = {user_id: set() for user_id in user_ids}
+            if team_users:
+                for perms in AuthClientTeamPermissions.query.filter(
+                    AuthClientTeamPermissions.auth_client == auth_client,
+                    AuthClientTeamPermissions.team_id.in_(list(team_users)),
+                ):
+                    for user_id in team_users[perms.team_id]:
+                        permsets[user_id].update(perms.access_permissions.split(' '))
+            for user_id, permset in permsets.items():
+                data[user_id].permissions = sorted(permset)
+
+    return data
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from baseframe import __
+from coaster.utils import LabeledEnum, utcnow
+
+from ..signals import user_data_changed
+from . import BaseMixin, UuidMixin
+from .auth_client import AuthClient, AuthToken
+from .autocomplete import rebuild_autocomplete
+from .user import USER_STATUS, User, UserOldId, db, user_autocomplete
+from .user_session import UserSession
+
+__all__ = [
+    'MERGE_STATUS',
+    'UserMerge',
+    'merge_users',
+    'migrate_user_rows',
+    'user_foreign_keys',
+]
+
+
+class MERGE_STATUS(LabeledEnum):  # NOQA: N801
+    #: Waiting for a worker
+    PENDING = (0, 'pending', __("Pending"))
+    #: Moving rows in chunks
+    RUNNING = (1, 'running', __("In progress"))
+    #: Done; merge_user is marked as merged
+    COMPLETE = (2, 'complete', __("Complete"))
+    #: Stopped with an error; can be resumed from the checkpoint
+    FAILED = (3, 'failed', __("Failed"))
+
+
+class UserMerge(UuidMixin, BaseMixin, db.Model):
+    """
+    An account merge run in the background by :meth:`run`, in chunked
+    transactions. Progress is saved after each chunk, so a merge that fails or
+    is interrupted can be resumed.
+    """
+
+    __tablename__ = 'user_merge'
+    #: Account that is kept
+    keep_user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False)
+    keep_user = db.relationship(User, foreign_keys=[keep_user_id])
+    #: Account that is merged into keep_user
+    merge_user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False)
+    merge_user = db.relationship(User, foreign_keys=[merge_user_id])
+    #: Status of the merge (see :class:`MERGE_STATUS`)
+    status = db.Column(db.Integer, nullable=False, default=MERGE_STATUS.PENDING)
+    #: Checkpoint: index of the table being moved, in the order of
+    #: :func:`user_foreign_keys`. Tables before it have been moved.
+    step = db.Column(db.Integer, nullable=False, default=0)
+    #: Number of tables to move
+    steps = db.Column(db.Integer, nullable=True)
+    #: Number of rows moved or dropped as duplicates so far
+    rows_moved = db.Column(db.Integer, nullable=False, default=0)
+    #: Error that stopped the merge, if it failed
+    error = db.Column(db.UnicodeText, nullable=True)
+
+    def __repr__(self):
+        return '<UserMerge {merge_user} into {keep_user}>'.format(
+            merge_user=repr(self.merge_user)[1:-1],
+            keep_user=repr(self.keep_user)[1:-1],
+        )
+
+    @classmethod
+    def get(cls, buid):
+        return cls.query.filter_by(buid=buid).one_or_none()
+
+    @classmethod
+    def start(cls, user1, user2):
+        """
+        Return the unfinished merge of these two accounts, or a new merge.
+        Like :func:`merge_users`, the older account is kept.
+        """
+        keep_user, merge_user = _keep_and_merge(user1, user2)
+        user_merge = cls.query.filter(
+            cls.keep_user == keep_user,
+            cls.merge_user == merge_user,
+            cls.status != MERGE_STATUS.COMPLETE,
+        ).first()
+        if user_merge is None:
+            user_merge = cls(keep_user=keep_user, merge_user=merge_user)
+            db.session.add(user_merge)
+        return user_merge
+
+    @property
+    def is_complete(self):
+        return self.status == MERGE_STATUS.COMPLETE
+
+    @property
+    def progress(self):
+        """Fraction of tables moved, from 0 to 1"""
+        if self.is_complete:
+            return 1
+        if not self.steps:
+            return 0
+        return min(self.step, self.steps) / self.steps
+
+    def needs_worker(self, timeout):
+        """
+        Whether a job must be queued to run this merge: it is new or failed, or
+        has made no progress in ``timeout`` seconds, as when its worker was killed.
+        Queueing a second worker is safe, as workers take turns on each chunk.
+        """
+        return (
+            self.id is None
+            or self.status == MERGE_STATUS.FAILED
+            or self.updated_at < utcnow() - timedelta(seconds=timeout)
+        )
+
+    def _lock(self):
+        """
+        Lock this merge's row until the transaction ends, and reload it. A second
+        worker on the same merge waits for each chunk of the first, and continues
+        from its checkpoint.
+        """
+        self.query.filter_by(id=self.id).populate_existing().with_for_update().one()
+
+    def run(self, limit=1000):
+        """
+        Run or resume the merge, committing after every ``limit`` rows. Rows that
+        refer to merge_user but were added while the merge ran are moved in the
+        final transaction, which also marks merge_user as merged and sends
+        ``user_data_changed`` with ``['merge']``.
+        """
+        self._lock()
+        if self.is_complete:
+            db.session.commit()
+            return
+        keep_user, merge_user = self.keep_user, self.merge_user
+        plan = _merge_plan()
+        if self.status == MERGE_STATUS.PENDING:
+            _release_username(keep_user, merge_user)
+            self.steps = len(plan)
+        self.status = MERGE_STATUS.RUNNING
+        self.error = None
+        _record_stale(keep_user, merge_user)
+        db.session.commit()
+
+        # Cached data that goes stale in between is discarded after the final
+        # transaction, which records the rows of both users
+        while True:
+            self._lock()
+            if self.step >= len(plan):
+                break
+            count = _migrate_step(plan[self.step], merge_user, keep_user, limit)
+            self.rows_moved += count
+            if count < limit:
+                # This table is done
+                self.step += 1
+            db.session.commit()
+
+        if self.is_complete:
+            # Completed by another worker while this one waited for the lock
+            db.session.commit()
+            return
+        _record_stale(keep_user, merge_user)
+        for step in plan:
+            _migrate_step(step, merge_user, keep_user)
+        db.session.expire_all()
+        _complete_merge(keep_user, merge_user)
+        self.status = MERGE_STATUS.COMPLETE
+        user_data_changed.send(keep_user, changes=['merge'])
+        db.session.commit()
+
+    def fail(self, error):
+        """Record the error that stopped the merge"""
+        self.status = MERGE_STATUS.FAILED
+        self.error = error
+
+
+def user_foreign_keys():
+    """
+    Return (table, column) for every column in the metadata that is a foreign key
+    to ``user.id``, including association tables that have no model
+    """
+    user_id = User.__table__.c.id
+    return [
+        (table, fk.parent)
+        for table in db.Model.metadata.sorted_tables
+        if table is not User.__table__ and table is not UserMerge.__table__
+        for fk in table.foreign_keys
+        if fk.column is user_id
+    ]
+
+
+def _unique_peers(table, column):
+    """
+    For each unique constraint, unique index or primary key that includes the
+    column, return the other columns in it
+    """
+    candidates = [
+        list(constraint.columns)
+        for constraint in table.constraints
+        if isinstance(constraint, (db.UniqueConstraint, db.PrimaryKeyConstraint))
+    ] + [list(index.columns) for index in table.indexes if index.unique]
+    if column.unique:
+        candidates.append([column])
+    peers = {}
+    for columns in candidates:
+        if any(other is column for other in columns):
+            others = [other for other in columns if other is not column]
+            peers[tuple(sorted(other.name for other in others))] = others
+    return list(peers.values())
+
+
+def migrate_user_rows(table, column, olduser, newuser, limit=None):
+    """
+    Move rows in the table from olduser to newuser with one UPDATE. Rows that
+    would duplicate one of newuser's rows in a unique constraint are removed
+    first. If a limit is given and the table has a primary key, only that many
+    rows are moved or removed. Returns the number of rows moved or removed.
+    """
+    selected = None
+    primary_key = list(table.primary_key.columns)
+    if limit is not None and primary_key:
+        rows = db.session.execute(
+            db.select(primary_key).where(column == olduser.id).limit(limit)
+        ).fetchall()
+        if not rows:
+            return 0
+        if len(primary_key) == 1:
+            selected = primary_key[0].in_([row[0] for row in rows])
+        else:
+            selected = db.tuple_(*primary_key).in_([tuple(row) for row in rows])
+
+    count = 0
+    for peers in _unique_peers(table, column):
+        existing = table.alias('existing')
+        duplicate = db.exists().where(existing.c[column.name] == newuser.id)
+        for peer in peers:
+            duplicate = duplicate.where(existing.c[peer.name] == table.c[peer.name])
+        statement = table.delete().where(column == olduser.id).where(duplicate)
+        if selected is not None:
+            statement = statement.where(selected)
+        count += db.session.execute(statement).rowcount
+    statement = (
+        table.update().where(column == olduser.id).values({column.name: newuser.id})
+    )
+    if selected is not None:
+        statement = statement.where(selected)
+    count += db.session.execute(statement).rowcount
+    return count
+
+
+def _merge_plan():
+    """
+    Return (table, column, model) for each table to move in a merge, in the order
+    of :func:`user_foreign_keys`. Model is set for models that have a
+    ``migrate_user(olduser, newuser, limit)`` classmethod, which is called
+    instead of :func:`migrate_user_rows` and returns the number of rows moved.
+    Tables derived from other tables are not moved, and are rebuilt when the
+    merge completes.
+    """
+    models = {
+        model.__table__: model
+        for model in db.Model.__subclasses__()
+        if hasattr(model, '__table__')
+    }
+    plan = []
+    hooked = set()
+    for table, column in user_foreign_keys():
+        if table is user_autocomplete:
+            continue
+        model = models.get(table)
+        if model is not None and hasattr(model, 'migrate_user'):
+            if model not in hooked:
+                hooked.add(model)
+                plan.append((table, column, model))
+        else:
+            plan.append((table, column, None))
+    return plan
+
+
+def _migrate_step(step, olduser, newuser, limit=None):
+    """
+    Move one table in the merge plan, up to ``limit`` rows. Returns the number
+    of rows moved or removed.
+    """
+    table, column, model = step
+    if model is not None:
+        return model.migrate_user(olduser=olduser, newuser=newuser, limit=limit)
+    return migrate_user_rows(table, column, olduser, newuser, limit)
+
+
+def _keep_and_merge(user1, user2):
+    # Always keep the older account and merge from the newer account
+    if user1.created_at < user2.created_at:
+        return user1, user2
+    return user2, user1
+
+
+def _release_username(keep_user, merge_user):
+    if not keep_user.username:
+        if merge_user.username:
+            # Flush before re-assigning to avoid dupe name constraint
+            username = merge_user.username
+            merge_user.username = None
+            db.session.flush()
+            keep_user.username = username
+    merge_user.username = None
+    db.session.flush()
+
+
+def _record_stale(keep_user, merge_user):
+    # Bulk updates skip ORM events, so record cached data that will be stale
+    # after commit: the tokens, sessions and clients of both users, as rows that
+    # were moved in earlier chunks of a merge now belong to keep_user
+    user_ids = [merge_user.id, keep_user.id]
+    db.session.info.setdefault('authtoken_stale', set()).update(
+        token
+        for (token,) in db.session.query(AuthToken.token).filter(
+            db.or_(
+                AuthToken.user_id.in_(user_ids),
+                # Cache entries hold the user of tokens issued to a user session
+                AuthToken.user_session_id.in_(
+                    db.session.query(UserSession.id).filter(
+                        UserSession.user_id.in_(user_ids)
+                    )
+                ),
+            )
+        )
+    )
+    db.session.info.setdefault('usersession_stale', set()).update(
+        buid
+        for (buid,) in db.session.query(UserSession.buid).filter(
+            UserSession.user_id.in_(user_ids)
+        )
+    )
+    db.session.info.setdefault('client_registry_stale', set()).update(
+        auth_client_id
+        for (auth_client_id,) in db.session.query(AuthClient.id).filter(
+            AuthClient.user_id.in_(user_ids)
+        )
+    )
+
+
+def _complete_merge(keep_user, merge_user):
+    # Add merge_user's uuid to olduserids
+    db.session.add(UserOldId(id=merge_user.uuid, user=keep_user))
+    # Mark merge_user as merged
+    merge_user.status = USER_STATUS.MERGED
+    # Bulk updates skip the flush listener that maintains autocomplete tokens
+    rebuild_autocomplete(db.session.connection(), [keep_user.id, merge_user.id])
+
+
+def merge_users(user1, user2):
+    """
+    Merge two user accounts in one transaction and return the new user account.
+    For large accounts, use :class:`UserMerge` instead.
+
+    Rows referring to the merged account are moved in bulk, one table at a time.
+    Models that need to combine rows instead of dropping duplicates do so in a
+    ``migrate_user`` classmethod. All other tables with a foreign key to
+    ``user.id`` are moved by :func:`migrate_user_rows`.
+    """
+    keep_user, merge_user = _keep_and_merge(user1, user2)
+    _release_username(keep_user, merge_user)
+    _record_stale(keep_user, merge_user)
+    for step in _merge_plan():
+        _migrate_step(step, merge_user, keep_user)
+    # Loaded instances and relationships no longer match the database
+    db.session.expire_all()
+    _complete_merge(keep_user, merge_user)
+    db.session.commit()
+    return keep_user
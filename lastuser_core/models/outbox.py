@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from coaster.sqlalchemy import JsonDict
+
+from . import BaseMixin, db
+
+__all__ = ['OutboxMessage']
+
+
+class OutboxMessage(BaseMixin, db.Model):
+    """
+    A message to be dispatched after the transaction that wrote it commits. See
+    :class:`lastuser_core.outbox.OutboxDispatcher`.
+    """
+
+    __tablename__ = 'outbox_message'
+    #: Kind of message, selecting the handler that dispatches it
+    kind = db.Column(db.Unicode(80), nullable=False)
+    #: Keyword arguments for the handler
+    payload = db.Column(JsonDict, nullable=False)
+    #: Messages with the same key are dispatched in order. A failed message holds
+    #: back later messages with its key, but not other messages
+    ordering_key = db.Column(db.Unicode(250), nullable=True)
+    #: Number of failed attempts to dispatch this message
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    #: Error from the last failed attempt
+    error = db.Column(db.UnicodeText, nullable=True)
+    #: A failed message is not tried again until this time
+    next_attempt_at = db.Column(
+        db.TIMESTAMP(timezone=True), nullable=False, default=db.func.utcnow()
+    )
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta, timezone
+
+from sqlalchemy import event as sqla_event
+from sqlalchemy.orm.attributes import get_history
+
+from coaster.utils import utcnow
+
+from . import db
+from .user import USER_STATUS, User
+
+__all__ = [
+    'client_user_day',
+    'client_user_hour',
+    'fold_rollups',
+    'rollup_client_users',
+    'rollup_users_by_month',
+    'user_signup_month',
+]
+
+# Rollup tables, filled by :func:`fold_rollups`. Buckets are in UTC. Rows are
+# (bucket, user) pairs rather than counts, so that distinct users can be counted
+# across any number of buckets.
+
+#: Users of each client in each hour. Only the last two days are kept
+client_user_hour = db.Table(
+    'client_user_hour',
+    db.Model.metadata,
+    db.Column('hour', db.TIMESTAMP(timezone=False), nullable=False, primary_key=True),
+    db.Column(
+        'auth_client_id',
+        None,
+        db.ForeignKey('auth_client.id'),
+        nullable=False,
+        primary_key=True,
+    ),
+    db.Column(
+        'user_id', None, db.ForeignKey('user.id'), nullable=False, primary_key=True
+    ),
+)
+
+#: Users of each client in each day
+client_user_day = db.Table(
+    'client_user_day',
+    db.Model.metadata,
+    db.Column('day', db.Date, nullable=False, primary_key=True),
+    db.Column(
+        'auth_client_id',
+        None,
+        db.ForeignKey('auth_client.id'),
+        nullable=False,
+        primary_key=True,
+    ),
+    db.Column(
+        'user_id', None, db.ForeignKey('user.id'), nullable=False, primary_key=True
+    ),
+)
+
+#: Active users by month of signup. Each fold adds the users created since the
+#: last, and a change to the status of a user already counted corrects the count
+user_signup_month = db.Table(
+    'user_signup_month',
+    db.Model.metadata,
+    db.Column('month', db.Date, nullable=False, primary_key=True),
+    db.Column('count', db.Integer, nullable=False),
+)
+
+#: Time up to which activity (``activity``) and signups (``signups``) have been
+#: folded into the rollups
+rollup_watermark = db.Table(
+    'rollup_watermark',
+    db.Model.metadata,
+    db.Column('name', db.Unicode(80), nullable=False, primary_key=True),
+    db.Column('folded_at', db.TIMESTAMP(timezone=True), nullable=False),
+)
+
+#: Activity timestamps are written behind (see lastuser_core.activity) and
+#: transactions commit out of order, so each fold looks back this far before the
+#: watermark. Folding is idempotent, so rows seen twice are harmless.
+ROLLUP_OVERLAP = timedelta(minutes=15)
+#: A first fold looks back this far, to fill the longest dashboard interval
+ROLLUP_BACKFILL = timedelta(days=366)
+#: Daily buckets older than this are removed
+ROLLUP_RETENTION = timedelta(days=400)
+
+
+def _watermark(name):
+    return db.session.execute(
+        db.text(
+            '''
+            SELECT folded_at FROM rollup_watermark WHERE name = :name FOR UPDATE
+            '''
+        ),
+        {'name': name},
+    ).scalar()
+
+
+def _set_watermark(name, folded_at):
+    db.session.execute(
+        db.text(
+            '''
+            INSERT INTO rollup_watermark (name, folded_at) VALUES (:name, :folded_at)
+            ON CONFLICT (name) DO UPDATE SET folded_at = excluded.folded_at
+            '''
+        ),
+        {'name': name, 'folded_at': folded_at},
+    )
+
+
+def fold_rollups():
+    """
+    Fold session and client activity and signups since the last fold into the
+    rollup tables. Returns the time folded up to. Concurrent folds wait for each
+    other.
+    """
+    now = utcnow()
+    folded_at = _watermark('activity')
+    since = (folded_at - ROLLUP_OVERLAP) if folded_at else (now - ROLLUP_BACKFILL)
+
+    for table, column, bucket in (
+        (
+            'client_user_hour',
+            'hour',
+            "date_trunc('hour', acus.accessed_at AT TIME ZONE 'UTC')",
+        ),
+        ('client_user_day', 'day', "(acus.accessed_at AT TIME ZONE 'UTC')::date"),
+    ):
+        db.session.execute(
+            db.text(
+                '''
+                INSERT INTO {table} ({column}, auth_client_id, user_id)
+                SELECT DISTINCT {bucket}, acus.auth_client_id, user_session.user_id
+                FROM auth_client_user_session AS acus, user_session
+                WHERE acus.user_session_id = user_session.id
+                    AND acus.accessed_at >= :since
+                ON CONFLICT DO NOTHING
+                '''.format(
+                    table=table, column=column, bucket=bucket
+                )
+            ),
+            {'since': since},
+        )
+
+    db.session.execute(
+        client_user_hour.delete().where(
+            client_user_hour.c.hour < (now - timedelta(days=2)).replace(tzinfo=None)
+        )
+    )
+    cutoff = (now - ROLLUP_RETENTION).date()
+    db.session.execute(client_user_day.delete().where(client_user_day.c.day < cutoff))
+
+    # Signups are counted, so unlike activity each is folded exactly once: up to
+    # ROLLUP_OVERLAP ago, so that users whose transactions commit late are not
+    # missed, and from where the last fold stopped
+    signups_at = _watermark('signups')
+    signups_to = now - ROLLUP_OVERLAP
+    if signups_at is None:
+        db.session.execute(user_signup_month.delete())
+    db.session.execute(
+        db.text(
+            '''
+            INSERT INTO user_signup_month (month, count)
+            SELECT date_trunc('month', created_at AT TIME ZONE 'UTC')::date, count(*)
+            FROM "user"
+            WHERE status = :status AND created_at < :until {since}
+            GROUP BY 1
+            ON CONFLICT (month) DO UPDATE
+            SET count = user_signup_month.count + excluded.count
+            '''.format(
+                since='AND created_at >= :since' if signups_at else ''
+            )
+        ),
+        {'status': USER_STATUS.ACTIVE, 'until': signups_to, 'since': signups_at},
+    )
+
+    _set_watermark('activity', now)
+    _set_watermark('signups', signups_to)
+    return now
+
+
+@sqla_event.listens_for(User, 'after_update')
+def _user_signup_status_updated(mapper, connection, target):
+    """Correct the signup count when the status of a user already counted changes"""
+    history = get_history(target, 'status')
+    if not history.deleted:
+        return
+    was_active = USER_STATUS.ACTIVE in history.deleted
+    if was_active == (target.status == USER_STATUS.ACTIVE):
+        return
+    # Wait for a fold in progress, and hold off the next, so that the user is
+    # counted by either the fold or this correction but not both
+    signups_at = connection.execute(
+        db.text(
+            '''
+            SELECT folded_at FROM rollup_watermark WHERE name = 'signups' FOR SHARE
+            '''
+        )
+    ).scalar()
+    if signups_at is None or target.created_at >= signups_at:
+        return
+    connection.execute(
+        db.text(
+            '''
+            INSERT INTO user_signup_month (month, count) VALUES (:month, :delta)
+            ON CONFLICT (month) DO UPDATE
+            SET count = user_signup_month.count + excluded.count
+            '''
+        ),
+        {
+            'month': target.created_at.astimezone(timezone.utc).date().replace(day=1),
+            'delta': -1 if was_active else 1,
+        },
+    )
+
+
+def rollup_users_by_month():
+    """Active users by month of signup, as (month, count) in order of month"""
+    return db.session.execute(
+        db.select([user_signup_month.c.month, user_signup_month.c.count]).order_by(
+            user_signup_month.c.month
+        )
+    ).fetchall()
+
+
+def rollup_client_users():
+    """
+    Distinct active users of each client in the last hour, day, week, month,
+    quarter, half year and year, in one query. Counts are of whole UTC hours and
+    days that overlap the interval, so the hour includes the previous hour and the
+    day includes the previous day.
+    """
+    return db.session.execute(
+        db.text(
+            '''
+            SELECT auth_client.id AS auth_client_id, auth_client.title AS title,
+                auth_client.website AS website,
+                count(DISTINCT rollup.user_id) FILTER (WHERE rollup.hourly) AS hour,
+                count(DISTINCT rollup.user_id) FILTER (
+                    WHERE NOT rollup.hourly
+                    AND rollup.bucket >= date_trunc('day', now_utc.ts - INTERVAL '1 day')
+                ) AS day,
+                count(DISTINCT rollup.user_id) FILTER (
+                    WHERE NOT rollup.hourly
+                    AND rollup.bucket >= date_trunc('day', now_utc.ts - INTERVAL '1 week')
+                ) AS week,
+                count(DISTINCT rollup.user_id) FILTER (
+                    WHERE NOT rollup.hourly
+                    AND rollup.bucket >= date_trunc('day', now_utc.ts - INTERVAL '1 month')
+                ) AS month,
+                count(DISTINCT rollup.user_id) FILTER (
+                    WHERE NOT rollup.hourly
+                    AND rollup.bucket >= date_trunc('day', now_utc.ts - INTERVAL '3 months')
+                ) AS quarter,
+                count(DISTINCT rollup.user_id) FILTER (
+                    WHERE NOT rollup.hourly
+                    AND rollup.bucket >= date_trunc('day', now_utc.ts - INTERVAL '6 months')
+                ) AS halfyear,
+                count(DISTINCT rollup.user_id) FILTER (WHERE NOT rollup.hourly) AS year
+            FROM (SELECT NOW() AT TIME ZONE 'UTC' AS ts) AS now_utc,
+            (
+                SELECT client_user_hour.auth_client_id, client_user_hour.user_id,
+                    client_user_hour.hour AS bucket, TRUE AS hourly
+                FROM client_user_hour
+                WHERE client_user_hour.hour >=
+                    date_trunc('hour', (NOW() AT TIME ZONE 'UTC') - INTERVAL '1 hour')
+                UNION ALL
+                SELECT client_user_day.auth_client_id, client_user_day.user_id,
+                    client_user_day.day::timestamp AS bucket, FALSE AS hourly
+                FROM client_user_day
+                WHERE client_user_day.day >=
+                    date_trunc('day', (NOW() AT TIME ZONE 'UTC') - INTERVAL '1 year')
+            ) AS rollup, "user", auth_client
+            WHERE rollup.user_id = "user".id
+                AND "user".status = :status
+                AND rollup.auth_client_id = auth_client.id
+            GROUP BY auth_client.id, auth_client.title, auth_client.website
+            '''
+        ),
+        {'status': USER_STATUS.ACTIVE},
+    ).fetchall()
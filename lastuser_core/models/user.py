@@ -2,7 +2,7 @@
 
 from datetime import timedelta
 
-from sqlalchemy import or_
+from sqlalchemy import and_, or_
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import defer, deferred
@@ -25,6 +25,7 @@ from coaster.utils import (
     valid_username,
 )
 
+from ..passwords import hash_password
 from . import BaseMixin, UuidMixin, db
 
 __all__ = [
@@ -279,18 +280,26 @@ class User(SharedNameMixin, UuidMixin, BaseMixin, db.Model):
         return self.status == USER_STATUS.ACTIVE
 
     def merged_user(self):
+        """
+        Return the account this user was merged into, or this user if not merged.
+        :func:`merge_users` keeps merges one hop long, so the account returned is
+        the live account. Load with :meth:`merged_user_option` to avoid queries.
+        """
         if self.status == USER_STATUS.MERGED:
-            return UserOldId.get(self.uuid).user
+            return self.oldid.user
         else:
             return self
 
+    @classmethod
+    def merged_user_option(cls):
+        """Query option to load the account each user was merged into, if any"""
+        return db.joinedload(cls.oldid).joinedload(UserOldId.user)
+
     def _set_password(self, password):
         if password is None:
             self.pw_hash = None
         else:
-            self.pw_hash = bcrypt.hashpw(
-                password.encode('utf-8'), bcrypt.gensalt()
-            ).decode('ascii')
+            self.pw_hash = hash_password(password)
         self.pw_set_at = db.func.utcnow()
         # Expire passwords after one year. TODO: make this configurable
         self.pw_expires_at = self.pw_set_at + timedelta(days=365)
@@ -305,16 +314,27 @@ class User(SharedNameMixin, UuidMixin, BaseMixin, db.Model):
             and self.pw_expires_at <= utcnow()
         )
 
+    @staticmethod
+    def password_hash_matches(pw_hash, password):
+        """
+        Compare a password with a password hash. This does not access the database
+        and is safe to call from another thread.
+        """
+        if pw_hash.startswith('sha1$'):  # XXX: DEPRECATED
+            return check_password_hash(pw_hash, password)
+        else:
+            return bcrypt.hashpw(
+                password.encode('utf-8'), pw_hash.encode('utf-8')
+            ) == pw_hash.encode('utf-8')
+
     def password_is(self, password):
+        """
+        Check the password in the current thread. Request handlers should use
+        :data:`lastuser_core.passwords.password_checker` instead.
+        """
         if self.pw_hash is None:
             return False
-
-        if self.pw_hash.startswith('sha1$'):  # XXX: DEPRECATED
-            return check_password_hash(self.pw_hash, password)
-        else:
-            return bcrypt.hashpw(
-                password.encode('utf-8'), self.pw_hash.encode('utf-8')
-            ) == self.pw_hash.encode('utf-8')
+        return self.password_hash_matches(self.pw_hash, password)
 
     def __repr__(self):
         return '<User {username} "{fullname}">'.format(
@@ -455,7 +475,7 @@ class User(SharedNameMixin, UuidMixin, BaseMixin, db.Model):
         return [
             token.auth_client
             for token in self.authtokens
-            if {'*', 'teams', 'teams/*'}.intersection(token.effective_scope)
+            if not token.compiled_effective_scope.isdisjoint({'*', 'teams', 'teams/*'})
         ]
 
     @classmethod
@@ -475,7 +495,7 @@ class User(SharedNameMixin, UuidMixin, BaseMixin, db.Model):
             query = cls.query.filter_by(buid=buid)
         if defercols:
             query = query.options(*cls._defercols)
-        user = query.one_or_none()
+        user = query.options(cls.merged_user_option()).one_or_none()
         if user and user.status == USER_STATUS.MERGED:
             user = user.merged_user()
         if user and user.is_active:
@@ -507,91 +527,78 @@ class User(SharedNameMixin, UuidMixin, BaseMixin, db.Model):
 
         if defercols:
             query = query.options(*cls._defercols)
-        for user in query.all():
+        for user in query.options(cls.merged_user_option()).all():
             user = user.merged_user()
             if user.is_active:
                 users.add(user)
         return list(users)
 
     @classmethod
-    def autocomplete(cls, query):
+    def autocomplete(cls, query, limit=100):
         """
         Return users whose names begin with the query, for autocomplete widgets.
-        Looks up users by fullname, username, external ids and email addresses.
+        Looks up users by fullname, username, external ids and email addresses,
+        using the tokens in :data:`user_autocomplete`. Users are listed once, with
+        matches on external ids and email addresses first, then usernames, then
+        fullnames.
 
         :param str query: Letters to start matching with
+        :param int limit: Maximum number of users to return
         """
-        # Escape the '%' and '_' wildcards in SQL LIKE clauses.
         # Some SQL dialects respond to '[' and ']', so remove them.
-        query = (
-            query.replace('%', r'\%')
-            .replace('_', r'\_')
-            .replace('[', '')
-            .replace(']', '')
-            + '%'
-        )
-        # Use User._username since 'username' is a hybrid property that checks for validity
-        # before passing on to _username, the actual column name on the model.
-        # We convert to lowercase and use the LIKE operator since ILIKE isn't standard
-        # and doesn't use an index on PostgreSQL (there's a functional index defined below).
+        query = query.replace('[', '').replace(']', '')
         if not query:
             return []
-        users = (
-            cls.query.join(AccountName)
-            .filter(
-                cls.status == USER_STATUS.ACTIVE,
-                or_(  # Match against buid (exact value only), fullname or username, case insensitive
-                    cls.buid == query[:-1],
-                    db.func.lower(cls.fullname).like(db.func.lower(query)),
-                    db.func.lower(AccountName.name).like(db.func.lower(query)),
-                ),
-            )
-            .options(*cls._defercols)
-            .limit(100)
-            .all()
-        )  # Limit to 100 results
+        # Escape the '%' and '_' wildcards in SQL LIKE clauses. Tokens are stored
+        # in lowercase, with an index for prefix matches with the LIKE operator
+        like = query.replace('%', r'\%').replace('_', r'\_').lower() + '%'
+        token = user_autocomplete.c.token
+        conditions = [
+            # Match against buid (exact value only), fullname or username
+            and_(user_autocomplete.c.kind == 'buid', token == query),
+            and_(
+                user_autocomplete.c.kind.in_(['username', 'fullname', 'word']),
+                token.like(like),
+            ),
+        ]
         if query.startswith('@') and UserExternalId.__at_username_services__:
-            # Add Twitter/GitHub accounts to the head of results
-            users = (
-                cls.query.filter(
-                    cls.status == USER_STATUS.ACTIVE,
-                    cls.id.in_(
-                        db.session.query(UserExternalId.user_id)
-                        .filter(
-                            UserExternalId.service.in_(
-                                UserExternalId.__at_username_services__
-                            ),
-                            db.func.lower(UserExternalId.username).like(
-                                db.func.lower(query[1:])
-                            ),
-                        )
-                        .subquery()
+            # Match Twitter/GitHub accounts
+            conditions.append(
+                and_(
+                    user_autocomplete.c.kind.in_(
+                        [
+                            '@' + service
+                            for service in UserExternalId.__at_username_services__
+                        ]
                     ),
+                    token.like(like[1:]),
                 )
-                .options(*cls._defercols)
-                .limit(100)
-                .all()
-                + users
             )
         elif '@' in query:
-            users = (
-                cls.query.filter(
-                    cls.status == USER_STATUS.ACTIVE,
-                    cls.id.in_(
-                        db.session.query(UserEmail.user_id)
-                        .filter(UserEmail.user_id.isnot(None))
-                        .filter(
-                            db.func.lower(UserEmail.email).like(db.func.lower(query))
-                        )
-                        .subquery()
-                    ),
-                )
-                .options(*cls._defercols)
-                .limit(100)
-                .all()
-                + users
+            # Match email addresses
+            conditions.append(
+                and_(user_autocomplete.c.kind == 'email', token.like(like))
+            )
+        # One row per user, with the best rank among their matching tokens
+        matches = (
+            db.select(
+                [
+                    user_autocomplete.c.user_id,
+                    db.func.min(user_autocomplete.c.rank).label('rank'),
+                ]
             )
-        return users
+            .where(or_(*conditions))
+            .group_by(user_autocomplete.c.user_id)
+            .alias('matches')
+        )
+        return (
+            cls.query.join(matches, matches.c.user_id == cls.id)
+            .filter(cls.status == USER_STATUS.ACTIVE)
+            .options(*cls._defercols)
+            .order_by(matches.c.rank, db.func.lower(cls.fullname), cls.id)
+            .limit(limit)
+            .all()
+        )
 
     @classmethod
     def active_user_count(cls):
@@ -609,7 +616,7 @@ class UserOldId(UuidMixin, BaseMixin, db.Model):
         backref=db.backref('oldid', uselist=False),
     )
     #: User id of new user
-    user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(None, db.ForeignKey('user.id'), nullable=False, index=True)
     #: New user account
     user = db.relationship(
         User,
@@ -798,13 +805,6 @@ class Team(UuidMixin, BaseMixin, db.Model):
             perms.add('delete')
         return perms
 
-    @classmethod
-    def migrate_user(cls, olduser, newuser):
-        for team in olduser.teams:
-            if team not in newuser.teams:
-                newuser.teams.append(team)
-        olduser.teams = []
-
     @classmethod
     def get(cls, buid, with_parent=False):
         """
@@ -1140,19 +1140,6 @@ class UserPhoneClaim(BaseMixin, db.Model):
         """
         return cls.query.filter_by(phone=phone).all()
 
-    @classmethod
-    def delete_expired(cls):
-        """Delete expired phone claims"""
-        # Delete if:
-        # 1. The claim is > 1 hour old
-        # 2. Too many unsuccessful verification attempts
-        cls.query.filter(
-            db.or_(
-                cls.updated_at < (utcnow() - timedelta(hours=1)),
-                cls.verification_expired,
-            )
-        ).delete(synchronize_session=False)
-
 
 class AuthPasswordResetRequest(BaseMixin, db.Model):
     __tablename__ = 'auth_password_reset_request'
@@ -1227,5 +1214,29 @@ class UserExternalId(BaseMixin, db.Model):
         return perms
 
 
+#: Normalized lookup tokens for :meth:`User.autocomplete`, maintained from writes
+#: to :class:`User`, :class:`AccountName`, :class:`UserEmail` and
+#: :class:`UserExternalId`. External id tokens have a kind of ``@`` + service
+user_autocomplete = db.Table(
+    'user_autocomplete',
+    db.Model.metadata,
+    db.Column(
+        'user_id',
+        None,
+        db.ForeignKey('user.id', ondelete='CASCADE'),
+        nullable=False,
+        primary_key=True,
+    ),
+    db.Column('kind', db.Unicode(80), nullable=False, primary_key=True),
+    db.Column('token', db.UnicodeText, nullable=False, primary_key=True),
+    db.Column('rank', db.SmallInteger, nullable=False),
+    db.Index(
+        'ix_user_autocomplete_token',
+        'token',
+        postgresql_ops={'token': 'text_pattern_ops'},
+    ),
+)
+
+
 add_primary_relationship(User, 'primary_email', UserEmail, 'user', 'user_id')
 add_primary_relationship(User, 'primary_phone', UserPhone, 'user', 'user_id')
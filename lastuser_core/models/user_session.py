@@ -1,20 +1,51 @@
 # -*- coding: utf-8 -*-
 
 from datetime import timedelta
+from functools import lru_cache
 
-from flask import request
-from werkzeug.utils import cached_property
+from sqlalchemy import event as sqla_event
+
+from flask import current_app, has_app_context, request
 
 from ua_parser import user_agent_parser
 
+from baseframe import cache
 from coaster.utils import buid as make_buid
 from coaster.utils import utcnow
 
 from ..signals import session_revoked
 from . import BaseMixin, UuidMixin, db
+from .cached import instance_data, merge_instance_data
 from .user import User
 
-__all__ = ['UserSession']
+__all__ = ['UserSession', 'parse_user_agent']
+
+#: Columns for the parsed user agent, in the order returned by parse_user_agent
+USER_AGENT_FIELDS = (
+    'ua_browser',
+    'ua_browser_version',
+    'ua_os',
+    'ua_os_version',
+    'ua_device',
+)
+
+
+@lru_cache(maxsize=4096)
+def parse_user_agent(user_agent):
+    """
+    Parse a user agent string into (browser, browser version, OS, OS version,
+    device). Results are cached, since a few browser releases account for most
+    sessions.
+    """
+    parsed = user_agent_parser.Parse(user_agent)
+    browser, os, device = parsed['user_agent'], parsed['os'], parsed['device']
+    return (
+        (browser['family'] or '')[:80],
+        (browser['major'] or '')[:20],
+        (os['family'] or '')[:80],
+        '.'.join(part for part in (os['major'], os['minor']) if part)[:20],
+        (device['family'] or '')[:80],
+    )
 
 
 auth_client_user_session = db.Table(
@@ -46,6 +77,8 @@ auth_client_user_session = db.Table(
         nullable=False,
         default=db.func.utcnow(),
     ),
+    # For folding recent activity into the dashboard rollups
+    db.Index('ix_auth_client_user_session_accessed_at', 'accessed_at'),
 )
 
 
@@ -62,8 +95,15 @@ class UserSession(UuidMixin, BaseMixin, db.Model):
 
     ipaddr = db.Column(db.String(45), nullable=False)
     user_agent = db.Column(db.UnicodeText, nullable=False)
+    #: Parsed from user_agent by :meth:`set_user_agent`; null for rows not yet
+    #: backfilled (see `./manage.py useragents`)
+    ua_browser = db.Column(db.Unicode(80), nullable=True)
+    ua_browser_version = db.Column(db.Unicode(20), nullable=True)
+    ua_os = db.Column(db.Unicode(80), nullable=True)
+    ua_os_version = db.Column(db.Unicode(20), nullable=True)
+    ua_device = db.Column(db.Unicode(80), nullable=True)
 
-    accessed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    accessed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, index=True)
     revoked_at = db.Column(db.TIMESTAMP(timezone=True), nullable=True)
     sudo_enabled_at = db.Column(
         db.TIMESTAMP(timezone=True), nullable=False, default=db.func.utcnow()
@@ -73,6 +113,8 @@ class UserSession(UuidMixin, BaseMixin, db.Model):
         super(UserSession, self).__init__(**kwargs)
         if not self.buid:
             self.buid = make_buid()
+        if self.user_agent is not None:
+            self.set_user_agent(self.user_agent)
 
     def access(self, auth_client=None):
         """
@@ -102,11 +144,24 @@ class UserSession(UuidMixin, BaseMixin, db.Model):
                     )
             else:
                 self.ipaddr = request.remote_addr or ''
-                self.user_agent = str(request.user_agent.string[:250]) or ''
+                user_agent = str(request.user_agent.string[:250]) or ''
+                if user_agent != self.user_agent or self.ua_browser is None:
+                    self.set_user_agent(user_agent)
 
-    @cached_property
+    def set_user_agent(self, user_agent):
+        """Set the user agent and the fields parsed from it"""
+        self.user_agent = user_agent
+        for field, value in zip(USER_AGENT_FIELDS, parse_user_agent(user_agent)):
+            setattr(self, field, value)
+
+    @property
     def ua(self):
-        return user_agent_parser.Parse(self.user_agent)
+        """Parsed user agent, as a dictionary of the ``ua_*`` fields without prefix"""
+        if self.ua_browser is None:
+            values = parse_user_agent(self.user_agent or '')
+        else:
+            values = [getattr(self, field) for field in USER_AGENT_FIELDS]
+        return {field[3:]: value for field, value in zip(USER_AGENT_FIELDS, values)}
 
     @property
     def has_sudo(self):
@@ -126,6 +181,31 @@ class UserSession(UuidMixin, BaseMixin, db.Model):
 
     @classmethod
     def authenticate(cls, buid):
+        """
+        Return a valid session with the given buid, or None. Results are cached for
+        ``USERSESSION_CACHE_TIMEOUT`` seconds (default 300), and cached sessions
+        are added to the database session without a query. The cache entry is
+        removed when the session is updated or revoked.
+        """
+        if not has_app_context():
+            return cls._authenticate_query(buid)
+        key = cls._cache_key(buid)
+        data = cache.get(key)
+        if data is None:
+            user_session = cls._authenticate_query(buid)
+            cache.set(
+                key,
+                instance_data(user_session) if user_session is not None else {},
+                timeout=current_app.config.get('USERSESSION_CACHE_TIMEOUT', 300),
+            )
+            return user_session
+        # An empty entry is an unknown, expired or revoked session
+        if not data or data['accessed_at'] <= utcnow() - timedelta(days=365):
+            return None
+        return merge_instance_data(cls, data)
+
+    @classmethod
+    def _authenticate_query(cls, buid):
         return cls.query.filter(
             # Session key must match.
             cls.buid == buid,
@@ -135,6 +215,10 @@ class UserSession(UuidMixin, BaseMixin, db.Model):
             cls.revoked_at.is_(None),
         ).one_or_none()
 
+    @staticmethod
+    def _cache_key(buid):
+        return 'lastuser/usersession/' + buid
+
 
 User.active_sessions = db.relationship(
     UserSession,
@@ -146,3 +230,35 @@ User.active_sessions = db.relationship(
     ),
     order_by=UserSession.accessed_at.desc(),
 )
+
+
+# --- Session cache invalidation ----------------------------------------------
+
+# Cache entries are removed when the change is flushed and again after commit, as
+# another worker may cache the old state from the database in between
+
+
+@sqla_event.listens_for(UserSession, 'after_update')
+@sqla_event.listens_for(UserSession, 'after_delete')
+def _usersession_updated(mapper, connection, target):
+    if has_app_context():
+        cache.delete(UserSession._cache_key(target.buid))
+        db.session.info.setdefault('usersession_stale', set()).add(target.buid)
+
+
+@session_revoked.connect
+def _usersession_revoked(user_session):
+    if has_app_context():
+        cache.delete(UserSession._cache_key(user_session.buid))
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _usersession_session_committed(session):
+    stale = session.info.pop('usersession_stale', None)
+    if stale:
+        cache.delete_many(*[UserSession._cache_key(buid) for buid in stale])
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _usersession_session_rolledback(session):
+    session.info.pop('usersession_stale', None)
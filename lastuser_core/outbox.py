@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from flask import current_app
+
+from coaster.utils import utcnow
+
+from .models import OutboxMessage, db
+
+__all__ = ['OutboxDispatcher', 'outbox']
+
+
+class OutboxDispatcher(object):
+    """
+    Transactional outbox. Signal receivers that need to reach other systems
+    (queueing jobs, calling webhooks) call :meth:`add` to write a message in the
+    request's database transaction. The messages are dispatched by a separate
+    process (``./manage.py outbox``) only once the transaction commits, and the
+    request does not wait on the other system.
+
+    Messages are dispatched in the order they were written. A message that fails
+    is tried again after a delay that doubles with each attempt, starting at
+    ``OUTBOX_RETRY_DELAY`` seconds (default 5) up to ``OUTBOX_RETRY_MAX_DELAY``
+    (default 3600), and until then holds back later messages with the same
+    ordering key, so that notices about a user reach other systems
+    in the order of the changes. Messages with other keys are not held back. A
+    message that fails ``OUTBOX_MAX_ATTEMPTS`` times (default 10) is left in the
+    table with its last error, and skipped; the sweeper removes it later. A
+    message may be dispatched again if the drain fails after its handler has
+    run, so handlers should tolerate duplicates.
+    """
+
+    #: Key for the PostgreSQL advisory lock that allows one drain at a time
+    lock_id = 0x6F7574626F78  # 'outbox'
+
+    def __init__(self):
+        self.handlers = {}
+
+    def handler(self, kind):
+        """Decorator that registers the handler for a kind of message"""
+
+        def decorator(f):
+            self.handlers[kind] = f
+            return f
+
+        return decorator
+
+    def add(self, kind, ordering_key=None, **payload):
+        """
+        Write a message to the outbox, in the current database session. Messages
+        with the same ``ordering_key`` are dispatched in order.
+        """
+        message = OutboxMessage(kind=kind, payload=payload, ordering_key=ordering_key)
+        db.session.add(message)
+        return message
+
+    def retry_delay(self, attempts):
+        """Delay before trying a message again after the given number of failures"""
+        return timedelta(
+            seconds=min(
+                current_app.config.get('OUTBOX_RETRY_DELAY', 5) * 2 ** (attempts - 1),
+                current_app.config.get('OUTBOX_RETRY_MAX_DELAY', 3600),
+            )
+        )
+
+    def drain(self, limit=100):
+        """
+        Dispatch up to ``limit`` pending messages. Returns the number dispatched,
+        or None if another process is draining the outbox.
+        """
+        max_attempts = current_app.config.get('OUTBOX_MAX_ATTEMPTS', 10)
+        if not db.session.execute(
+            db.select([db.func.pg_try_advisory_xact_lock(self.lock_id)])
+        ).scalar():
+            db.session.rollback()
+            return None
+        now = utcnow()
+        pending = OutboxMessage.query.filter(OutboxMessage.attempts < max_attempts)
+        messages = (
+            pending.filter(OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.id)
+            .limit(limit)
+            .all()
+        )
+        dispatched = 0
+        # Keys of messages waiting to be tried again
+        held = {
+            key
+            for (key,) in pending.filter(
+                OutboxMessage.next_attempt_at > now,
+                OutboxMessage.ordering_key.isnot(None),
+            )
+            .with_entities(OutboxMessage.ordering_key)
+            .distinct()
+        }
+        for message in messages:
+            if message.ordering_key is not None and message.ordering_key in held:
+                continue
+            try:
+                self.handlers[message.kind](**message.payload)
+            except Exception as e:
+                message.attempts += 1
+                message.error = '{name}: {message}'.format(
+                    name=type(e).__name__, message=e
+                )
+                message.next_attempt_at = now + self.retry_delay(message.attempts)
+                current_app.logger.exception(
+                    "Could not dispatch outbox message %s (attempt %s)",
+                    message.id,
+                    message.attempts,
+                )
+                if message.ordering_key is not None:
+                    held.add(message.ordering_key)
+                continue
+            db.session.delete(message)
+            dispatched += 1
+        # Releases the lock
+        db.session.commit()
+        return dispatched
+
+
+#: Outbox for this app
+outbox = OutboxDispatcher()
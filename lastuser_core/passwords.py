@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+from flask import current_app, has_app_context
+
+import bcrypt
+
+__all__ = [
+    'PasswordCheckBusy',
+    'PasswordChecker',
+    'bcrypt_rounds',
+    'hash_cost',
+    'hash_password',
+    'hash_timings',
+    'needs_rehash',
+    'password_checker',
+]
+
+#: bcrypt's own default cost, used outside an app context
+DEFAULT_BCRYPT_ROUNDS = 12
+
+
+def bcrypt_rounds():
+    """Target bcrypt cost for new password hashes (``PASSWORD_BCRYPT_ROUNDS``)"""
+    if has_app_context():
+        return current_app.config.get('PASSWORD_BCRYPT_ROUNDS', DEFAULT_BCRYPT_ROUNDS)
+    return DEFAULT_BCRYPT_ROUNDS
+
+
+def hash_password(password, rounds=None):
+    """Hash a password with bcrypt at the given or target cost"""
+    return bcrypt.hashpw(
+        password.encode('utf-8'), bcrypt.gensalt(rounds or bcrypt_rounds())
+    ).decode('ascii')
+
+
+def hash_cost(pw_hash):
+    """
+    Return the bcrypt cost of a password hash, or None if the hash does not use
+    bcrypt (such as the deprecated ``sha1$`` scheme)
+    """
+    # bcrypt hashes look like $2b$12$<salt and hash>
+    parts = pw_hash.split('$')
+    if len(parts) == 4 and parts[0] == '' and parts[1].startswith('2'):
+        try:
+            return int(parts[2])
+        except ValueError:
+            pass
+    return None
+
+
+def needs_rehash(pw_hash, rounds=None):
+    """
+    Return True if a password hash uses a legacy scheme or a cost below the
+    target, and should be replaced when the password is next available
+    """
+    cost = hash_cost(pw_hash)
+    return cost is None or cost < (rounds or bcrypt_rounds())
+
+
+def hash_timings(rounds, samples=3):
+    """Return the best time in seconds to hash a password at each bcrypt cost"""
+    timings = {}
+    for cost in rounds:
+        salt = bcrypt.gensalt(cost)
+        best = None
+        for sample in range(samples):
+            start = perf_counter()
+            bcrypt.hashpw(b'benchmark password', salt)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[cost] = best
+    return timings
+
+
+class PasswordCheckBusy(Exception):
+    """
+    Too many password checks are pending in this process. The caller should ask
+    the client to retry after :attr:`retry_after` seconds.
+    """
+
+    def __init__(self, retry_after):
+        super(PasswordCheckBusy, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class PasswordChecker(object):
+    """
+    Runs password hash comparisons in a bounded thread pool, so that a burst of
+    logins cannot occupy every request thread with bcrypt.
+
+    The pool has ``PASSWORD_CHECK_WORKERS`` threads (default 4) and accepts up to
+    ``PASSWORD_CHECK_QUEUE`` further checks waiting for a thread (default 16).
+    Beyond that, :meth:`check` fails immediately with :exc:`PasswordCheckBusy`,
+    carrying ``PASSWORD_CHECK_RETRY_AFTER`` seconds (default 5) as a retry hint.
+    The pool is created on first use with the settings of the app at that time.
+
+    A successful check also replaces a hash that uses the deprecated ``sha1$``
+    scheme or a bcrypt cost below ``PASSWORD_BCRYPT_ROUNDS`` (see
+    :func:`needs_rehash`). The new hash is set on the user and saved when the
+    caller commits.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._executor = None
+        self._slots = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                workers = current_app.config.get('PASSWORD_CHECK_WORKERS', 4)
+                queue = current_app.config.get('PASSWORD_CHECK_QUEUE', 16)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix='password-check'
+                )
+                self._slots = BoundedSemaphore(workers + queue)
+            return self._executor, self._slots
+
+    def check(self, user, password):
+        """
+        Return True if the password matches the user's password hash, upgrading
+        the hash if required. Raises :exc:`PasswordCheckBusy` if the pool is
+        saturated.
+        """
+        pw_hash = user.pw_hash
+        if pw_hash is None or not password:
+            return False
+        executor, slots = self._pool()
+        if not slots.acquire(blocking=False):
+            raise PasswordCheckBusy(
+                current_app.config.get('PASSWORD_CHECK_RETRY_AFTER', 5)
+            )
+        try:
+            future = executor.submit(
+                self._check_hash,
+                user.password_hash_matches,
+                pw_hash,
+                password,
+                bcrypt_rounds(),
+            )
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        matches, new_hash = future.result()
+        # Upgrade a legacy or weak hash, unless the password changed meanwhile
+        if new_hash is not None and user.pw_hash == pw_hash:
+            user.pw_hash = new_hash
+        return matches
+
+    @staticmethod
+    def _check_hash(password_hash_matches, pw_hash, password, rounds):
+        """
+        Compare the password in a pool thread, and rehash it at the target cost if
+        the existing hash is due for an upgrade. Returns (matches, new_hash).
+        """
+        if not password_hash_matches(pw_hash, password):
+            return False, None
+        if needs_rehash(pw_hash, rounds):
+            return True, hash_password(password, rounds)
+        return True, None
+
+
+#: Password checker for this process
+password_checker = PasswordChecker()
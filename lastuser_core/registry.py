@@ -5,25 +5,254 @@ Resource registry
 """
 
 from collections import OrderedDict
+from datetime import timedelta
 from functools import wraps
+from threading import Lock
+from time import monotonic
 import re
 
-from flask import Response, abort, jsonify, request
+from sqlalchemy import event as sqla_event
+from sqlalchemy.orm.attributes import get_history
 
-from baseframe import _
-from baseframe.signals import exception_catchall
+from flask import Response, abort, current_app, has_app_context, jsonify, request
 
-from .models import AuthToken, UserExternalId
+from baseframe import _, cache
+from baseframe.signals import exception_catchall
+from coaster.utils import require_one_of, utcnow, uuid2buid
+
+from .models import (
+    AuthClient,
+    AuthClientCredential,
+    AuthToken,
+    User,
+    UserExternalId,
+    db,
+    merge_instance_data,
+)
+from .signals import session_revoked
 
 # Bearer token, as per http://tools.ietf.org/html/draft-ietf-oauth-v2-bearer-15#section-2.1
 auth_bearer_re = re.compile('^Bearer ([a-zA-Z0-9_.~+/-]+=*)$')
 
 
+class AuthTokenCache(object):
+    """
+    Two-tier cache for bearer token validation: a small in-process LRU in front of
+    the app cache (Redis), which is shared across workers. Each entry holds what
+    :class:`ResourceRegistry` needs to validate a request without a database query:
+    the token's id, the ids of its user and client, the client's trusted flag, the
+    validity window and the effective scope. Unknown tokens are also cached,
+    briefly.
+
+    Invalidation removes entries from the shared cache and from this process's LRU.
+    Other workers may continue to use their local copy until it expires, so the
+    local timeout must be kept short.
+    """
+
+    #: Marker for unknown tokens in the shared cache
+    unknown = 'unknown'
+
+    def __init__(self):
+        self._local = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _cache_key(token):
+        return 'lastuser/authtoken/' + token
+
+    @staticmethod
+    def make_entry(authtoken):
+        """Return a cache entry for the given :class:`AuthToken`."""
+        return {
+            'id': authtoken.id,
+            # The token's user is either its own or its user session's
+            'user_id': (
+                authtoken.user_session.user_id
+                if authtoken.user_session_id is not None
+                else authtoken.user_id
+            ),
+            'auth_client_id': authtoken.auth_client_id,
+            'trusted': authtoken.auth_client.trusted,
+            'created_at': authtoken.created_at,
+            'validity': authtoken.validity,
+            'scope': authtoken.compiled_effective_scope,
+        }
+
+    @staticmethod
+    def entry_is_valid(entry):
+        """Equivalent of :meth:`AuthToken.is_valid` for a cache entry."""
+        if entry['validity'] == 0:
+            return True  # This token is perpetually valid
+        return entry['created_at'] >= utcnow() - timedelta(seconds=entry['validity'])
+
+    def _remember(self, token, entry, timeout):
+        maxsize = current_app.config.get('AUTHTOKEN_CACHE_SIZE', 1024)
+        with self._lock:
+            self._local[token] = (monotonic() + timeout, entry)
+            self._local.move_to_end(token)
+            while len(self._local) > maxsize:
+                self._local.popitem(last=False)
+
+    def get(self, token):
+        """
+        Return a cache entry for the given token, or None if the token is unknown.
+        Reads through to the database if the token isn't in either cache.
+        """
+        with self._lock:
+            item = self._local.get(token)
+            if item is not None:
+                expires_at, entry = item
+                if expires_at > monotonic():
+                    self._local.move_to_end(token)
+                    return None if entry == self.unknown else entry
+                del self._local[token]
+
+        config = current_app.config
+        local_timeout = config.get('AUTHTOKEN_CACHE_LOCAL_TIMEOUT', 10)
+        unknown_timeout = config.get('AUTHTOKEN_CACHE_UNKNOWN_TIMEOUT', 30)
+
+        cache_key = self._cache_key(token)
+        entry = cache.get(cache_key)
+        if entry is None:
+            authtoken = AuthToken.get(token=token)
+            if authtoken is None:
+                entry = self.unknown
+                cache.set(cache_key, entry, timeout=unknown_timeout)
+            else:
+                entry = self.make_entry(authtoken)
+                timeout = config.get('AUTHTOKEN_CACHE_TIMEOUT', 300)
+                if entry['validity']:
+                    # Don't hold on to the token beyond its validity
+                    remaining = (
+                        entry['created_at']
+                        + timedelta(seconds=entry['validity'])
+                        - utcnow()
+                    ).total_seconds()
+                    timeout = max(1, min(timeout, int(remaining)))
+                cache.set(cache_key, entry, timeout=timeout)
+
+        if entry == self.unknown:
+            self._remember(token, entry, min(local_timeout, unknown_timeout))
+            return None
+        self._remember(token, entry, local_timeout)
+        return entry
+
+    def discard(self, *tokens):
+        """Remove the given tokens from the cache."""
+        tokens = [token for token in tokens if token]
+        if not tokens:
+            return
+        with self._lock:
+            for token in tokens:
+                self._local.pop(token, None)
+        if has_app_context():
+            cache.delete_many(*[self._cache_key(token) for token in tokens])
+
+    def clear_local(self):
+        """Empty this process's LRU (the shared cache is not affected)."""
+        with self._lock:
+            self._local.clear()
+
+
+#: Global bearer token cache, used by :meth:`ResourceRegistry.resource`
+authtoken_cache = AuthTokenCache()
+
+
+class UnknownAuthToken(Exception):
+    """A cached token was deleted before the resource function loaded it"""
+
+
+class CachedAuthToken(object):
+    """
+    Stand-in for :class:`AuthToken` passed to resource functions, made from an
+    :class:`AuthTokenCache` entry. The user is loaded by id and the client comes
+    from :data:`client_registry`. The token is loaded from the database only if
+    the resource function asks for something the cache entry does not have. If
+    the token has since been deleted, it is discarded from the cache and
+    :exc:`UnknownAuthToken` is raised.
+    """
+
+    def __init__(self, token, entry):
+        self.token = token
+        self.entry = entry
+
+    @property
+    def compiled_effective_scope(self):
+        return self.entry['scope']
+
+    @property
+    def effective_scope(self):
+        return sorted(self.entry['scope'])
+
+    @property
+    def auth_client_id(self):
+        return self.entry['auth_client_id']
+
+    @property
+    def auth_client(self):
+        return client_registry.get_client_by_id(self.entry['auth_client_id'])
+
+    @property
+    def user(self):
+        if self.entry['user_id'] is not None:
+            return User.query.get(self.entry['user_id'])
+
+    def is_valid(self):
+        return AuthTokenCache.entry_is_valid(self.entry)
+
+    def __getattr__(self, attr):
+        # Only called for attributes that are not found on this object
+        if attr.startswith('__') or attr == '_authtoken':
+            raise AttributeError(attr)
+        if '_authtoken' not in self.__dict__:
+            authtoken = AuthToken.query.get(self.entry['id'])
+            if authtoken is None:
+                # Deleted after this worker cached it
+                authtoken_cache.discard(self.token)
+                raise UnknownAuthToken(self.token)
+            self._authtoken = authtoken
+        return getattr(self._authtoken, attr)
+
+    def __repr__(self):
+        return '<CachedAuthToken {token}>'.format(token=self.token)
+
+
 class ResourceRegistry(OrderedDict):
     """
     Dictionary of resources
     """
 
+    def __init__(self, *args, **kwargs):
+        self._wildcard_index = None
+        super(ResourceRegistry, self).__init__(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        self._wildcard_index = None
+        return super(ResourceRegistry, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._wildcard_index = None
+        return super(ResourceRegistry, self).__delitem__(key)
+
+    def wildcard_resources(self, base):
+        """
+        Return names of resources matched by the wildcard scope ``base/*``, in
+        registration order. The index is built on first use after the registry was
+        last modified, which is once all resources have been declared.
+
+        :param str base: Wildcard scope without the trailing ``/*``
+        """
+        if self._wildcard_index is None:
+            index = {}
+            for key in self:
+                parts = key.split('/')
+                for counter in range(1, len(parts) + 1):
+                    index.setdefault('/'.join(parts[:counter]), []).append(key)
+            self._wildcard_index = {
+                wildcard: tuple(keys) for wildcard, keys in index.items()
+            }
+        return self._wildcard_index.get(base, ())
+
     def resource(self, name, description=None, trusted=False, scope=None):
         """
         Decorator for resource functions.
@@ -37,6 +266,7 @@ class ResourceRegistry(OrderedDict):
         if '*' in usescope or ' ' in usescope:
             # Don't allow resources to be declared with '*' or ' ' in the name
             raise ValueError(usescope)
+        wildcardscope = usescope.split('/', 1)[0] + '/*'
 
         def resource_auth_error(message):
             return Response(
@@ -73,17 +303,15 @@ class ResourceRegistry(OrderedDict):
                     return resource_auth_error(
                         _("An access token is required to access this resource")
                     )
-                authtoken = AuthToken.get(token=token)
-                if not authtoken:
+                entry = authtoken_cache.get(token)
+                if not entry:
                     return resource_auth_error(_("Unknown access token"))
+                authtoken = CachedAuthToken(token, entry)
                 if not authtoken.is_valid():
                     return resource_auth_error(_("Access token has expired"))
 
-                tokenscope = set(
-                    authtoken.effective_scope
-                )  # Read once to avoid reparsing below
-                wildcardscope = usescope.split('/', 1)[0] + '/*'
-                if not (authtoken.auth_client.trusted and '*' in tokenscope):
+                tokenscope = entry['scope']
+                if not (entry['trusted'] and '*' in tokenscope):
                     # If a trusted client has '*' in token scope, all good, else check further
                     if (usescope not in tokenscope) and (
                         wildcardscope not in tokenscope
@@ -92,7 +320,7 @@ class ResourceRegistry(OrderedDict):
                         return resource_auth_error(
                             _("Token does not provide access to this resource")
                         )
-                if trusted and not authtoken.auth_client.trusted:
+                if trusted and not entry['trusted']:
                     return resource_auth_error(
                         _("This resource can only be accessed by trusted clients")
                     )
@@ -100,6 +328,8 @@ class ResourceRegistry(OrderedDict):
                 try:
                     result = f(authtoken, args, request.files)
                     response = jsonify({'status': 'ok', 'result': result})
+                except UnknownAuthToken:
+                    return resource_auth_error(_("Unknown access token"))
                 except Exception as exception:
                     exception_catchall.send(exception)
                     response = jsonify(
@@ -129,6 +359,267 @@ class ResourceRegistry(OrderedDict):
         return wrapper
 
 
+def _authtoken_stale(*tokens):
+    # Discard now, and again after commit, as a concurrent request may cache the
+    # old row from another connection before this transaction commits
+    tokens = [token for token in tokens if token]
+    if tokens:
+        authtoken_cache.discard(*tokens)
+        db.session.info.setdefault('authtoken_stale', set()).update(tokens)
+
+
+@sqla_event.listens_for(AuthToken, 'after_update')
+def _authtoken_updated(mapper, connection, target):
+    # A refresh replaces the token, so discard the previous value as well
+    _authtoken_stale(target.token, *get_history(target, 'token').deleted)
+
+
+@sqla_event.listens_for(AuthToken, 'after_delete')
+def _authtoken_deleted(mapper, connection, target):
+    _authtoken_stale(target.token)
+
+
+@sqla_event.listens_for(AuthClient, 'after_update')
+def _auth_client_updated(mapper, connection, target):
+    # The client's scope and trusted flag are part of every token's cache entry
+    if (
+        get_history(target, '_scope').has_changes()
+        or get_history(target, 'trusted').has_changes()
+    ):
+        _authtoken_stale(
+            *[
+                row.token
+                for row in connection.execute(
+                    db.select([AuthToken.__table__.c.token]).where(
+                        AuthToken.__table__.c.auth_client_id == target.id
+                    )
+                )
+            ]
+        )
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _authtoken_session_committed(session):
+    # Tokens changed in ORM events, and in bulk outside them (as in merge_users)
+    stale = session.info.pop('authtoken_stale', None)
+    if stale:
+        authtoken_cache.discard(*stale)
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _authtoken_session_rolledback(session):
+    session.info.pop('authtoken_stale', None)
+
+
+@session_revoked.connect
+def _session_revoked(user_session):
+    _authtoken_stale(
+        *[
+            token
+            for (token,) in db.session.query(AuthToken.token).filter(
+                AuthToken.user_session_id == user_session.id
+            )
+        ]
+    )
+
+
+class AuthClientRegistry(object):
+    """
+    Per-worker registry of all clients and client credentials, for lookups by
+    credential name, client buid and namespace without a database query. Lookups
+    return instances added to the database session as if loaded from the database.
+
+    The registry is versioned with a counter in the app cache (Redis), shared
+    across workers. Changes to :class:`AuthClient` and
+    :class:`AuthClientCredential` increment the counter after commit and record
+    the clients that changed under the new version. On each lookup, a worker that
+    is behind reloads only the changed clients, or everything if the record of a
+    version is missing.
+    """
+
+    version_key = 'lastuser/clientregistry/version'
+    changes_key = 'lastuser/clientregistry/changes/'
+    #: Reload everything if further behind than this many versions
+    max_changes = 100
+
+    def __init__(self):
+        self._lock = Lock()
+        self._version = None
+        #: Column values, keyed by client id and credential name
+        self._clients = {}
+        self._credentials = {}
+        #: Client ids by buid and namespace
+        self._buids = {}
+        self._namespaces = {}
+
+    @staticmethod
+    def _select(model, whereclause=None):
+        """Load column values for a model, outside the database session"""
+        columns = [
+            (prop.key, prop.columns[0]) for prop in model.__mapper__.column_attrs
+        ]
+        query = db.select([column for key, column in columns])
+        if whereclause is not None:
+            query = query.where(whereclause)
+        with db.engine.connect() as connection:
+            return [
+                {key: row[column] for key, column in columns}
+                for row in connection.execute(query)
+            ]
+
+    def _load(self, auth_client_ids=None):
+        """Reload the given clients and their credentials, or all if None"""
+        if auth_client_ids is None:
+            clients = self._select(AuthClient)
+            credentials = self._select(AuthClientCredential)
+        else:
+            clients = self._select(AuthClient, AuthClient.id.in_(auth_client_ids))
+            credentials = self._select(
+                AuthClientCredential,
+                AuthClientCredential.auth_client_id.in_(auth_client_ids),
+            )
+        with self._lock:
+            if auth_client_ids is None:
+                self._clients = {}
+                self._credentials = {}
+            else:
+                for auth_client_id in auth_client_ids:
+                    self._clients.pop(auth_client_id, None)
+                self._credentials = {
+                    name: data
+                    for name, data in self._credentials.items()
+                    if data['auth_client_id'] not in auth_client_ids
+                }
+            for data in clients:
+                self._clients[data['id']] = data
+            for data in credentials:
+                self._credentials[data['name']] = data
+            self._buids = {
+                uuid2buid(data['uuid']): auth_client_id
+                for auth_client_id, data in self._clients.items()
+            }
+            self._namespaces = {
+                data['namespace']: auth_client_id
+                for auth_client_id, data in self._clients.items()
+                if data['namespace']
+            }
+
+    def refresh(self):
+        """Bring the registry up to date with the shared version"""
+        version = cache.get(self.version_key) or 0
+        if version == self._version:
+            return
+        changed = None
+        if self._version is not None and 0 < version - self._version <= (
+            self.max_changes
+        ):
+            changes = cache.get_many(
+                *[
+                    self.changes_key + str(number)
+                    for number in range(self._version + 1, version + 1)
+                ]
+            )
+            if None not in changes:
+                changed = set().union(*changes)
+        self._load(changed)
+        self._version = version
+
+    def changed(self, auth_client_ids):
+        """Record that the given clients have changed, for all workers"""
+        version = cache.inc(self.version_key)
+        cache.set(
+            self.changes_key + str(version),
+            set(auth_client_ids),
+            timeout=current_app.config.get('CLIENT_REGISTRY_CHANGES_TIMEOUT', 3600),
+        )
+
+    def _client_instance(self, auth_client_id):
+        data = self._clients.get(auth_client_id)
+        if data is not None:
+            return merge_instance_data(AuthClient, data)
+
+    def get_credential(self, name):
+        """Equivalent of :meth:`AuthClientCredential.get`, with the client loaded"""
+        self.refresh()
+        data = self._credentials.get(name)
+        if data is None:
+            return None
+        # Add the client to the session so that `credential.auth_client` finds it
+        self._client_instance(data['auth_client_id'])
+        return merge_instance_data(AuthClientCredential, data)
+
+    def get_client_by_id(self, auth_client_id):
+        """Return the client with the given id, active or not"""
+        self.refresh()
+        return self._client_instance(auth_client_id)
+
+    def get_client(self, buid=None, namespace=None):
+        """Equivalent of :meth:`AuthClient.get`. Only returns active clients"""
+        param, value = require_one_of(True, buid=buid, namespace=namespace)
+        self.refresh()
+        if param == 'buid':
+            auth_client_id = self._buids.get(value)
+        else:
+            auth_client_id = self._namespaces.get(value)
+        data = self._clients.get(auth_client_id)
+        if data is not None and data['active']:
+            return merge_instance_data(AuthClient, data)
+
+
+#: Client registry for this process
+client_registry = AuthClientRegistry()
+
+
+# Changes are recorded after commit, so that workers reload committed data
+
+
+def _client_registry_stale(auth_client_id):
+    db.session.info.setdefault('client_registry_stale', set()).add(auth_client_id)
+
+
+def _columns_changed(mapper, target, ignore=()):
+    return any(
+        get_history(target, prop.key).has_changes()
+        for prop in mapper.column_attrs
+        if prop.key not in ignore
+    )
+
+
+@sqla_event.listens_for(AuthClient, 'after_insert')
+@sqla_event.listens_for(AuthClient, 'after_delete')
+@sqla_event.listens_for(AuthClientCredential, 'after_insert')
+@sqla_event.listens_for(AuthClientCredential, 'after_delete')
+def _client_registry_row_changed(mapper, connection, target):
+    _client_registry_stale(
+        target.id if isinstance(target, AuthClient) else target.auth_client_id
+    )
+
+
+@sqla_event.listens_for(AuthClient, 'after_update')
+def _client_registry_client_updated(mapper, connection, target):
+    if _columns_changed(mapper, target):
+        _client_registry_stale(target.id)
+
+
+@sqla_event.listens_for(AuthClientCredential, 'after_update')
+def _client_registry_credential_updated(mapper, connection, target):
+    # Usage timestamps are not used by the registry
+    if _columns_changed(mapper, target, ignore=('accessed_at',)):
+        _client_registry_stale(target.auth_client_id)
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _client_registry_session_committed(session):
+    stale = session.info.pop('client_registry_stale', None)
+    if stale and has_app_context():
+        client_registry.changed(stale)
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _client_registry_session_rolledback(session):
+    session.info.pop('client_registry_stale', None)
+
+
 class LoginProviderRegistry(OrderedDict):
     """Registry of login providers"""
 
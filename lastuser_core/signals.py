@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
+from functools import partial
+
 from sqlalchemy import event as sqla_event
+from sqlalchemy.orm import object_session
 
+from flask import current_app
 from flask.signals import Namespace
 
 from .models import (
@@ -12,6 +17,7 @@ from .models import (
     UserEmailClaim,
     UserPhone,
     UserPhoneClaim,
+    db,
 )
 
 lastuser_signals = Namespace()
@@ -55,106 +61,90 @@ team_data_changed = lastuser_signals.signal('team-data-changed')
 session_revoked = lastuser_signals.signal('session-revoked')
 
 
-@sqla_event.listens_for(User, 'after_insert')
-def _user_new(mapper, connection, target):
-    model_user_new.send(target)
-
-
-@sqla_event.listens_for(User, 'after_update')
-def _user_edited(mapper, connection, target):
-    model_user_edited.send(target)
-
-
-@sqla_event.listens_for(User, 'after_delete')
-def _user_deleted(mapper, connection, target):
-    model_user_deleted.send(target)
-
-
-@sqla_event.listens_for(Organization, 'after_insert')
-def _org_new(mapper, connection, target):
-    model_org_new.send(target)
-
-
-@sqla_event.listens_for(Organization, 'after_update')
-def _org_edited(mapper, connection, target):
-    model_org_edited.send(target)
-
-
-@sqla_event.listens_for(Organization, 'after_delete')
-def _org_deleted(mapper, connection, target):
-    model_org_deleted.send(target)
-
-
-@sqla_event.listens_for(Team, 'after_insert')
-def _team_new(mapper, connection, target):
-    model_team_new.send(target)
-
-
-@sqla_event.listens_for(Team, 'after_update')
-def _team_edited(mapper, connection, target):
-    model_team_edited.send(target)
-
-
-@sqla_event.listens_for(Team, 'after_delete')
-def _team_deleted(mapper, connection, target):
-    model_team_deleted.send(target)
-
-
-@sqla_event.listens_for(UserEmail, 'after_insert')
-def _useremail_new(mapper, connection, target):
-    model_useremail_new.send(target)
-
-
-@sqla_event.listens_for(UserEmail, 'after_update')
-def _useremail_edited(mapper, connection, target):
-    model_useremail_edited.send(target)
-
-
-@sqla_event.listens_for(UserEmail, 'after_delete')
-def _useremail_deleted(mapper, connection, target):
-    model_useremail_deleted.send(target)
-
-
-@sqla_event.listens_for(UserEmailClaim, 'after_insert')
-def _useremailclaim_new(mapper, connection, target):
-    model_useremailclaim_new.send(target)
-
-
-@sqla_event.listens_for(UserEmailClaim, 'after_update')
-def _useremailclaim_edited(mapper, connection, target):
-    model_useremailclaim_edited.send(target)
-
-
-@sqla_event.listens_for(UserEmailClaim, 'after_delete')
-def _useremailclaim_deleted(mapper, connection, target):
-    model_useremailclaim_deleted.send(target)
-
-
-@sqla_event.listens_for(UserPhone, 'after_insert')
-def _userphone_new(mapper, connection, target):
-    model_userphone_new.send(target)
-
-
-@sqla_event.listens_for(UserPhone, 'after_update')
-def _userphone_edited(mapper, connection, target):
-    model_userphone_edited.send(target)
-
-
-@sqla_event.listens_for(UserPhone, 'after_delete')
-def _userphone_deleted(mapper, connection, target):
-    model_userphone_deleted.send(target)
-
-
-@sqla_event.listens_for(UserPhoneClaim, 'after_insert')
-def _userphoneclaim_new(mapper, connection, target):
-    model_userphoneclaim_new.send(target)
-
-
-@sqla_event.listens_for(UserPhoneClaim, 'after_update')
-def _userphoneclaim_edited(mapper, connection, target):
-    model_userphoneclaim_edited.send(target)
-
-
-@sqla_event.listens_for(UserPhoneClaim, 'after_delete')
-def _userphoneclaim_deleted(mapper, connection, target):
-    model_userphoneclaim_deleted.send(target)
+# Model signals are not sent during a flush. Events are collected in the session
+# and sent after the transaction commits, once per changed object and grouped by
+# model, so that receivers do not hold the transaction open and see only changes
+# that are visible to other workers. Nothing is sent if the transaction is
+# rolled back. Receivers are called before the session expires the objects, so
+# loaded attributes can be read, but they must not load anything from the
+# database.
+
+#: Receivers that take all targets of a model signal in one call, by signal
+batch_receivers = {}
+
+
+def connect_batch(signal):
+    """
+    Decorator for a receiver of a model signal that is called once per commit
+    and model with a list of all the changed objects, instead of once per object
+    """
+
+    def decorator(f):
+        batch_receivers.setdefault(signal, []).append(f)
+        return f
+
+    return decorator
+
+
+def _collect(signal):
+    def listener(mapper, connection, target):
+        # Kept in the flushing session, which commits or rolls back the change
+        events = object_session(target).info.setdefault('model_events', OrderedDict())
+        # Objects stay in the session until commit, so their ids are unique
+        events.setdefault((signal, mapper.class_), OrderedDict())[id(target)] = target
+
+    return listener
+
+
+for model, (signal_new, signal_edited, signal_deleted) in (
+    (User, (model_user_new, model_user_edited, model_user_deleted)),
+    (Organization, (model_org_new, model_org_edited, model_org_deleted)),
+    (Team, (model_team_new, model_team_edited, model_team_deleted)),
+    (UserEmail, (model_useremail_new, model_useremail_edited, model_useremail_deleted)),
+    (
+        UserEmailClaim,
+        (
+            model_useremailclaim_new,
+            model_useremailclaim_edited,
+            model_useremailclaim_deleted,
+        ),
+    ),
+    (UserPhone, (model_userphone_new, model_userphone_edited, model_userphone_deleted)),
+    (
+        UserPhoneClaim,
+        (
+            model_userphoneclaim_new,
+            model_userphoneclaim_edited,
+            model_userphoneclaim_deleted,
+        ),
+    ),
+):
+    sqla_event.listen(model, 'after_insert', _collect(signal_new))
+    sqla_event.listen(model, 'after_update', _collect(signal_edited))
+    sqla_event.listen(model, 'after_delete', _collect(signal_deleted))
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _send_model_events(session):
+    events = session.info.pop('model_events', None)
+    if not events:
+        return
+    for (signal, model), targets in events.items():
+        targets = list(targets.values())
+        receivers = [
+            partial(receiver, targets) for receiver in batch_receivers.get(signal, ())
+        ] + [partial(signal.send, target) for target in targets]
+        for receiver in receivers:
+            # The transaction has committed, so a failing receiver cannot undo it
+            # and should not keep the others from running
+            try:
+                receiver()
+            except Exception:  # NOQA: B902
+                current_app.logger.exception(
+                    "Receiver failed for signal %s on %s", signal.name, model.__name__
+                )
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _discard_model_events(session):
+    session.info.pop('model_events', None)
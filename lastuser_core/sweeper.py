@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from time import sleep
+
+from flask import current_app
+
+from coaster.utils import utcnow
+
+from .models import (
+    AuthCode,
+    AuthPasswordResetRequest,
+    AuthToken,
+    OutboxMessage,
+    SMSMessage,
+    UserPhoneClaim,
+    UserSession,
+    db,
+)
+from .models.user_session import auth_client_user_session
+
+__all__ = ['SweepPolicy', 'Sweeper', 'sweeper']
+
+
+#: Retention policy for a table. ``where(table, cutoff)`` returns the condition
+#: for rows to remove, given the time before which rows are past retention.
+#: ``dependents`` are (table, column) for rows that refer to removed rows and
+#: are removed with them.
+SweepPolicy = namedtuple(
+    'SweepPolicy', ['name', 'table', 'retention', 'where', 'dependents']
+)
+
+
+class Sweeper(object):
+    """
+    Removes rows that are past their retention period, table by table, as set by
+    policies registered with :meth:`policy`. Rows are found by walking the
+    primary key and removed ``SWEEP_BATCH_SIZE`` at a time (default 1000), one
+    short transaction per batch, pausing ``SWEEP_PAUSE`` seconds (default 0.1)
+    between batches so that the sweep does not crowd out other queries.
+
+    The retention period of a policy can be changed in ``SWEEP_RETENTION``, a
+    dictionary of policy name to seconds.
+    """
+
+    def __init__(self):
+        self.policies = OrderedDict()
+        #: Cached data to discard when rows are removed from a table, as
+        #: (session.info key, column) by table
+        self.stale = {}
+
+    def policy(self, name, table, retention, where, dependents=()):
+        """Register a retention policy for a table (or model)"""
+        self.policies[name] = SweepPolicy(
+            name,
+            getattr(table, '__table__', table),
+            retention,
+            where,
+            tuple(dependents),
+        )
+
+    def cached(self, table, key, column):
+        """
+        Record a column of removed rows in ``session.info[key]``, for the listener
+        that discards cached data when the session commits
+        """
+        self.stale[getattr(table, '__table__', table)] = (key, column)
+
+    def retention(self, policy):
+        seconds = current_app.config.get('SWEEP_RETENTION', {}).get(policy.name)
+        return policy.retention if seconds is None else timedelta(seconds=seconds)
+
+    def sweep(self, names=None):
+        """
+        Apply the named policies, or all policies. Returns the number of rows
+        removed by each policy.
+        """
+        return OrderedDict(
+            (name, self.sweep_table(self.policies[name]))
+            for name in (names or self.policies)
+        )
+
+    def sweep_table(self, policy):
+        """Apply a policy, in batches. Returns the number of rows removed."""
+        batch = current_app.config.get('SWEEP_BATCH_SIZE', 1000)
+        pause = current_app.config.get('SWEEP_PAUSE', 0.1)
+        table = policy.table
+        (key,) = table.primary_key.columns
+        where = policy.where(table, utcnow() - self.retention(policy))
+        last_id = None
+        removed = 0
+        while True:
+            query = db.select([key]).where(where).order_by(key).limit(batch)
+            if last_id is not None:
+                query = query.where(key > last_id)
+            ids = [row[0] for row in db.session.execute(query)]
+            if not ids:
+                break
+            for dependent, column in policy.dependents:
+                self._delete(dependent, column.in_(ids))
+            self._delete(table, key.in_(ids))
+            db.session.commit()
+            removed += len(ids)
+            last_id = ids[-1]
+            if len(ids) < batch:
+                break
+            sleep(pause)
+        return removed
+
+    def _delete(self, table, where):
+        statement = table.delete().where(where)
+        if table in self.stale:
+            stale_key, column = self.stale[table]
+            db.session.info.setdefault(stale_key, set()).update(
+                row[0] for row in db.session.execute(statement.returning(column))
+            )
+        else:
+            db.session.execute(statement)
+
+
+#: Sweeper for this app
+sweeper = Sweeper()
+# Bulk deletes skip ORM events, so cached tokens and sessions are discarded here
+sweeper.cached(AuthToken, 'authtoken_stale', AuthToken.__table__.c.token)
+sweeper.cached(UserSession, 'usersession_stale', UserSession.__table__.c.buid)
+
+# Codes are valid for three minutes; see AuthCode.is_valid
+sweeper.policy(
+    'auth_code',
+    AuthCode,
+    timedelta(hours=1),
+    lambda table, cutoff: table.c.created_at < cutoff,
+)
+
+# Reset links are valid for a day; see the reset view
+sweeper.policy(
+    'auth_password_reset_request',
+    AuthPasswordResetRequest,
+    timedelta(days=1),
+    lambda table, cutoff: table.c.created_at < cutoff,
+)
+
+# Claims are valid for an hour, or until there are too many failed attempts
+sweeper.policy(
+    'user_phone_claim',
+    UserPhoneClaim,
+    timedelta(hours=1),
+    lambda table, cutoff: db.or_(
+        table.c.updated_at < cutoff, UserPhoneClaim.verification_expired
+    ),
+)
+
+# Tokens with a limited validity, counted from the time they expired
+sweeper.policy(
+    'auth_token',
+    AuthToken,
+    timedelta(days=1),
+    lambda table, cutoff: db.and_(
+        table.c.validity != 0,
+        table.c.created_at
+        + db.func.make_interval(0, 0, 0, 0, 0, 0, table.c.validity, type_=db.Interval)
+        < cutoff,
+    ),
+)
+
+# Revoked sessions, with their client links, and codes and tokens issued in them
+sweeper.policy(
+    'user_session',
+    UserSession,
+    timedelta(days=30),
+    lambda table, cutoff: table.c.revoked_at < cutoff,
+    dependents=[
+        (auth_client_user_session, auth_client_user_session.c.user_session_id),
+        (AuthCode.__table__, AuthCode.__table__.c.user_session_id),
+        (AuthToken.__table__, AuthToken.__table__.c.user_session_id),
+    ],
+)
+
+sweeper.policy(
+    'sms_message',
+    SMSMessage,
+    timedelta(days=90),
+    lambda table, cutoff: table.c.created_at < cutoff,
+)
+
+# Outbox messages given up after OUTBOX_MAX_ATTEMPTS failures, kept for a while
+# with their last error
+sweeper.policy(
+    'outbox_message',
+    OutboxMessage,
+    timedelta(days=30),
+    lambda table, cutoff: db.and_(
+        table.c.attempts >= current_app.config.get('OUTBOX_MAX_ATTEMPTS', 10),
+        table.c.updated_at < cutoff,
+    ),
+)
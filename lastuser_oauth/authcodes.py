@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import json
+
+from flask import current_app
+
+from coaster.utils import newsecret
+
+from lastuser_core.models import AuthCode, User, UserSession, db
+
+from . import rq
+
+__all__ = [
+    'AuthCodeStore',
+    'RedisAuthCode',
+    'RedisAuthCodeStore',
+    'auth_code_store',
+    'auth_code_stores',
+]
+
+
+class AuthCodeStore(object):
+    """
+    Stores authorization codes as :class:`AuthCode` rows. Codes are issued by
+    :meth:`issue` and taken by :meth:`consume`, and the caller commits the
+    database session in both cases.
+    """
+
+    def issue(self, user, user_session, auth_client, scope, redirect_uri):
+        """Make an auth code for a client and return the code"""
+        authcode = AuthCode(
+            user=user,
+            user_session=user_session,
+            auth_client=auth_client,
+            scope=scope,
+            redirect_uri=redirect_uri[:1024],
+        )
+        authcode.code = newsecret()
+        db.session.add(authcode)
+        return authcode.code
+
+    def consume(self, auth_client, code):
+        """
+        Take an auth code for a client, so that it cannot be used again. Returns an
+        object with ``user``, ``user_session``, ``scope``, ``redirect_uri`` and
+        ``is_valid()``, or None if the code is unknown.
+        """
+        authcode = AuthCode.get_for_client(auth_client=auth_client, code=code)
+        if authcode is not None:
+            db.session.delete(authcode)
+        return authcode
+
+
+class RedisAuthCode(object):
+    """An auth code held in Redis"""
+
+    def __init__(self, user_id, user_session_id, scope, redirect_uri):
+        self.user_id = user_id
+        self.user_session_id = user_session_id
+        self.scope = tuple(sorted(scope))
+        self.redirect_uri = redirect_uri
+
+    @property
+    def user(self):
+        return User.query.get(self.user_id)
+
+    @property
+    def user_session(self):
+        if self.user_session_id is not None:
+            return UserSession.query.get(self.user_session_id)
+
+    def is_valid(self):
+        # Redis removes codes when they expire
+        return True
+
+
+class RedisAuthCodeStore(AuthCodeStore):
+    """
+    Stores authorization codes in Redis with a native expiry, instead of
+    inserting and deleting a database row for every login. A code is read and
+    removed in one MULTI/EXEC transaction, so it can only be used once even if
+    presented twice at the same time. Codes that are not in Redis are looked up
+    in the database, for codes issued before the switch to this store.
+    """
+
+    key = 'lastuser/authcode/'
+    #: Same as AuthCode.is_valid
+    validity = timedelta(minutes=3)
+
+    def _key(self, auth_client, code):
+        return '{prefix}{auth_client_id}/{code}'.format(
+            prefix=self.key, auth_client_id=auth_client.id, code=code
+        )
+
+    def issue(self, user, user_session, auth_client, scope, redirect_uri):
+        code = newsecret()
+        rq.connection.set(
+            self._key(auth_client, code),
+            json.dumps(
+                {
+                    'user_id': user.id,
+                    'user_session_id': user_session.id if user_session else None,
+                    'scope': list(scope),
+                    'redirect_uri': redirect_uri[:1024],
+                }
+            ),
+            ex=self.validity,
+        )
+        return code
+
+    def consume(self, auth_client, code):
+        pipe = rq.connection.pipeline()
+        key = self._key(auth_client, code)
+        pipe.get(key)
+        pipe.delete(key)
+        data = pipe.execute()[0]
+        if data is None:
+            return super(RedisAuthCodeStore, self).consume(auth_client, code)
+        return RedisAuthCode(**json.loads(data.decode('utf-8')))
+
+
+#: Auth code stores by name, for ``AUTH_CODE_BACKEND``
+auth_code_stores = {'sql': AuthCodeStore(), 'redis': RedisAuthCodeStore()}
+
+
+def auth_code_store():
+    """Return the auth code store selected by ``AUTH_CODE_BACKEND`` (default sql)"""
+    return auth_code_stores[current_app.config.get('AUTH_CODE_BACKEND', 'sql')]
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from threading import Lock
+
+from sqlalchemy import event as sqla_event
+from sqlalchemy.orm.attributes import get_history
+
+from flask import current_app, has_app_context
+
+from redis import RedisError
+
+from coaster.utils import buid, utcnow
+from lastuser_core.models import USER_STATUS, User, db
+
+from . import rq
+
+__all__ = ['ActivityBitmaps', 'activity_bitmaps']
+
+
+class ActivityBitmaps(object):
+    """
+    Daily bitmaps of active users in Redis, with the bit at each user's id set
+    when the user's session is used that day (UTC). Distinct active users over
+    any set of days are counted by OR-ing the days' bitmaps, and users retained
+    from one period to the next by AND-ing the periods' bitmaps, in Redis.
+
+    Bitmaps are kept for ``ACTIVITY_BITMAP_DAYS`` days (default 400). Each
+    process remembers who it has marked today and skips them, so most requests
+    do not reach Redis. When an account is merged or suspended, its bits are
+    cleared from all days after commit, so that the bitmaps only count users
+    whose accounts are active, like the database rollups.
+    """
+
+    key = 'lastuser/activity/'
+    #: Users remembered per process before the memory is reset
+    memory_size = 100000
+
+    def __init__(self):
+        self._lock = Lock()
+        self._day = None
+        self._marked = set()
+
+    def day_key(self, day):
+        return self.key + day.isoformat()
+
+    def _expiry(self):
+        return timedelta(days=current_app.config.get('ACTIVITY_BITMAP_DAYS', 400))
+
+    def mark(self, user_id):
+        """
+        Mark a user as active today. Returns True if Redis was updated. Redis
+        errors are logged and do not fail the request.
+        """
+        day = utcnow().date()
+        with self._lock:
+            if day != self._day or len(self._marked) >= self.memory_size:
+                self._day = day
+                self._marked = set()
+            if user_id in self._marked:
+                return False
+            self._marked.add(user_id)
+        key = self.day_key(day)
+        try:
+            pipe = rq.connection.pipeline()
+            pipe.setbit(key, user_id, 1)
+            pipe.expire(key, self._expiry())
+            pipe.execute()
+        except RedisError:
+            with self._lock:
+                self._marked.discard(user_id)
+            current_app.logger.warning("Could not mark user activity", exc_info=True)
+            return False
+        return True
+
+    def backfill(self, day, user_ids):
+        """Mark users as active on a past day"""
+        key = self.day_key(day)
+        pipe = rq.connection.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.setbit(key, user_id, 1)
+        pipe.expire(key, self._expiry())
+        pipe.execute()
+
+    def clear(self, user_ids, end=None):
+        """Unmark users on all the days that are kept, ending on ``end``"""
+        end = end or utcnow().date()
+        keys = self._days(end, current_app.config.get('ACTIVITY_BITMAP_DAYS', 400))
+        pipe = rq.connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        # SETBIT would create missing days without an expiry
+        keys = [key for key, exists in zip(keys, pipe.execute()) if exists]
+        for key in keys:
+            for user_id in user_ids:
+                pipe.setbit(key, user_id, 0)
+        pipe.execute()
+
+    def _days(self, end, days):
+        return [self.day_key(end - timedelta(days=offset)) for offset in range(days)]
+
+    def active_users(self, days=1, end=None):
+        """
+        Number of distinct users active in the ``days`` days ending on ``end``
+        (default today): 1 for daily, 7 for weekly and 30 for monthly users
+        """
+        end = end or utcnow().date()
+        dest = self.key + 'tmp/' + buid()
+        pipe = rq.connection.pipeline()
+        pipe.bitop('OR', dest, *self._days(end, days))
+        pipe.bitcount(dest)
+        pipe.delete(dest)
+        return pipe.execute()[1]
+
+    def retention(self, weeks=8, end=None):
+        """
+        Week over week retention for the last ``weeks`` weeks ending on ``end``
+        (default today). Returns a list of dicts, oldest first, with the first
+        day of each week, the users active that week, and how many of them were
+        active in the following week. The current week has no following week and
+        is not listed.
+        """
+        end = end or utcnow().date()
+        prefix = self.key + 'tmp/' + buid() + '/'
+        # Week 0 is the current week and week `weeks` is the oldest
+        active_keys = [
+            prefix + 'active/{week}'.format(week=week) for week in range(weeks + 1)
+        ]
+        retained_keys = [
+            prefix + 'retained/{week}'.format(week=week) for week in range(1, weeks + 1)
+        ]
+        pipe = rq.connection.pipeline()
+        for week in range(weeks + 1):
+            pipe.bitop(
+                'OR', active_keys[week], *self._days(end - timedelta(weeks=week), 7)
+            )
+        for week in range(1, weeks + 1):
+            pipe.bitcount(active_keys[week])
+            pipe.bitop(
+                'AND', retained_keys[week - 1], active_keys[week], active_keys[week - 1]
+            )
+            pipe.bitcount(retained_keys[week - 1])
+        pipe.delete(*(active_keys + retained_keys))
+        results = pipe.execute()[weeks + 1 : -1]
+        cohorts = []
+        for week in range(1, weeks + 1):
+            active, _bitop, retained = results[(week - 1) * 3 : week * 3]
+            cohorts.append(
+                {
+                    'week': end - timedelta(weeks=week, days=6),
+                    'active': active,
+                    'retained': retained,
+                }
+            )
+        cohorts.reverse()
+        return cohorts
+
+
+#: Activity bitmaps for this app
+activity_bitmaps = ActivityBitmaps()
+
+
+@sqla_event.listens_for(User, 'after_update')
+def _user_status_updated(mapper, connection, target):
+    if (
+        target.status != USER_STATUS.ACTIVE
+        and get_history(target, 'status').has_changes()
+    ):
+        db.session.info.setdefault('activity_stale', set()).add(target.id)
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _activity_session_committed(session):
+    user_ids = session.info.pop('activity_stale', None)
+    if user_ids and has_app_context():
+        try:
+            activity_bitmaps.clear(user_ids)
+        except RedisError:
+            current_app.logger.warning(
+                "Could not clear activity of inactive users", exc_info=True
+            )
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _activity_session_rolledback(session):
+    session.info.pop('activity_stale', None)
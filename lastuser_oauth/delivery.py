@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from random import uniform
+from threading import Lock
+from urllib.parse import urlparse
+from uuid import uuid4
+import time
+
+from flask import current_app
+
+from requests.adapters import HTTPAdapter
+import requests
+
+from coaster.utils import utcnow
+
+from . import rq
+
+__all__ = ['NoticeDelivery', 'notice_delivery']
+
+
+class NoticeDelivery(object):
+    """
+    Delivers notices to client apps' notification URIs, for the ``send_notice``
+    job.
+
+    Each worker process keeps one :class:`requests.Session` per host, so that
+    connections are reused across notices to the same host (this needs a worker
+    that does not fork per job, such as ``rq.worker.SimpleWorker``). Requests
+    time out after ``NOTICE_CONNECT_TIMEOUT`` and ``NOTICE_READ_TIMEOUT``
+    seconds, and no more than ``NOTICE_HOST_CONCURRENCY`` requests to a host are
+    in flight across all workers.
+
+    Outcomes are counted per host in Redis (see :meth:`stats`). Deliveries are
+    counted once each, by the ``send_notice`` job, with their final outcome:
+
+    * ``sent``: the client accepted the notice (2xx or 3xx)
+    * ``failed``: the client rejected the notice (other 4xx), or retries ran out
+
+    Attempts that will be tried again are counted separately, by :meth:`send`:
+
+    * ``retry``: timeout, connection error, 5xx, 408 or 429; try again later
+    * ``deferred``: the host was at its concurrency limit; try again shortly
+    """
+
+    stats_key = 'lastuser/notice/stats/'
+    slots_key = 'lastuser/notice/slots/'
+    #: Status codes that are worth retrying, besides 5xx
+    retry_statuses = frozenset([408, 429])
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sessions = {}
+
+    @staticmethod
+    def host(url):
+        return urlparse(url).netloc.lower()
+
+    def session(self, host):
+        """Return the session for a host, creating it if required"""
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=current_app.config.get('NOTICE_HOST_CONCURRENCY', 4),
+                    max_retries=0,
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def _timeout(self):
+        return (
+            current_app.config.get('NOTICE_CONNECT_TIMEOUT', 3.05),
+            current_app.config.get('NOTICE_READ_TIMEOUT', 10),
+        )
+
+    def acquire(self, host):
+        """
+        Take one of the host's concurrency slots, if available, and return a
+        holder id for :meth:`release`, or `None` if the host is busy.
+
+        Slots are kept in a sorted set, scored by the time they expire. A worker
+        killed mid-request never releases its slot, so expired slots are dropped
+        before counting.
+        """
+        key = self.slots_key + host
+        holder = uuid4().hex
+        now = time.time()
+        timeout = int(sum(self._timeout())) * 2 + 1
+        pipe = rq.connection.pipeline()
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.zadd(key, {holder: now + timeout})
+        pipe.zcard(key)
+        pipe.expire(key, timeout)
+        count = pipe.execute()[2]
+        if count > current_app.config.get('NOTICE_HOST_CONCURRENCY', 4):
+            rq.connection.zrem(key, holder)
+            return None
+        return holder
+
+    def release(self, host, holder):
+        rq.connection.zrem(self.slots_key + host, holder)
+
+    def record(self, host, outcome):
+        """Count the final outcome of a delivery, ``sent`` or ``failed``"""
+        rq.connection.hincrby(self.stats_key + host, outcome, 1)
+
+    def attempted(self, host, outcome, status_code=None, error=None):
+        """Note the response to an attempt, and count it if it will be retried"""
+        key = self.stats_key + host
+        pipe = rq.connection.pipeline()
+        if outcome == 'retry':
+            pipe.hincrby(key, outcome, 1)
+        pipe.hset(key, 'last_at', utcnow().isoformat())
+        pipe.hset(key, 'last_outcome', outcome)
+        pipe.hset(key, 'last_status', status_code or '')
+        pipe.hset(key, 'last_error', error or '')
+        pipe.execute()
+
+    def stats(self, host):
+        """Return delivery counts and the last response for a host"""
+        return {
+            key.decode('utf-8'): value.decode('utf-8')
+            for key, value in rq.connection.hgetall(self.stats_key + host).items()
+        }
+
+    def send(
+        self,
+        url,
+        params=None,
+        data=None,
+        method='POST',
+        json=None,
+        can_defer=True,
+        final=False,
+    ):
+        """
+        Attempt delivery once and return the outcome. If the host is busy, the
+        outcome is ``deferred``, or ``retry`` if ``can_defer`` is false. If this is
+        the ``final`` attempt, ``retry`` is returned as ``failed``. Retries and
+        deferrals are counted here, and the caller counts the delivery with
+        :meth:`record` once it is ``sent`` or ``failed``.
+        """
+        host = self.host(url)
+        holder = self.acquire(host)
+        if holder is None and can_defer:
+            rq.connection.hincrby(self.stats_key + host, 'deferred', 1)
+            return 'deferred'
+        status_code = error = None
+        if holder is None:
+            error = "Host is at its concurrency limit"
+        else:
+            try:
+                response = self.session(host).request(
+                    method,
+                    url,
+                    params=params,
+                    data=data,
+                    json=json,
+                    timeout=self._timeout(),
+                )
+                # Return the connection to the pool for the next notice to this host
+                response.close()
+                status_code = response.status_code
+            except requests.RequestException as e:
+                error = '{name}: {message}'.format(name=type(e).__name__, message=e)
+                error = error[:250]
+            finally:
+                self.release(host, holder)
+
+        if status_code is None or (
+            status_code >= 500 or status_code in self.retry_statuses
+        ):
+            outcome = 'failed' if final else 'retry'
+        elif status_code >= 400:
+            outcome = 'failed'
+        else:
+            outcome = 'sent'
+        self.attempted(host, outcome, status_code, error)
+        return outcome
+
+    def retry_delay(self, attempt):
+        """Exponential backoff with jitter, for the given retry attempt (from 1)"""
+        delay = min(
+            current_app.config.get('NOTICE_RETRY_DELAY', 30) * 2 ** (attempt - 1),
+            current_app.config.get('NOTICE_RETRY_MAX_DELAY', 3600),
+        )
+        return timedelta(seconds=uniform(delay / 2, delay))
+
+    def defer_delay(self):
+        """Delay before trying a host that was at its concurrency limit"""
+        return timedelta(seconds=uniform(1, 5))
+
+
+#: Delivery engine for this process
+notice_delivery = NoticeDelivery()
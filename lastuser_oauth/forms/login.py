@@ -4,6 +4,7 @@ from flask import Markup, escape, url_for
 
 from baseframe import _, __
 from lastuser_core.models import UserEmail, getuser
+from lastuser_core.passwords import password_checker
 import baseframe.forms as forms
 
 
@@ -21,22 +22,25 @@ class LoginForm(forms.Form):
         __("Password"), validators=[forms.validators.DataRequired()]
     )
 
+    #: The user, resolved once when validating the username
+    user = None
+
     def validate_username(self, field):
-        existing = getuser(field.data)
-        if existing is None:
+        self.user = getuser(field.data)
+        if self.user is None:
             raise forms.ValidationError(_("User does not exist"))
 
     def validate_password(self, field):
-        if not self.username.data:
-            # Can't validate password without a user
+        user = self.user
+        if user is None:
+            # Can't validate password without a user. The username field has
+            # the error
             return
-        user = getuser(self.username.data)
-        if user and not user.pw_hash:
+        if not user.pw_hash:
             raise LoginPasswordResetException()
-        if user is None or not user.password_is(field.data):
-            if not self.username.errors:
-                raise forms.ValidationError(_("Incorrect password"))
-        self.user = user
+        # Raises PasswordCheckBusy if too many logins are in progress
+        if not password_checker.check(user, field.data):
+            raise forms.ValidationError(_("Incorrect password"))
 
 
 class RegisterForm(forms.RecaptchaForm):
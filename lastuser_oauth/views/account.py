@@ -1,5 +1,15 @@
 # -*- coding: utf-8 -*-
-from flask import abort, flash, redirect, render_template, request, session, url_for
+from flask import (
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 
 from baseframe import _
 from baseframe.signals import exception_catchall
@@ -8,18 +18,18 @@ from coaster.utils import valid_username
 from coaster.views import get_next_url
 from lastuser_core import login_registry
 from lastuser_core.models import (
+    MERGE_STATUS,
     User,
     UserEmail,
     UserEmailClaim,
     UserExternalId,
+    UserMerge,
     db,
     getextid,
-    merge_users,
 )
 from lastuser_core.registry import LoginCallbackError, LoginInitError
-from lastuser_core.signals import user_data_changed
 
-from .. import lastuser_oauth
+from .. import lastuser_oauth, rq
 from ..forms.profile import ProfileMergeForm
 from ..mailclient import send_email_verify_link
 from ..views.helpers import (
@@ -237,13 +247,25 @@ def account_merge():
     form = ProfileMergeForm()
     if form.validate_on_submit():
         if 'merge' in request.form:
-            new_user = merge_users(current_auth.user, other_user)
-            login_internal(new_user)
-            flash(_("Your accounts have been merged"), 'success')
-            session.pop('merge_buid', None)
+            # Resumes an earlier merge of these accounts that did not complete.
+            # merge_buid stays in the session until the merge completes, so that
+            # a failed merge can be tried again
+            user_merge = UserMerge.start(current_auth.user, other_user)
+            # A pending or running merge already has a worker, unless it stalled
+            queue = user_merge.needs_worker(
+                current_app.config.get('USER_MERGE_STALL_TIMEOUT', 600)
+            )
             db.session.commit()
-            user_data_changed.send(new_user, changes=['merge'])
-            return redirect(get_next_url(), code=303)
+            if queue:
+                run_user_merge.queue(user_merge.id)
+            return redirect(
+                url_for(
+                    '.account_merge_progress',
+                    buid=user_merge.buid,
+                    next=get_next_url(),
+                ),
+                code=303,
+            )
         else:
             session.pop('merge_buid', None)
             return redirect(get_next_url(), code=303)
@@ -254,3 +276,63 @@ def account_merge():
         other_user=other_user,
         login_registry=login_registry,
     )
+
+
+def get_user_merge(buid):
+    user_merge = UserMerge.get(buid)
+    # Sessions move to keep_user during the merge, so the current user may be
+    # either account
+    if user_merge is None or current_auth.user not in (
+        user_merge.keep_user,
+        user_merge.merge_user,
+    ):
+        abort(404)
+    return user_merge
+
+
+@lastuser_oauth.route('/account/merge/<buid>')
+@requires_login
+def account_merge_progress(buid):
+    user_merge = get_user_merge(buid)
+    if user_merge.is_complete:
+        session.pop('merge_buid', None)
+        flash(_("Your accounts have been merged"), 'success')
+        return redirect(get_next_url(), code=303)
+    return render_template(
+        'merge.html.jinja2',
+        user_merge=user_merge,
+        MERGE_STATUS=MERGE_STATUS,
+        user=user_merge.keep_user,
+        other_user=user_merge.merge_user,
+        login_registry=login_registry,
+    )
+
+
+@lastuser_oauth.route('/account/merge/<buid>/status')
+@requires_login
+def account_merge_status(buid):
+    user_merge = get_user_merge(buid)
+    return jsonify(
+        status=MERGE_STATUS[user_merge.status].name,
+        progress=round(user_merge.progress, 2),
+        rows_moved=user_merge.rows_moved,
+    )
+
+
+@rq.job('lastuser', timeout=3600)
+def run_user_merge(user_merge_id):
+    """
+    Merge two accounts in chunks of ``USER_MERGE_CHUNK_SIZE`` rows (default 1000),
+    so that no transaction holds locks on many of the accounts' rows. Queue the
+    job again to resume a merge that failed.
+    """
+    user_merge = UserMerge.query.get(user_merge_id)
+    if user_merge is None:
+        return
+    try:
+        user_merge.run(limit=current_app.config.get('USER_MERGE_CHUNK_SIZE', 1000))
+    except Exception as e:
+        db.session.rollback()
+        user_merge.fail('{name}: {message}'.format(name=type(e).__name__, message=e))
+        db.session.commit()
+        raise
@@ -14,10 +14,13 @@ from coaster.auth import add_auth_attribute, current_auth, request_has_auth
 from coaster.sqlalchemy import failsafe_add
 from coaster.utils import utcnow
 from coaster.views import get_current_url
-from lastuser_core.models import AuthClientCredential, User, UserSession, db
+from lastuser_core.activity import activity_tracker
+from lastuser_core.models import User, UserSession, db
+from lastuser_core.registry import client_registry
 from lastuser_core.signals import user_login, user_registered
 
 from .. import lastuser_oauth
+from ..bitmaps import activity_bitmaps
 
 valid_timezones = set(common_timezones)
 
@@ -56,9 +59,9 @@ class LoginManager(object):
                 'session', UserSession.authenticate(buid=lastuser_cookie['sessionid'])
             )
             if current_auth.session:
-                current_auth.session.access()
-                db.session.commit()  # Save access
+                activity_tracker.session_accessed(current_auth.session)  # Save access
                 add_auth_attribute('user', current_auth.session.user)
+                activity_bitmaps.mark(current_auth.user.id)
 
         # Transition users with 'userid' to 'sessionid'
         if not current_auth.session and 'userid' in lastuser_cookie:
@@ -122,6 +125,17 @@ def lastuser_cookie(response):
     return response
 
 
+@lastuser_oauth.after_app_request
+def save_activity(response):
+    """
+    Save buffered session and client activity timestamps, if they are not saved
+    in the background (``ACTIVITY_FLUSH_INTERVAL`` is 0).
+    """
+    if not current_app.config.get('ACTIVITY_FLUSH_INTERVAL', 10):
+        activity_tracker.flush_safely()
+    return response
+
+
 @lastuser_oauth.after_app_request
 def cache_expiry_headers(response):
     if 'Expires' not in response.headers:
@@ -182,7 +196,7 @@ def _client_login_inner():
             401,
             {'WWW-Authenticate': 'Basic realm="Client credentials"'},
         )
-    credential = AuthClientCredential.get(name=request.authorization.username)
+    credential = client_registry.get_credential(request.authorization.username)
     if credential is None or not credential.secret_is(request.authorization.password):
         return Response(
             'Invalid client credentials',
@@ -190,8 +204,7 @@ def _client_login_inner():
             {'WWW-Authenticate': 'Basic realm="Client credentials"'},
         )
     if credential:
-        credential.accessed_at = db.func.utcnow()
-        db.session.commit()
+        activity_tracker.credential_accessed(credential)
     add_auth_attribute('auth_client', credential.auth_client, actor=True)
 
 
@@ -253,7 +266,7 @@ def requires_client_id_or_user_or_client_login(f):
             and 'session' in request.values
             and request.referrer
         ):
-            client_cred = AuthClientCredential.get(request.values['client_id'])
+            client_cred = client_registry.get_credential(request.values['client_id'])
             if client_cred is not None and get_scheme_netloc(
                 client_cred.auth_client.website
             ) == get_scheme_netloc(request.referrer):
@@ -25,13 +25,14 @@ from coaster.utils import getbool, utcnow
 from coaster.views import get_next_url, load_model
 from lastuser_core import login_registry
 from lastuser_core.models import (
-    AuthClientCredential,
     AuthPasswordResetRequest,
     User,
     UserEmailClaim,
     UserSession,
     db,
 )
+from lastuser_core.passwords import PasswordCheckBusy
+from lastuser_core.registry import client_registry
 from lastuser_core.utils import mask_email
 
 from .. import lastuser_oauth
@@ -79,6 +80,8 @@ def login():
     if request.method == 'GET':
         loginmethod = request.cookies.get('login')
 
+    status_code = 200
+    headers = {'X-Frame-Options': 'SAMEORIGIN'}
     formid = request.form.get('form.id')
     if request.method == 'POST' and formid == 'passwordlogin':
         try:
@@ -99,20 +102,28 @@ def login():
                 category='danger',
             )
             return render_redirect(url_for('.reset', username=loginform.username.data))
+        except PasswordCheckBusy as e:
+            flash(
+                _(
+                    "We are receiving too many logins right now. Please try again shortly"
+                ),
+                category='danger',
+            )
+            status_code = 503
+            headers['Retry-After'] = str(e.retry_after)
     elif request.method == 'POST' and formid in service_forms:
         form = service_forms[formid]['form']
         if form.validate():
             return set_loginmethod_cookie(login_registry[formid].do(form=form), formid)
     elif request.method == 'POST':
         abort(500)
-    iframe_block = {'X-Frame-Options': 'SAMEORIGIN'}
     if request_is_xhr() and formid == 'passwordlogin':
         return (
             render_template(
                 'loginform.html.jinja2', loginform=loginform, Markup=Markup
             ),
-            200,
-            iframe_block,
+            status_code,
+            headers,
         )
     else:
         return (
@@ -124,8 +135,8 @@ def login():
                 Markup=Markup,
                 login_registry=login_registry,
             ),
-            200,
-            iframe_block,
+            status_code,
+            headers,
         )
 
 
@@ -160,7 +171,7 @@ def logout_client():
     """
     Client-initiated logout
     """
-    cred = AuthClientCredential.get(request.args['client_id'])
+    cred = client_registry.get_credential(request.args['client_id'])
     auth_client = cred.auth_client if cred else None
 
     if (
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
-import requests
+from datetime import timedelta
+import json
+
+from flask import current_app
 
 from lastuser_core.models import AuthToken
+from lastuser_core.outbox import outbox
 from lastuser_core.signals import (
     org_data_changed,
     session_revoked,
@@ -11,6 +15,8 @@ from lastuser_core.signals import (
 )
 from lastuser_oauth import rq
 
+from ..delivery import notice_delivery
+
 user_changes_to_notify = {
     'merge',
     'profile',
@@ -24,14 +30,20 @@ user_changes_to_notify = {
     'team-membership',
 }
 
+# Scopes that grant access to the data affected by each category of change
+email_scopes = frozenset(['email', 'email/*'])
+phone_scopes = frozenset(['phone', 'phone/*'])
+team_scopes = frozenset(['organizations', 'organizations/*', 'teams', 'teams/*'])
+org_scopes = frozenset(['*', 'organizations', 'organizations/*'])
+
 
 @session_revoked.connect
 def notify_session_revoked(session):
     for auth_client in session.auth_clients:
         if auth_client.notification_uri:
-            send_notice.queue(
-                auth_client.notification_uri,
-                data={
+            queue_client_notice(
+                auth_client,
+                {
                     'userid': session.user.buid,  # XXX: Deprecated parameter
                     'buid': session.user.buid,
                     'type': 'user',
@@ -52,7 +64,7 @@ def notify_user_data_changed(user, changes):
         # We have changes that apps need to hear about
         for token in user.authtokens:
             if token.is_valid() and token.auth_client.notification_uri:
-                tokenscope = token.effective_scope
+                tokenscope = token.compiled_effective_scope
                 notify_changes = []
                 for change in changes:
                     if change in ['merge', 'profile']:
@@ -63,7 +75,7 @@ def notify_user_data_changed(user, changes):
                         'email-delete',
                         'email-update-primary',
                     ]:
-                        if {'email', 'email/*'}.intersection(tokenscope):
+                        if not tokenscope.isdisjoint(email_scopes):
                             notify_changes.append(change)
                     elif change in [
                         'phone',
@@ -71,26 +83,165 @@ def notify_user_data_changed(user, changes):
                         'phone-delete',
                         'phone-update-primary',
                     ]:
-                        if {'phone', 'phone/*'}.intersection(tokenscope):
+                        if not tokenscope.isdisjoint(phone_scopes):
                             notify_changes.append(change)
                     elif change in ['team-membership']:
-                        if {
-                            'organizations',
-                            'organizations/*',
-                            'teams',
-                            'teams/*',
-                        }.intersection(tokenscope):
+                        if not tokenscope.isdisjoint(team_scopes):
                             notify_changes.append(change)
                 if notify_changes:
-                    send_notice.queue(
-                        token.auth_client.notification_uri,
-                        data={
-                            'userid': user.buid,  # XXX: Deprecated parameter
-                            'buid': user.buid,
-                            'type': 'user',
-                            'changes': notify_changes,
-                        },
-                    )
+                    queue_user_notice(token.auth_client, user, notify_changes)
+
+
+def user_notice_data(buid, changes):
+    return {
+        'userid': buid,  # XXX: Deprecated parameter
+        'buid': buid,
+        'type': 'user',
+        'changes': changes,
+    }
+
+
+# Changes to a user are collected per client in a Redis set, and sent together by
+# a job scheduled when the first change arrives. The window key marks a pending
+# job. The job removes the window key before taking the changes, so a change
+# that arrives while it runs is either taken by it or schedules another job.
+notice_pending_key = 'lastuser/notice/pending/{auth_client_id}/{buid}'
+notice_window_key = 'lastuser/notice/window/{auth_client_id}/{buid}'
+
+
+def queue_user_notice(auth_client, user, changes):
+    """Notify a client of changes to a user, once the transaction commits"""
+    outbox.add(
+        'user_notice',
+        ordering_key=user.buid,
+        url=auth_client.notification_uri,
+        auth_client_id=auth_client.id,
+        batch=auth_client.notification_batch,
+        buid=user.buid,
+        changes=changes,
+    )
+
+
+@outbox.handler('user_notice')
+def coalesce_user_notice(url, auth_client_id, batch, buid, changes):
+    """
+    Notify a client of changes to a user, merged with other changes to the user
+    in the next ``NOTICE_COALESCE_WINDOW`` seconds (default 5; 0 to send now)
+    """
+    window = current_app.config.get('NOTICE_COALESCE_WINDOW', 5)
+    if not window:
+        queue_notice(
+            url, auth_client_id if batch else None, user_notice_data(buid, changes)
+        )
+        return
+    keys = {'auth_client_id': auth_client_id, 'buid': buid}
+    pending_key = notice_pending_key.format(**keys)
+    # Expire keys if the scheduler fails to run the job
+    expiry = window * 10 + 60
+    pipe = rq.connection.pipeline()
+    pipe.sadd(pending_key, *changes)
+    pipe.expire(pending_key, expiry)
+    pipe.set(notice_window_key.format(**keys), 1, nx=True, ex=expiry)
+    if pipe.execute()[-1]:
+        send_user_notice.schedule(
+            timedelta(seconds=window), url, auth_client_id, buid, batch=batch
+        )
+
+
+@rq.job('lastuser')
+def send_user_notice(url, auth_client_id, buid, batch=False):
+    """Send the changes collected for a user to a client"""
+    keys = {'auth_client_id': auth_client_id, 'buid': buid}
+    pending_key = notice_pending_key.format(**keys)
+    rq.connection.delete(notice_window_key.format(**keys))
+    pipe = rq.connection.pipeline()
+    pipe.smembers(pending_key)
+    pipe.delete(pending_key)
+    changes = pipe.execute()[0]
+    if changes:
+        queue_notice(
+            url,
+            auth_client_id if batch else None,
+            user_notice_data(
+                buid, sorted(change.decode('utf-8') for change in changes)
+            ),
+        )
+
+
+# Notices for clients that accept batches are appended to a Redis list, and sent
+# by a job scheduled when the first notice arrives or queued when the list has
+# a full batch
+notice_batch_key = 'lastuser/notice/batch/{auth_client_id}'
+notice_batch_window_key = 'lastuser/notice/batchwindow/{auth_client_id}'
+
+
+def queue_client_notice(auth_client, data):
+    """
+    Send a notice to a client once the transaction commits, in a batch if the
+    client accepts batches
+    """
+    outbox.add(
+        'notice',
+        ordering_key=data['buid'],
+        url=auth_client.notification_uri,
+        batch_auth_client_id=(
+            auth_client.id if auth_client.notification_batch else None
+        ),
+        data=data,
+    )
+
+
+@outbox.handler('notice')
+def queue_notice(url, batch_auth_client_id, data):
+    """
+    Send a notice to the URL, or add it to the batch for the given client.
+    Batches are sent when they have ``NOTICE_BATCH_SIZE`` notices (default 100),
+    or ``NOTICE_BATCH_INTERVAL`` seconds (default 10) after their first notice.
+    """
+    if batch_auth_client_id is None:
+        send_notice.queue(url, data=data)
+        return
+    length = rq.connection.rpush(
+        notice_batch_key.format(auth_client_id=batch_auth_client_id), json.dumps(data)
+    )
+    schedule_notice_batch(url, batch_auth_client_id, length)
+
+
+def schedule_notice_batch(url, auth_client_id, length):
+    """Arrange for a batch with the given number of pending notices to be sent"""
+    size = current_app.config.get('NOTICE_BATCH_SIZE', 100)
+    interval = current_app.config.get('NOTICE_BATCH_INTERVAL', 10)
+    if length and length % size == 0:
+        send_notice_batch.queue(url, auth_client_id)
+    elif length and rq.connection.set(
+        notice_batch_window_key.format(auth_client_id=auth_client_id),
+        1,
+        nx=True,
+        ex=interval * 10 + 60,
+    ):
+        send_notice_batch.schedule(timedelta(seconds=interval), url, auth_client_id)
+
+
+@rq.job('lastuser')
+def send_notice_batch(url, auth_client_id):
+    """Send up to a batch of pending notices as a JSON array"""
+    key = notice_batch_key.format(auth_client_id=auth_client_id)
+    size = current_app.config.get('NOTICE_BATCH_SIZE', 100)
+    rq.connection.delete(notice_batch_window_key.format(auth_client_id=auth_client_id))
+    pipe = rq.connection.pipeline()
+    pipe.lrange(key, 0, size - 1)
+    pipe.ltrim(key, size, -1)
+    pipe.llen(key)
+    notices, trimmed, remaining = pipe.execute()
+    if notices:
+        send_notice.queue(url, json=[json.loads(notice) for notice in notices])
+    if remaining:
+        # More notices arrived after this batch filled up. Send them right away if
+        # they make a full batch, or after the interval
+        if remaining >= size:
+            send_notice_batch.queue(url, auth_client_id)
+        else:
+            schedule_notice_batch(url, auth_client_id, remaining)
 
 
 @org_data_changed.connect
@@ -102,9 +253,7 @@ def notify_org_data_changed(org, user, changes, team=None):
     client_users = {}
     for token in AuthToken.all(users=org.owners.users):
         if (
-            {'*', 'organizations', 'organizations/*'}.intersection(
-                token.effective_scope
-            )
+            not token.compiled_effective_scope.isdisjoint(org_scopes)
             and token.auth_client.notification_uri
             and token.is_valid()
         ):
@@ -115,9 +264,9 @@ def notify_org_data_changed(org, user, changes, team=None):
             notify_user = user
         else:
             notify_user = users[0]  # First user available
-        send_notice.queue(
-            auth_client.notification_uri,
-            data={
+        queue_client_notice(
+            auth_client,
+            {
                 'userid': notify_user.buid,  # XXX: Deprecated parameter
                 'buid': notify_user.buid,
                 'type': 'org' if team is None else 'team',
@@ -138,6 +287,44 @@ def notify_team_data_changed(team, user, changes):
     )
 
 
-@rq.job('lastuser')
-def send_notice(url, params=None, data=None, method='POST'):
-    requests.request(method, url, params=params, data=data)
+@rq.job('lastuser', timeout=60)
+def send_notice(
+    url, params=None, data=None, method='POST', attempt=0, json=None, deferrals=0
+):
+    """
+    Deliver a notice, retrying with exponential backoff up to
+    ``NOTICE_MAX_ATTEMPTS`` times (default 6) if the client is unavailable.
+    Batches of notices are sent as a JSON array in ``json``. If the client's host
+    is busy, delivery is deferred without counting an attempt, up to
+    ``NOTICE_MAX_DEFERRALS`` times (default 60), after which a busy host counts
+    as an attempt.
+    """
+    outcome = notice_delivery.send(
+        url,
+        params=params,
+        data=data,
+        method=method,
+        json=json,
+        can_defer=deferrals < current_app.config.get('NOTICE_MAX_DEFERRALS', 60),
+        final=attempt + 1 >= current_app.config.get('NOTICE_MAX_ATTEMPTS', 6),
+    )
+    if outcome == 'deferred':
+        deferrals += 1
+        delay = notice_delivery.defer_delay()
+    elif outcome == 'retry':
+        attempt += 1
+        delay = notice_delivery.retry_delay(attempt)
+    else:
+        notice_delivery.record(notice_delivery.host(url), outcome)
+        return outcome
+    send_notice.schedule(
+        delay,
+        url,
+        params=params,
+        data=data,
+        method=method,
+        attempt=attempt,
+        json=json,
+        deferrals=deferrals,
+    )
+    return outcome
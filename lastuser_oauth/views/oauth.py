@@ -5,20 +5,14 @@ from flask import get_flashed_messages, jsonify, redirect, render_template, requ
 from baseframe import _
 from coaster.auth import current_auth
 from coaster.sqlalchemy import failsafe_add
-from coaster.utils import newsecret
 from lastuser_core import resource_registry
-from lastuser_core.models import (
-    AuthClient,
-    AuthClientCredential,
-    AuthCode,
-    AuthToken,
-    User,
-    db,
-    getuser,
-)
+from lastuser_core.models import AuthToken, User, db, getuser
+from lastuser_core.passwords import PasswordCheckBusy, password_checker
+from lastuser_core.registry import client_registry
 from lastuser_core.utils import make_redirect_url
 
 from .. import lastuser_oauth
+from ..authcodes import auth_code_store
 from ..forms import AuthorizeForm
 from .helpers import requires_client_login, requires_login_no_message
 from .resource import get_userinfo
@@ -55,17 +49,12 @@ def verifyscope(scope, auth_client):
             # Validation 0: Is this an internal wildcard resource?
             if item.endswith('/*'):
                 found_internal = False
-                wildcard_base = item[:-2]
-                for key in resource_registry:
-                    if key == wildcard_base or key.startswith(wildcard_base + '/'):
-                        if (
-                            resource_registry[key]['trusted']
-                            and not auth_client.trusted
-                        ):
-                            # Skip over trusted resources if the client is not trusted
-                            continue
-                        internal_resources.append(key)
-                        found_internal = True
+                for key in resource_registry.wildcard_resources(item[:-2]):
+                    if resource_registry[key]['trusted'] and not auth_client.trusted:
+                        # Skip over trusted resources if the client is not trusted
+                        continue
+                    internal_resources.append(key)
+                    found_internal = True
                 if found_internal:
                     continue  # Continue to next item in scope, skipping the following
 
@@ -98,7 +87,7 @@ def verifyscope(scope, auth_client):
                 resource_name = subitem
                 action_name = None
             if resource_name == '*' and not action_name:
-                resource_client = AuthClient.get(namespace=namespace)
+                resource_client = client_registry.get_client(namespace=namespace)
                 if resource_client:
                     if resource_client.owner == auth_client.owner:
                         full_client_access.append(resource_client)
@@ -132,16 +121,9 @@ def oauth_make_auth_code(auth_client, scope, redirect_uri):
     Make an auth code for a given client. Caller must commit
     the database session for this to work.
     """
-    authcode = AuthCode(
-        user=current_auth.user,
-        user_session=current_auth.session,
-        auth_client=auth_client,
-        scope=scope,
-        redirect_uri=redirect_uri[:1024],
+    return auth_code_store().issue(
+        current_auth.user, current_auth.session, auth_client, scope, redirect_uri
     )
-    authcode.code = newsecret()
-    db.session.add(authcode)
-    return authcode.code
 
 
 def clear_flashed_messages():
@@ -232,7 +214,7 @@ def oauth_authorize():
         return oauth_auth_403(_("Missing client_id"))
     # Validation 1.2: AuthClient exists
 
-    credential = AuthClientCredential.get(client_id)
+    credential = client_registry.get_credential(client_id)
     if credential:
         auth_client = credential.auth_client
     else:
@@ -312,8 +294,8 @@ def oauth_authorize():
     # If there is an existing auth token with the same or greater scope, don't ask user again; authorise silently
     existing_token = auth_client.authtoken_for(current_auth.user, current_auth.session)
     if existing_token and (
-        '*' in existing_token.effective_scope
-        or set(scope).issubset(set(existing_token.effective_scope))
+        '*' in existing_token.compiled_effective_scope
+        or existing_token.compiled_effective_scope.issuperset(scope)
     ):
         if response_type == 'code':
             return oauth_auth_success(
@@ -502,11 +484,11 @@ def oauth_token():
 
     # Validations 3: auth code
     elif grant_type == 'authorization_code':
-        authcode = AuthCode.get_for_client(auth_client=auth_client, code=code)
+        # The code is taken from the store here, so it cannot be used again
+        authcode = auth_code_store().consume(auth_client=auth_client, code=code)
         if not authcode:
             return oauth_token_error('invalid_grant', _("Unknown auth code"))
         if not authcode.is_valid():
-            db.session.delete(authcode)
             db.session.commit()
             return oauth_token_error('invalid_grant', _("Expired auth code"))
         # Validations 3.1: scope in authcode
@@ -523,7 +505,6 @@ def oauth_token():
         token = oauth_make_token(
             user=authcode.user, auth_client=auth_client, scope=scope
         )
-        db.session.delete(authcode)
         return oauth_token_success(
             token,
             userinfo=get_userinfo(
@@ -552,7 +533,16 @@ def oauth_token():
             return oauth_token_error(
                 'invalid_client', _("No such user")
             )  # XXX: invalid_client doesn't seem right
-        if not user.password_is(password):
+        try:
+            password_matches = password_checker.check(user, password)
+        except PasswordCheckBusy as e:
+            response = oauth_token_error(
+                'temporarily_unavailable', _("Too many logins. Try again shortly")
+            )
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+        if not password_matches:
             return oauth_token_error('invalid_client', _("Password mismatch"))
         # Validations 4.3: verify scope
         try:
@@ -54,10 +54,10 @@ def account_edit(newprofile=False):
                 )
                 db.session.add(useremail)
             send_email_verify_link(useremail)
-            db.session.commit()
             user_data_changed.send(
                 current_auth.user, changes=['profile', 'email-claim']
             )
+            db.session.commit()
             flash(
                 _(
                     "Your profile has been updated. We sent you an email to confirm your address"
@@ -65,8 +65,8 @@ def account_edit(newprofile=False):
                 category='success',
             )
         else:
-            db.session.commit()
             user_data_changed.send(current_auth.user, changes=['profile'])
+            db.session.commit()
             flash(_("Your profile has been updated"), category='success')
 
         if newprofile:
@@ -140,8 +140,8 @@ def confirm_email(md5sum, secret):
             )
             db.session.delete(emailclaim)
             UserEmailClaim.all(useremail.email).delete(synchronize_session=False)
-            db.session.commit()
             user_data_changed.send(current_auth.user, changes=['email'])
+            db.session.commit()
             return render_message(
                 title=_("Email address verified"),
                 message=Markup(
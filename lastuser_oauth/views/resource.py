@@ -1,28 +1,48 @@
 # -*- coding: utf-8 -*-
 
+from itertools import chain
 from urllib.parse import urlparse
 
-from flask import abort, jsonify, render_template, request
+from sqlalchemy import event as sqla_event
+from sqlalchemy.orm.attributes import get_history
+
+from flask import abort, current_app, has_app_context, jsonify, render_template, request
 from werkzeug.exceptions import BadRequest
 
-from baseframe import _, __
+from baseframe import _, __, cache
 from coaster.auth import current_auth
-from coaster.utils import getbool
+from coaster.utils import buid, getbool, md5sum
 from coaster.views import jsonp, requestargs
 from lastuser_core import resource_registry
+from lastuser_core.activity import activity_tracker
 from lastuser_core.models import (
-    AuthClientCredential,
+    AuthClient,
     AuthClientTeamPermissions,
     AuthClientUserPermissions,
     AuthToken,
     Organization,
+    Team,
     User,
     UserSession,
     db,
     getuser,
+    getuser_many,
+    load_userinfo_data,
+)
+from lastuser_core.models.user import team_membership
+from lastuser_core.registry import client_registry
+from lastuser_core.signals import (
+    connect_batch,
+    model_user_deleted,
+    model_user_edited,
+    model_useremail_deleted,
+    model_useremail_edited,
+    model_useremail_new,
+    user_data_changed,
 )
 
 from .. import lastuser_oauth
+from ..bitmaps import activity_bitmaps
 from .helpers import (
     requires_client_id_or_user_or_client_login,
     requires_client_login,
@@ -30,11 +50,183 @@ from .helpers import (
 )
 
 
-def get_userinfo(user, auth_client, scope=[], user_session=None, get_permissions=True):
+#: Scopes that include each section of userinfo
+id_scopes = frozenset(['*', 'id', 'id/*'])
+email_scopes = frozenset(['*', 'email', 'email/*'])
+phone_scopes = frozenset(['*', 'phone', 'phone/*'])
+organizations_scopes = frozenset(['*', 'organizations', 'organizations/*'])
+teams_scopes = frozenset(['*', 'teams', 'teams/*'])
+member_teams_scopes = organizations_scopes | teams_scopes
+
+
+class UserinfoCache(object):
+    """
+    Cache of userinfo projections, shared across workers through the app cache.
+
+    Entries are keyed by user, client, scope and the ``get_permissions`` flag,
+    together with generation markers for the user, the client and the whole
+    cache. Invalidation replaces a generation marker, which
+    orphans every entry built under the previous marker. Orphaned entries expire
+    after ``USERINFO_CACHE_TIMEOUT`` seconds. Markers expire after
+    :attr:`generation_timeout`, and an expired marker is replaced by a new one,
+    which orphans entries like an invalidation. A timeout of 0 disables the cache.
+    """
+
+    prefix = 'lastuser/userinfo/'
+    global_gen_key = prefix + 'gen'
+
+    def user_gen_key(self, user_id):
+        return self.prefix + 'gen/user/' + str(user_id)
+
+    def client_gen_key(self, auth_client_id):
+        return self.prefix + 'gen/client/' + str(auth_client_id)
+
+    @property
+    def timeout(self):
+        return current_app.config.get('USERINFO_CACHE_TIMEOUT', 300)
+
+    @property
+    def generation_timeout(self):
+        # Long enough that few entries are orphaned by an expiring marker, short
+        # enough that markers for users and clients not seen again go away
+        return self.timeout * 12
+
+    def generations(self, keys):
+        """Return current generation markers for the given keys, creating them if missing"""
+        keys = list(keys)
+        generations = dict(zip(keys, cache.get_many(*keys)))
+        missing = {key: buid() for key, value in generations.items() if value is None}
+        if missing:
+            cache.set_many(missing, timeout=self.generation_timeout)
+            generations.update(missing)
+        return generations
+
+    def get_many(self, items):
+        """
+        Look up cached userinfo in two cache round trips.
+
+        :param items: List of ``(user, auth_client, scope, get_permissions)`` tuples
+        :return: List of ``(key, userinfo)`` tuples in the same order, with
+            ``userinfo`` set to ``None`` for entries not in the cache
+        """
+        if not self.timeout:
+            return [(None, None) for item in items]
+        generations = self.generations(
+            {self.global_gen_key}
+            | {self.user_gen_key(user.id) for user, _c, _s, _p in items}
+            | {self.client_gen_key(auth_client.id) for _u, auth_client, _s, _p in items}
+        )
+        keys = [
+            self.prefix
+            + '/'.join(
+                (
+                    generations[self.global_gen_key],
+                    generations[self.user_gen_key(user.id)],
+                    generations[self.client_gen_key(auth_client.id)],
+                    str(user.id),
+                    str(auth_client.id),
+                    'p' if get_permissions else 'n',
+                    ' '.join(sorted(scope)),
+                )
+            )
+            for user, auth_client, scope, get_permissions in items
+        ]
+        return list(zip(keys, cache.get_many(*keys))) if keys else []
+
+    def set(self, key, userinfo):
+        if key is not None:
+            cache.set(key, userinfo, timeout=self.timeout)
+
+    def invalidate(self, user_ids=(), auth_client_ids=(), everything=False):
+        """Replace generation markers, orphaning all entries that depend on them"""
+        if not has_app_context() or not self.timeout:
+            return
+        keys = [self.user_gen_key(user_id) for user_id in user_ids] + [
+            self.client_gen_key(auth_client_id) for auth_client_id in auth_client_ids
+        ]
+        if everything:
+            keys.append(self.global_gen_key)
+        if keys:
+            cache.set_many(
+                {key: buid() for key in keys}, timeout=self.generation_timeout
+            )
+
+
+userinfo_cache = UserinfoCache()
+
+
+def prefetch_userinfo(users, auth_client, scope, get_permissions=True):
+    """
+    Load the data required by :func:`get_userinfo` for multiple users at once.
+    Pass the result for each user to :func:`get_userinfo` as ``data``.
+    """
+    scope = frozenset(scope)
+    return load_userinfo_data(
+        users,
+        auth_client=auth_client if get_permissions else None,
+        oldids=not scope.isdisjoint(id_scopes),
+        teams=not scope.isdisjoint(member_teams_scopes),
+        owned_teams=not scope.isdisjoint(teams_scopes),
+    )
+
+
+def _orginfo(org):
+    return {
+        'userid': org.buid,
+        'buid': org.buid,
+        'uuid': org.uuid,
+        'name': org.name,
+        'title': org.title,
+    }
+
+
+def _teaminfo(team, member):
+    return {
+        'userid': team.buid,
+        'buid': team.buid,
+        'uuid': team.uuid,
+        'title': team.title,
+        'org': team.organization.buid,
+        'org_uuid': team.organization.uuid,
+        'owners': team.organization.owners_id == team.id,
+        'member': member,
+    }
+
+
+def get_userinfo(
+    user, auth_client, scope=[], user_session=None, get_permissions=True, data=None
+):
+    """
+    Return userinfo for the given user and scope, from :data:`userinfo_cache` if
+    available.
+
+    :param data: :class:`UserinfoData` from :func:`prefetch_userinfo`, if available.
+        It is loaded here otherwise
+    """
+    scope = frozenset(scope)
+    [(key, userinfo)] = userinfo_cache.get_many(
+        [(user, auth_client, scope, get_permissions)]
+    )
+    if userinfo is None:
+        userinfo = build_userinfo(user, auth_client, scope, get_permissions, data)
+        userinfo_cache.set(key, userinfo)
+    if user_session:
+        # The session is specific to this call and is not part of the cached entry
+        userinfo = dict(userinfo, sessionid=user_session.buid)
+    return userinfo
+
+
+def build_userinfo(user, auth_client, scope, get_permissions=True, data=None):
+    """
+    Build userinfo for the given user and scope, bypassing the cache.
+    """
+    scope = frozenset(scope)
+    if data is None:
+        data = prefetch_userinfo([user], auth_client, scope, get_permissions)[user.id]
 
     teams = {}
 
-    if '*' in scope or 'id' in scope or 'id/*' in scope:
+    if not scope.isdisjoint(id_scopes):
         userinfo = {
             'userid': user.buid,
             'buid': user.buid,
@@ -43,107 +235,199 @@ def get_userinfo(user, auth_client, scope=[], user_session=None, get_permissions
             'fullname': user.fullname,
             'timezone': user.timezone,
             'avatar': user.avatar,
-            'oldids': [o.buid for o in user.oldids],
-            'olduuids': [o.uuid for o in user.oldids],
+            'oldids': [o.buid for o in data.oldids],
+            'olduuids': [o.uuid for o in data.oldids],
         }
     else:
         userinfo = {}
 
-    if user_session:
-        userinfo['sessionid'] = user_session.buid
-
-    if '*' in scope or 'email' in scope or 'email/*' in scope:
+    if not scope.isdisjoint(email_scopes):
         userinfo['email'] = str(user.email)
-    if '*' in scope or 'phone' in scope or 'phone/*' in scope:
+    if not scope.isdisjoint(phone_scopes):
         userinfo['phone'] = str(user.phone)
-    if '*' in scope or 'organizations' in scope or 'organizations/*' in scope:
+    if not scope.isdisjoint(organizations_scopes):
+        # User.organizations() and organizations_memberof() are identical
+        memberof = [_orginfo(org) for org in data.organizations_memberof]
         userinfo['organizations'] = {
-            'owner': [
-                {
-                    'userid': org.buid,
-                    'buid': org.buid,
-                    'uuid': org.uuid,
-                    'name': org.name,
-                    'title': org.title,
-                }
-                for org in user.organizations_owned()
-            ],
-            'member': [
-                {
-                    'userid': org.buid,
-                    'buid': org.buid,
-                    'uuid': org.uuid,
-                    'name': org.name,
-                    'title': org.title,
-                }
-                for org in user.organizations_memberof()
-            ],
-            'all': [
-                {
-                    'userid': org.buid,
-                    'buid': org.buid,
-                    'uuid': org.uuid,
-                    'name': org.name,
-                    'title': org.title,
-                }
-                for org in user.organizations()
-            ],
+            'owner': [_orginfo(org) for org in data.organizations_owned],
+            'member': memberof,
+            'all': memberof,
         }
 
-    if (
-        '*' in scope
-        or 'organizations' in scope
-        or 'teams' in scope
-        or 'organizations/*' in scope
-        or 'teams/*' in scope
-    ):
-        for team in user.teams:
-            teams[team.buid] = {
-                'userid': team.buid,
-                'buid': team.buid,
-                'uuid': team.uuid,
-                'title': team.title,
-                'org': team.organization.buid,
-                'org_uuid': team.organization.uuid,
-                'owners': team == team.organization.owners,
-                'member': True,
-            }
+    if not scope.isdisjoint(member_teams_scopes):
+        for team in data.teams:
+            teams[team.buid] = _teaminfo(team, member=True)
 
-    if '*' in scope or 'teams' in scope or 'teams/*' in scope:
-        for org in user.organizations_owned():
-            for team in org.teams:
-                if team.buid not in teams:
-                    teams[team.buid] = {
-                        'userid': team.buid,
-                        'buid': team.buid,
-                        'uuid': team.uuid,
-                        'title': team.title,
-                        'org': team.organization.buid,
-                        'org_uuid': team.organization.uuid,
-                        'owners': team == team.organization.owners,
-                        'member': False,
-                    }
+    if not scope.isdisjoint(teams_scopes):
+        for team in data.owned_org_teams:
+            if team.buid not in teams:
+                teams[team.buid] = _teaminfo(team, member=False)
 
     if teams:
         userinfo['teams'] = list(teams.values())
 
     if get_permissions:
-        if auth_client.user:
-            perms = AuthClientUserPermissions.get(auth_client=auth_client, user=user)
-            if perms:
-                userinfo['permissions'] = perms.access_permissions.split(' ')
+        if auth_client.user_id is not None:
+            if data.permissions is not None:
+                userinfo['permissions'] = data.permissions
         else:
-            permsset = set()
-            if user.teams:
-                perms = AuthClientTeamPermissions.all_for(
-                    auth_client=auth_client, user=user
-                ).all()
-                for permob in perms:
-                    permsset.update(permob.access_permissions.split(' '))
-            userinfo['permissions'] = sorted(permsset)
+            userinfo['permissions'] = data.permissions or []
     return userinfo
 
 
+# --- Userinfo cache invalidation ---------------------------------------------
+
+# Mapper events fire during a flush, before the changes are visible to other
+# workers. They are collected in the session and applied after commit, so that no
+# worker can cache data from before the change under the new generation
+
+
+def _userinfo_stale(user_ids=(), auth_client_ids=(), everything=False):
+    stale = db.session.info.setdefault(
+        'userinfo_stale', {'user_ids': set(), 'auth_client_ids': set(), 'all': False}
+    )
+    stale['user_ids'].update(user_ids)
+    stale['auth_client_ids'].update(auth_client_ids)
+    stale['all'] = stale['all'] or everything
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _userinfo_session_committed(session):
+    stale = session.info.pop('userinfo_stale', None)
+    if stale:
+        userinfo_cache.invalidate(
+            stale['user_ids'], stale['auth_client_ids'], stale['all']
+        )
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _userinfo_session_rolledback(session):
+    session.info.pop('userinfo_stale', None)
+
+
+# Model signals are sent after commit, so they are applied immediately, once per
+# commit for all the changed objects of a model
+
+
+@connect_batch(model_user_edited)
+@connect_batch(model_user_deleted)
+def _userinfo_users_changed(users):
+    userinfo_cache.invalidate(user_ids=[user.id for user in users])
+
+
+# The email, phone and claim model signals share the model-useremail-* names
+@connect_batch(model_useremail_new)
+@connect_batch(model_useremail_edited)
+@connect_batch(model_useremail_deleted)
+def _userinfo_contacts_changed(targets):
+    userinfo_cache.invalidate(user_ids={target.user_id for target in targets})
+
+
+@sqla_event.listens_for(db.session, 'before_flush')
+def _userinfo_session_flushing(session, flush_context, instances):
+    # Organization and team changes affect the userinfo of their members and of
+    # the organization's owners, and membership changes that of the users added
+    # or removed. Members are looked up before the flush, while the rows of
+    # deleted organizations and teams are still there
+    org_ids = set()
+    team_ids = set()
+    owner_org_ids = set()
+    user_ids = set()
+    for target in chain(session.new, session.dirty, session.deleted):
+        if isinstance(target, Organization):
+            if target.id is not None and (
+                target in session.deleted
+                or session.is_modified(target, include_collections=False)
+            ):
+                org_ids.add(target.id)
+        elif isinstance(target, Team):
+            history = get_history(target, 'users')
+            user_ids.update(
+                user.id for user in chain(history.added, history.deleted) if user.id
+            )
+            if (
+                target in session.new
+                or target in session.deleted
+                or session.is_modified(target, include_collections=False)
+            ):
+                if target.id is not None:
+                    team_ids.add(target.id)
+                organization = target.organization
+                if organization is not None and organization.id is not None:
+                    owner_org_ids.add(organization.id)
+        elif isinstance(target, User) and target.id is not None:
+            if get_history(target, 'teams').has_changes():
+                user_ids.add(target.id)
+
+    conditions = []
+    if org_ids:
+        conditions.append(Team.__table__.c.organization_id.in_(org_ids))
+    if team_ids:
+        conditions.append(Team.__table__.c.id.in_(team_ids))
+    if owner_org_ids:
+        conditions.append(
+            Team.__table__.c.id.in_(
+                db.select([Organization.__table__.c.owners_id]).where(
+                    Organization.__table__.c.id.in_(owner_org_ids)
+                )
+            )
+        )
+    if conditions:
+        user_ids.update(
+            user_id
+            for (user_id,) in session.execute(
+                db.select([team_membership.c.user_id])
+                .select_from(
+                    team_membership.join(
+                        Team.__table__,
+                        Team.__table__.c.id == team_membership.c.team_id,
+                    )
+                )
+                .where(db.or_(*conditions))
+            )
+        )
+    if user_ids:
+        _userinfo_stale(user_ids=user_ids)
+
+
+@sqla_event.listens_for(AuthClient, 'after_update')
+def _userinfo_auth_client_updated(mapper, connection, target):
+    _userinfo_stale(auth_client_ids=[target.id])
+
+
+@sqla_event.listens_for(AuthClientUserPermissions, 'after_insert')
+@sqla_event.listens_for(AuthClientUserPermissions, 'after_update')
+@sqla_event.listens_for(AuthClientUserPermissions, 'after_delete')
+@sqla_event.listens_for(AuthClientTeamPermissions, 'after_insert')
+@sqla_event.listens_for(AuthClientTeamPermissions, 'after_update')
+@sqla_event.listens_for(AuthClientTeamPermissions, 'after_delete')
+def _userinfo_permissions_changed(mapper, connection, target):
+    _userinfo_stale(auth_client_ids=[target.auth_client_id])
+
+
+# High level signals are sent before the views commit, so they are also applied
+# after commit. They cover changes that no model signal does, such as the
+# primary email and phone
+
+
+@user_data_changed.connect
+def _userinfo_user_data_changed(user, **kwargs):
+    _userinfo_stale(user_ids=[user.id])
+
+
+def get_clientinfo(auth_client):
+    return {
+        'title': auth_client.title,
+        'userid': auth_client.owner.buid,
+        'buid': auth_client.owner.buid,
+        'uuid': auth_client.owner.uuid,
+        'owner_title': auth_client.owner.pickername,
+        'website': auth_client.website,
+        'key': auth_client.buid,
+        'trusted': auth_client.trusted,
+    }
+
+
 def resource_error(error, description=None, uri=None):
     params = {'status': 'error', 'error': error}
     if description:
@@ -208,10 +492,10 @@ def token_verify():
     if not authtoken:
         # No such auth token
         return api_result('error', error='no_token')
+    tokenscope = authtoken.compiled_effective_scope
     if (
-        current_auth.auth_client.namespace + ':' + client_resource
-        not in authtoken.effective_scope
-    ) and (current_auth.auth_client.namespace + ':*' not in authtoken.effective_scope):
+        current_auth.auth_client.namespace + ':' + client_resource not in tokenscope
+    ) and (current_auth.auth_client.namespace + ':*' not in tokenscope):
         # Token does not grant access to this resource
         return api_result('error', error='access_denied')
 
@@ -224,19 +508,115 @@ def token_verify():
         params['userinfo'] = get_userinfo(
             authtoken.user, current_auth.auth_client, scope=authtoken.effective_scope
         )
-    params['clientinfo'] = {
-        'title': authtoken.auth_client.title,
-        'userid': authtoken.auth_client.owner.buid,
-        'buid': authtoken.auth_client.owner.buid,
-        'uuid': authtoken.auth_client.owner.uuid,
-        'owner_title': authtoken.auth_client.owner.pickername,
-        'website': authtoken.auth_client.website,
-        'key': authtoken.auth_client.buid,
-        'trusted': authtoken.auth_client.trusted,
-    }
+    params['clientinfo'] = get_clientinfo(authtoken.auth_client)
     return api_result('ok', **params)
 
 
+@lastuser_oauth.route('/api/1/token/verify_many', methods=['POST'])
+@requires_client_login
+@requestargs('access_token[]')
+def token_verify_many(access_token):
+    """
+    Batch variant of :func:`token_verify`. Accepts multiple tokens as
+    ``access_token[]`` and returns results keyed by token. Unlike
+    :func:`token_verify`, which is left unchanged for existing clients, tokens
+    past their validity are reported as ``token_expired``.
+    """
+    tokens = access_token
+    client_resource = request.form.get('resource')
+    if not client_resource:
+        # No resource specified by caller
+        return resource_error('no_resource')
+    if client_resource != '*':
+        # Client resources are no longer supported; only the '*' resource is
+        return resource_error('unknown_resource')
+    if not tokens:
+        # No tokens specified by caller
+        return resource_error('no_token')
+    if len(tokens) > current_app.config.get('TOKEN_VERIFY_MANY_LIMIT', 100):
+        return resource_error('too_many_tokens')
+
+    if not current_auth.auth_client.namespace:
+        # This client has not defined any resources
+        return api_result('error', error='client_no_resources')
+
+    required_scopes = {
+        current_auth.auth_client.namespace + ':' + client_resource,
+        current_auth.auth_client.namespace + ':*',
+    }
+    authtokens = AuthToken.get_many(tokens)
+    # Userinfo is looked up once per distinct user and scope, with a single cache
+    # lookup for all of them
+    userinfo_items = {}
+    for authtoken in authtokens.values():
+        tokenscope = authtoken.compiled_effective_scope
+        if (
+            authtoken.user
+            and authtoken.is_valid()
+            and not tokenscope.isdisjoint(required_scopes)
+        ):
+            userinfo_items[(authtoken.user.id, tokenscope)] = (
+                authtoken.user,
+                current_auth.auth_client,
+                tokenscope,
+                True,
+            )
+    userinfo_results = dict(
+        zip(userinfo_items, userinfo_cache.get_many(list(userinfo_items.values())))
+    )
+    # Load userinfo data for all users not in the cache in one pass, for the union
+    # of their scopes
+    missing = [
+        userinfo_items[item_key]
+        for item_key, (key, userinfo) in userinfo_results.items()
+        if userinfo is None
+    ]
+    if missing:
+        userinfo_data = prefetch_userinfo(
+            {user for user, _c, _s, _p in missing},
+            current_auth.auth_client,
+            frozenset().union(*(scope for _u, _c, scope, _p in missing)),
+        )
+        for item_key, (key, userinfo) in list(userinfo_results.items()):
+            if userinfo is None:
+                user = userinfo_items[item_key][0]
+                userinfo = build_userinfo(
+                    user,
+                    current_auth.auth_client,
+                    item_key[1],
+                    data=userinfo_data[user.id],
+                )
+                userinfo_cache.set(key, userinfo)
+                userinfo_results[item_key] = (key, userinfo)
+    # Clientinfo is built once per client
+    clientinfo_cache = {}
+    results = {}
+    for token in tokens:
+        authtoken = authtokens.get(token)
+        if not authtoken:
+            # No such auth token
+            results[token] = {'status': 'error', 'error': 'no_token'}
+            continue
+        if not authtoken.is_valid():
+            results[token] = {'status': 'error', 'error': 'token_expired'}
+            continue
+        tokenscope = authtoken.compiled_effective_scope
+        if tokenscope.isdisjoint(required_scopes):
+            # Token does not grant access to this resource
+            results[token] = {'status': 'error', 'error': 'access_denied'}
+            continue
+        result = {'status': 'ok', 'validity': 120}
+        if authtoken.user:
+            result['userinfo'] = userinfo_results[(authtoken.user.id, tokenscope)][1]
+        if authtoken.auth_client_id not in clientinfo_cache:
+            clientinfo_cache[authtoken.auth_client_id] = get_clientinfo(
+                authtoken.auth_client
+            )
+        result['clientinfo'] = clientinfo_cache[authtoken.auth_client_id]
+        results[token] = result
+    return api_result('ok', results=results)
+
+
 @lastuser_oauth.route('/api/1/token/get_scope', methods=['POST'])
 @requires_client_login
 def token_get_scope():
@@ -272,17 +652,8 @@ def token_get_scope():
         params['userinfo'] = get_userinfo(
             authtoken.user, current_auth.auth_client, scope=authtoken.effective_scope
         )
-    params['clientinfo'] = {
-        'title': authtoken.auth_client.title,
-        'userid': authtoken.auth_client.owner.buid,
-        'buid': authtoken.auth_client.owner.buid,
-        'uuid': authtoken.auth_client.owner.uuid,
-        'owner_title': authtoken.auth_client.owner.pickername,
-        'website': authtoken.auth_client.website,
-        'key': authtoken.auth_client.buid,
-        'trusted': authtoken.auth_client.trusted,
-        'scope': client_resources,
-    }
+    params['clientinfo'] = get_clientinfo(authtoken.auth_client)
+    params['clientinfo']['scope'] = client_resources
     return api_result('ok', **params)
 
 
@@ -341,6 +712,7 @@ def user_get_by_userids(userid):
         return api_result('error', error='no_userid_provided', _jsonp=True)
     users = User.all(buids=userid)
     orgs = Organization.all(buids=userid)
+    userinfo_data = load_userinfo_data(users, teams=False, owned_teams=False)
     return api_result(
         'ok',
         _jsonp=True,
@@ -354,8 +726,8 @@ def user_get_by_userids(userid):
                 'title': u.fullname,
                 'label': u.pickername,
                 'timezone': u.timezone,
-                'oldids': [o.buid for o in u.oldids],
-                'olduuids': [o.uuid for o in u.oldids],
+                'oldids': [o.buid for o in userinfo_data[u.id].oldids],
+                'olduuids': [o.uuid for o in userinfo_data[u.id].oldids],
             }
             for u in users
         ]
@@ -414,9 +786,13 @@ def user_getall(name):
     if not names:
         return api_result('error', error='no_name_provided')
     results = []
-    for name in names:
-        user = getuser(name)
-        if user and user.buid not in buids:
+    users = getuser_many(names)
+    userinfo_data = load_userinfo_data(
+        set(users.values()), teams=False, owned_teams=False
+    )
+    for user in users.values():
+        if user.buid not in buids:
+            oldids = userinfo_data[user.id].oldids
             results.append(
                 {
                     'type': 'user',
@@ -427,8 +803,8 @@ def user_getall(name):
                     'title': user.fullname,
                     'label': user.pickername,
                     'timezone': user.timezone,
-                    'oldids': [o.buid for o in user.oldids],
-                    'olduuids': [o.uuid for o in user.oldids],
+                    'oldids': [o.buid for o in oldids],
+                    'olduuids': [o.uuid for o in oldids],
                 }
             )
             buids.add(user.buid)
@@ -438,27 +814,70 @@ def user_getall(name):
         return api_result('ok', results=results)
 
 
+# Cached autocomplete results are keyed by a generation marker, replaced after
+# commit when a user's status changes, so that suspended and merged accounts are
+# no longer listed
+autocomplete_gen_key = 'lastuser/autocomplete/gen'
+
+
+@sqla_event.listens_for(db.session, 'before_flush')
+def _autocomplete_session_flushing(session, flush_context, instances):
+    for target in session.dirty:
+        if isinstance(target, User) and get_history(target, 'status').has_changes():
+            session.info['autocomplete_stale'] = True
+            return
+
+
+@sqla_event.listens_for(db.session, 'after_commit')
+def _autocomplete_session_committed(session):
+    if session.info.pop('autocomplete_stale', False) and has_app_context():
+        cache.delete(autocomplete_gen_key)
+
+
+@sqla_event.listens_for(db.session, 'after_rollback')
+def _autocomplete_session_rolledback(session):
+    session.info.pop('autocomplete_stale', None)
+
+
 @lastuser_oauth.route('/api/1/user/autocomplete', methods=['GET', 'POST'])
 @requires_client_id_or_user_or_client_login
 def user_autocomplete():
     """
     Returns users (buid, username, fullname, twitter, github or email) matching the search term.
+
+    Results are cached for ``USER_AUTOCOMPLETE_CACHE_TIMEOUT`` seconds. A change
+    to a user's status, as when the account is suspended or merged, discards all
+    cached results. Other changes, such as new users and changed names, may not
+    be reflected until the cached result expires.
     """
     q = request.values.get('q', '')
     if not q:
         return api_result('error', error='no_query_provided')
-    users = User.autocomplete(q)
-    result = [
-        {
-            'userid': u.buid,
-            'buid': u.buid,
-            'uuid': u.uuid,
-            'name': u.username,
-            'title': u.fullname,
-            'label': u.pickername,
-        }
-        for u in users
-    ]
+    # Popular prefixes are requested by every picker widget as users type
+    timeout = current_app.config.get('USER_AUTOCOMPLETE_CACHE_TIMEOUT', 60)
+    generation = cache.get(autocomplete_gen_key)
+    if generation is None:
+        # The marker outlives many entries, and an expired marker only orphans them
+        generation = buid()
+        cache.set(autocomplete_gen_key, generation, timeout=timeout * 12)
+    cache_key = 'lastuser/autocomplete/{gen}/{q}'.format(gen=generation, q=md5sum(q))
+    result = cache.get(cache_key)
+    if result is None:
+        users = User.autocomplete(
+            q, limit=current_app.config.get('USER_AUTOCOMPLETE_LIMIT', 100)
+        )
+        result = [
+            {
+                'userid': u.buid,
+                'buid': u.buid,
+                'uuid': u.uuid,
+                'name': u.username,
+                'title': u.fullname,
+                'label': u.pickername,
+            }
+            for u in users
+        ]
+        cache.set(cache_key, result, timeout=timeout)
     return api_result('ok', users=result, _jsonp=True)
 
 
@@ -468,7 +887,7 @@ def user_autocomplete():
 @lastuser_oauth.route('/api/1/login/beacon.html')
 @requestargs('client_id', 'login_url')
 def login_beacon_iframe(client_id, login_url):
-    cred = AuthClientCredential.get(client_id)
+    cred = client_registry.get_credential(client_id)
     auth_client = cred.auth_client if cred else None
     if auth_client is None:
         abort(404)
@@ -489,7 +908,7 @@ def login_beacon_iframe(client_id, login_url):
 @lastuser_oauth.route('/api/1/login/beacon.json')
 @requestargs('client_id')
 def login_beacon_json(client_id):
-    cred = AuthClientCredential.get(client_id)
+    cred = client_registry.get_credential(client_id)
     auth_client = cred.auth_client if cred else None
     if auth_client is None:
         abort(404)
@@ -531,8 +950,8 @@ def session_verify(authtoken, args, files=None):
     sessionid = args['sessionid']
     session = UserSession.authenticate(buid=sessionid)
     if session and session.user == authtoken.user:
-        session.access(auth_client=authtoken.auth_client)
-        db.session.commit()
+        activity_tracker.client_session_accessed(session, authtoken.auth_client)
+        activity_bitmaps.mark(session.user.id)
         return {
             'active': True,
             'sessionid': session.buid,
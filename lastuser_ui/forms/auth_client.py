@@ -108,6 +108,14 @@ class RegisterClientForm(forms.Form):
             "Other notices may be posted too"
         ),
     )
+    notification_batch = forms.BooleanField(
+        __("Batch notices"),
+        default=False,
+        description=__(
+            "Collect notices and POST them together every few seconds as a JSON "
+            "array, instead of one request per notice"
+        ),
+    )
     allow_any_login = forms.BooleanField(
         __("Allow anyone to login"),
         default=True,
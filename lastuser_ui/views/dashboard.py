@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
 from functools import wraps
 from io import StringIO
 import csv
@@ -8,7 +7,12 @@ import csv
 from flask import abort, current_app, render_template
 
 from coaster.auth import current_auth
-from lastuser_core.models import USER_STATUS, User, db
+from lastuser_core.models import (
+    User,
+    rollup_client_users,
+    rollup_users_by_month,
+)
+from lastuser_oauth.bitmaps import activity_bitmaps
 
 from .. import lastuser_ui
 
@@ -35,45 +39,25 @@ def requires_dashboard(f):
 @requires_dashboard
 def dashboard():
     user_count = User.active_user_count()
-    mau = (
-        db.session.query('mau')
-        .from_statement(
-            db.text(
-                '''
-                SELECT COUNT(DISTINCT(user_session.user_id)) AS mau
-                FROM user_session, "user"
-                WHERE user_session.user_id = "user".id
-                    AND "user".status = :status
-                    AND user_session.accessed_at >= NOW() - INTERVAL '30 days'
-                '''
-            )
-        )
-        .params(status=USER_STATUS.ACTIVE)
-        .scalar()
+    dau = activity_bitmaps.active_users(1)
+    wau = activity_bitmaps.active_users(7)
+    mau = activity_bitmaps.active_users(30)
+    retention = activity_bitmaps.retention(8)
+
+    return render_template(
+        'dashboard.html.jinja2',
+        user_count=user_count,
+        dau=dau,
+        wau=wau,
+        mau=mau,
+        retention=retention,
     )
 
-    return render_template('dashboard.html.jinja2', user_count=user_count, mau=mau)
-
 
 @lastuser_ui.route('/dashboard/data/users_by_month.csv')
 @requires_dashboard
 def dashboard_data_users_by_month():
-    users_by_month = (
-        db.session.query('month', 'count')
-        .from_statement(
-            db.text(
-                '''
-                SELECT date_trunc('month', "user".created_at) AS month,
-                    count(*) AS count
-                FROM "user"
-                WHERE status=:status
-                GROUP BY month
-                ORDER BY month
-                '''
-            )
-        )
-        .params(status=USER_STATUS.ACTIVE)
-    )
+    users_by_month = rollup_users_by_month()
 
     outfile = StringIO()
     out = csv.writer(outfile, 'excel')
@@ -86,70 +70,17 @@ def dashboard_data_users_by_month():
 @lastuser_ui.route('/dashboard/data/users_by_client.csv')
 @requires_dashboard
 def dashboard_data_users_by_client():
-    client_users = defaultdict(
-        lambda: {
-            'counts': {
-                'hour': 0,
-                'day': 0,
-                'week': 0,
-                'month': 0,
-                'quarter': 0,
-                'halfyear': 0,
-                'year': 0,
-            }
-        }
-    )
-
-    for label, interval in (
-        ('hour', '1 hour'),
-        ('day', '1 day'),
-        ('week', '1 week'),
-        ('month', '1 month'),
-        ('quarter', '3 months'),
-        ('halfyear', '6 months'),
-        ('year', '1 year'),
-    ):
-        clients = (
-            db.session.query('auth_client_id', 'count', 'title', 'website')
-            .from_statement(
-                db.text(
-                    '''
-                    SELECT client_users.auth_client_id AS auth_client_id,
-                    count(*) AS count, auth_client.title AS title,
-                    auth_client.website AS website
-                    FROM (
-                        SELECT user_session.user_id,
-                        auth_client_user_session.auth_client_id FROM user_session,
-                        auth_client_user_session, "user"
-                        WHERE user_session.user_id = "user".id
-                        AND auth_client_user_session.user_session_id = user_session.id
-                        AND "user".status = :status
-                        AND auth_client_user_session.accessed_at >=
-                        (NOW() AT TIME ZONE 'UTC') - INTERVAL :interval
-                        GROUP BY auth_client_user_session.auth_client_id,
-                        user_session.user_id
-                    ) AS client_users, auth_client
-                    WHERE auth_client.id = client_users.auth_client_id
-                    GROUP BY client_users.auth_client_id, auth_client.title,
-                    auth_client.website
-                    ORDER BY count DESC
-                    '''
-                )
-            )
-            .params(status=USER_STATUS.ACTIVE, interval=interval)
-            .all()
-        )
-        for row in clients:
-            client_users[row.auth_client_id]['title'] = row.title
-            client_users[row.auth_client_id]['website'] = row.website
-            client_users[row.auth_client_id]['id'] = row.auth_client_id
-            client_users[row.auth_client_id]['counts'][label] = row.count - sum(
-                client_users[row.auth_client_id]['counts'].values()
-            )
-
-    users_by_client = sorted(
-        client_users.values(), key=lambda r: sum(r['counts'].values()), reverse=True
-    )
+    users_by_client = []
+    for row in rollup_client_users():
+        # Each interval counts users not already counted in a shorter interval
+        counts = {}
+        previous = 0
+        for label in ('hour', 'day', 'week', 'month', 'quarter', 'halfyear', 'year'):
+            total = max(getattr(row, label), previous)
+            counts[label] = total - previous
+            previous = total
+        users_by_client.append({'title': row.title, 'counts': counts})
+    users_by_client.sort(key=lambda r: sum(r['counts'].values()), reverse=True)
 
     outfile = StringIO()
     out = csv.writer(outfile, 'excel')
@@ -48,8 +48,8 @@ class OrgView(UrlForView, ModelView):
             if current_auth.user not in org.owners.users:
                 org.owners.users.append(current_auth.user)
             db.session.add(org)
-            db.session.commit()
             org_data_changed.send(org, changes=['new'], user=current_auth.user)
+            db.session.commit()
             return render_redirect(org.url_for('view'), code=303)
         return render_form(
             form=form,
@@ -72,8 +72,8 @@ class OrgView(UrlForView, ModelView):
         form.title.description = current_app.config.get('ORG_TITLE_REASON')
         if form.validate_on_submit():
             form.populate_obj(self.obj)
-            db.session.commit()
             org_data_changed.send(self.obj, changes=['edit'], user=current_auth.user)
+            db.session.commit()
             return render_redirect(self.obj.url_for('view'), code=303)
         return render_form(
             form=form,
@@ -114,8 +114,8 @@ class OrgView(UrlForView, ModelView):
             team = Team(organization=self.obj)
             db.session.add(team)
             form.populate_obj(team)
-            db.session.commit()
             team_data_changed.send(team, changes=['new'], user=current_auth.user)
+            db.session.commit()
             return render_redirect(self.obj.url_for('view'), code=303)
         return render_form(
             form=form, title=_("Create new team"), formid='new_team', submit=_("Create")
@@ -146,8 +146,8 @@ class TeamView(UrlForView, ModelView):
         form = TeamForm(obj=self.obj)
         if form.validate_on_submit():
             form.populate_obj(self.obj)
-            db.session.commit()
             team_data_changed.send(self.obj, changes=['edit'], user=current_auth.user)
+            db.session.commit()
             return render_redirect(self.obj.organization.url_for(), code=303)
         return render_form(
             form=form,
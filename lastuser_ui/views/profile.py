@@ -97,10 +97,10 @@ def add_email():
                 user=current_auth.user, email=form.email.data, type=form.type.data
             )
             db.session.add(useremail)
-            db.session.commit()
+        user_data_changed.send(current_auth.user, changes=['email-claim'])
+        db.session.commit()
         send_email_verify_link(useremail)
         flash(_("We sent you an email to confirm your address"), 'success')
-        user_data_changed.send(current_auth.user, changes=['email-claim'])
         return render_redirect(url_for('.account'), code=303)
     return render_form(
         form=form,
@@ -122,10 +122,10 @@ def make_email_primary():
                 flash(_("This is already your primary email address"), 'info')
             else:
                 current_auth.user.primary_email = useremail
-                db.session.commit()
                 user_data_changed.send(
                     current_auth.user, changes=['email-update-primary']
                 )
+                db.session.commit()
                 flash(_("Your primary email address has been updated"), 'success')
         else:
             flash(_("No such email address is linked to this user account"), 'danger')
@@ -145,10 +145,10 @@ def make_phone_primary():
                 flash(_("This is already your primary phone number"), 'info')
             else:
                 current_auth.user.primary_phone = userphone
-                db.session.commit()
                 user_data_changed.send(
                     current_auth.user, changes=['phone-update-primary']
                 )
+                db.session.commit()
                 flash(_("Your primary phone number has been updated"), 'success')
         else:
             flash(_("No such phone number is linked to this user account"), 'danger')
@@ -245,9 +245,9 @@ def add_phone():
             db.session.add(userphone)
         try:
             send_phone_verify_code(userphone)
+            user_data_changed.send(current_auth.user, changes=['phone-claim'])
             db.session.commit()  # Commit after sending because send_phone_verify_code saves the message sent
             flash(_("We sent a verification code to your phone number"), 'success')
-            user_data_changed.send(current_auth.user, changes=['phone-claim'])
             return render_redirect(
                 url_for('.verify_phone', number=userphone.phone), code=303
             )
@@ -322,9 +322,9 @@ def verify_phone(phoneclaim):
             userphone.primary = primary
             db.session.add(userphone)
             db.session.delete(phoneclaim)
+            user_data_changed.send(current_auth.user, changes=['phone'])
             db.session.commit()
             flash(_("Your phone number has been verified"), 'success')
-            user_data_changed.send(current_auth.user, changes=['phone'])
             return render_redirect(url_for('.account'), code=303)
         else:
             db.session.delete(phoneclaim)
@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
+from datetime import timedelta
+from itertools import groupby
+from time import sleep
+
 from coaster.manage import Manager, init_manager
+from coaster.utils import utcnow
 from lastuser_core.models import db
+from lastuser_core.models.user_session import USER_AGENT_FIELDS
+from lastuser_core.outbox import outbox as message_outbox
+from lastuser_core.passwords import bcrypt_rounds, hash_timings
+from lastuser_core.sweeper import sweeper
+from lastuser_oauth import rq
+from lastuser_oauth.bitmaps import activity_bitmaps
 from lastuserapp import app
 import lastuser_core
 import lastuser_core.models as models
@@ -16,10 +28,175 @@ periodic = Manager(usage="Periodic tasks from cron (with recommended intervals)"
 @periodic.command
 def phoneclaims():
     """Sweep phone claims to close all unclaimed beyond expiry period (10m)"""
-    models.UserPhoneClaim.delete_expired()
+    sweeper.sweep(['user_phone_claim'])
+
+
+@periodic.command
+def sweep(policy=None):
+    """Remove rows past their retention period, for one or all policies (1h)"""
+    if policy and policy not in sweeper.policies:
+        print(  # noqa: T001
+            "Unknown policy {policy}. Policies: {policies}".format(
+                policy=policy, policies=', '.join(sweeper.policies)
+            )
+        )
+        return
+    for name, count in sweeper.sweep([policy] if policy else None).items():
+        print(  # noqa: T001
+            "{name}: {count} rows removed".format(name=name, count=count)
+        )
+
+
+@periodic.command
+def rollups():
+    """Fold recent activity into the dashboard rollup tables (10m)"""
+    models.fold_rollups()
     db.session.commit()
 
 
+def activitybackfill():
+    """Mark users active in past days, from their sessions, in activity bitmaps"""
+    rows = db.session.execute(
+        db.text(
+            '''
+            SELECT DISTINCT (user_session.accessed_at AT TIME ZONE 'UTC')::date AS day,
+                user_session.user_id
+            FROM user_session, "user"
+            WHERE user_session.user_id = "user".id AND "user".status = :status
+                AND user_session.accessed_at >= :since
+            ORDER BY day
+            '''
+        ),
+        {
+            'status': models.USER_STATUS.ACTIVE,
+            'since': utcnow()
+            - timedelta(days=app.config.get('ACTIVITY_BITMAP_DAYS', 400)),
+        },
+    )
+    for day, user_ids in groupby(rows, key=lambda row: row.day):
+        activity_bitmaps.backfill(day, [row.user_id for row in user_ids])
+
+
+def autocomplete(batch=1000):
+    """Rebuild user autocomplete tokens for all users"""
+    last_id = 0
+    while True:
+        user_ids = [
+            user_id
+            for (user_id,) in db.session.query(models.User.id)
+            .filter(models.User.id > last_id)
+            .order_by(models.User.id)
+            .limit(batch)
+        ]
+        if not user_ids:
+            break
+        models.rebuild_autocomplete(db.session.connection(), user_ids)
+        db.session.commit()
+        last_id = user_ids[-1]
+
+
+def useragents(batch=1000):
+    """Fill parsed user agent fields for sessions saved before they were added"""
+    table = models.UserSession.__table__
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            db.select([table.c.id, table.c.user_agent])
+            .where(table.c.id > last_id)
+            .where(table.c.ua_browser.is_(None))
+            .order_by(table.c.id)
+            .limit(int(batch))
+        ).fetchall()
+        if not rows:
+            break
+        ids_by_agent = defaultdict(list)
+        for session_id, user_agent in rows:
+            ids_by_agent[user_agent].append(session_id)
+        for user_agent, session_ids in ids_by_agent.items():
+            db.session.execute(
+                table.update()
+                .where(table.c.id.in_(session_ids))
+                .values(
+                    dict(
+                        zip(
+                            USER_AGENT_FIELDS,
+                            models.parse_user_agent(user_agent),
+                        )
+                    )
+                )
+            )
+        db.session.commit()
+        last_id = rows[-1].id
+
+
+def outbox(loop=False, limit=100):
+    """Dispatch messages written to the outbox (continuously with --loop)"""
+    interval = app.config.get('OUTBOX_POLL_INTERVAL', 1)
+    while True:
+        dispatched = message_outbox.drain(int(limit))
+        if not loop:
+            print(  # noqa: T001
+                "Dispatched {count} messages".format(count=dispatched or 0)
+            )
+            break
+        if not dispatched:
+            sleep(interval)
+
+
+def rqscheduler():
+    """Queue delayed jobs (coalesced and batched notices, retries) when they are due"""
+    rq.get_scheduler().run()
+
+
+def passwordbench(budget=250, low=10, high=15):
+    """Time bcrypt costs and recommend PASSWORD_BCRYPT_ROUNDS for a budget (in ms)"""
+    budget = float(budget) / 1000
+    timings = hash_timings(range(int(low), int(high) + 1))
+    recommended = None
+    for cost, elapsed in sorted(timings.items()):
+        print(  # noqa: T001
+            "{cost:2d}: {ms:8.1f} ms{current}".format(
+                cost=cost,
+                ms=elapsed * 1000,
+                current=" (current)" if cost == bcrypt_rounds() else "",
+            )
+        )
+        if elapsed <= budget:
+            recommended = cost
+    if recommended is None:
+        print("No cost is within the budget")  # noqa: T001
+    else:
+        print("PASSWORD_BCRYPT_ROUNDS = {cost}".format(cost=recommended))  # noqa: T001
+
+
+def passwordreport():
+    """Report the number of password hashes by scheme and cost"""
+    # bcrypt hashes start with $2b$<cost>$; anything else is a legacy scheme
+    scheme = db.case(
+        [
+            (
+                models.User.pw_hash.like('$2%'),
+                db.func.split_part(models.User.pw_hash, '$', 3),
+            )
+        ],
+        else_=db.func.split_part(models.User.pw_hash, '$', 1),
+    )
+    target = bcrypt_rounds()
+    for label, count in (
+        db.session.query(scheme, db.func.count())
+        .filter(models.User.pw_hash.isnot(None))
+        .group_by(scheme)
+        .order_by(scheme)
+    ):
+        if label.isdigit():
+            label = "bcrypt cost {cost}{upgrade}".format(
+                cost=label, upgrade=" (to upgrade)" if int(label) < target else ""
+            )
+        else:
+            label = "{scheme} (to upgrade)".format(scheme=label)
+        print("{label}: {count}".format(label=label, count=count))  # noqa: T001
+
+
 if __name__ == '__main__':
     db.init_app(app)
     manager = init_manager(
@@ -32,4 +209,11 @@ if __name__ == '__main__':
         models=models,
     )
     manager.add_command('periodic', periodic)
+    manager.command(activitybackfill)
+    manager.command(autocomplete)
+    manager.command(outbox)
+    manager.command(passwordbench)
+    manager.command(passwordreport)
+    manager.command(rqscheduler)
+    manager.command(useragents)
     manager.run()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Flatten user_oldid chains
+
+Revision ID: 1e209909b3e7
+Revises: 87fc422c81f9
+Create Date: 2026-10-16 20:45:12.318204
+
+"""
+from alembic import op
+from sqlalchemy.sql import column, table
+from sqlalchemy_utils import UUIDType
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '1e209909b3e7'
+down_revision = '87fc422c81f9'
+branch_labels = None
+depends_on = None
+
+user = table(
+    'user',
+    column('id', sa.Integer()),
+    column('uuid', UUIDType(binary=False)),
+    column('status', sa.SmallInteger()),
+)
+
+user_oldid = table(
+    'user_oldid',
+    column('id', UUIDType(binary=False)),
+    column('user_id', sa.Integer()),
+)
+
+#: USER_STATUS.MERGED
+MERGED = 2
+
+
+def upgrade():
+    op.create_index(
+        op.f('ix_user_oldid_user_id'), 'user_oldid', ['user_id'], unique=False
+    )
+
+    # Old ids pointing at a merged account are moved to the account it was merged
+    # into, one hop per pass, until every old id points at a live account
+    conn = op.get_bind()
+    parent = user_oldid.alias('parent')
+    while True:
+        result = conn.execute(
+            sa.update(user_oldid)
+            .where(user_oldid.c.user_id == user.c.id)
+            .where(user.c.status == MERGED)
+            .where(parent.c.id == user.c.uuid)
+            .where(parent.c.user_id != user_oldid.c.user_id)
+            .values(user_id=parent.c.user_id)
+        )
+        if not result.rowcount:
+            break
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_oldid_user_id'), table_name='user_oldid')
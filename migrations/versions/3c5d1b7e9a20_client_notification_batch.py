@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Client notification batch flag
+
+Revision ID: 3c5d1b7e9a20
+Revises: db4303686563
+Create Date: 2026-10-16 23:02:41.117834
+
+"""
+from alembic import op
+from sqlalchemy.sql import expression
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3c5d1b7e9a20'
+down_revision = 'db4303686563'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'auth_client',
+        sa.Column(
+            'notification_batch',
+            sa.Boolean(),
+            nullable=False,
+            server_default=expression.false(),
+        ),
+    )
+    op.alter_column('auth_client', 'notification_batch', server_default=None)
+
+
+def downgrade():
+    op.drop_column('auth_client', 'notification_batch')
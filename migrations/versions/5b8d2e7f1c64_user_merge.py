@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Background account merges
+
+Revision ID: 5b8d2e7f1c64
+Revises: 9f2e4c6a8b13
+Create Date: 2026-10-16 23:58:42.183604
+
+"""
+from alembic import op
+from sqlalchemy_utils import UUIDType
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5b8d2e7f1c64'
+down_revision = '9f2e4c6a8b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'user_merge',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('uuid', UUIDType(binary=False), nullable=False),
+        sa.Column('keep_user_id', sa.Integer(), nullable=False),
+        sa.Column('merge_user_id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Integer(), nullable=False),
+        sa.Column('step', sa.Integer(), nullable=False),
+        sa.Column('steps', sa.Integer(), nullable=True),
+        sa.Column('rows_moved', sa.Integer(), nullable=False),
+        sa.Column('error', sa.UnicodeText(), nullable=True),
+        sa.ForeignKeyConstraint(['keep_user_id'], ['user.id']),
+        sa.ForeignKeyConstraint(['merge_user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('uuid'),
+    )
+
+
+def downgrade():
+    op.drop_table('user_merge')
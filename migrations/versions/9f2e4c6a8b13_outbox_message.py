@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Outbox messages
+
+Revision ID: 9f2e4c6a8b13
+Revises: 3c5d1b7e9a20
+Create Date: 2026-10-16 23:41:09.528310
+
+"""
+from alembic import op
+from sqlalchemy.dialects import postgresql
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9f2e4c6a8b13'
+down_revision = '3c5d1b7e9a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox_message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('updated_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column('kind', sa.Unicode(length=80), nullable=False),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('ordering_key', sa.Unicode(length=250), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('error', sa.UnicodeText(), nullable=True),
+        sa.Column('next_attempt_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('outbox_message')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Dashboard rollups
+
+Revision ID: c4a7e2d93f58
+Revises: 5b8d2e7f1c64
+Create Date: 2026-10-17 00:21:37.648215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e2d93f58'
+down_revision = '5b8d2e7f1c64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'client_user_hour',
+        sa.Column('hour', sa.TIMESTAMP(timezone=False), nullable=False),
+        sa.Column('auth_client_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['auth_client_id'], ['auth_client.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('hour', 'auth_client_id', 'user_id'),
+    )
+    op.create_table(
+        'client_user_day',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('auth_client_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['auth_client_id'], ['auth_client.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('day', 'auth_client_id', 'user_id'),
+    )
+    op.create_table(
+        'user_signup_month',
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('month'),
+    )
+    op.create_table(
+        'rollup_watermark',
+        sa.Column('name', sa.Unicode(length=80), nullable=False),
+        sa.Column('folded_at', sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+    op.create_index(
+        op.f('ix_user_session_accessed_at'),
+        'user_session',
+        ['accessed_at'],
+        unique=False,
+    )
+    op.create_index(
+        'ix_auth_client_user_session_accessed_at',
+        'auth_client_user_session',
+        ['accessed_at'],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        'ix_auth_client_user_session_accessed_at',
+        table_name='auth_client_user_session',
+    )
+    op.drop_index(op.f('ix_user_session_accessed_at'), table_name='user_session')
+    op.drop_table('rollup_watermark')
+    op.drop_table('user_signup_month')
+    op.drop_table('client_user_day')
+    op.drop_table('client_user_hour')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""User autocomplete tokens
+
+Revision ID: db4303686563
+Revises: 1e209909b3e7
+Create Date: 2026-10-16 21:10:37.502916
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'db4303686563'
+down_revision = '1e209909b3e7'
+branch_labels = None
+depends_on = None
+
+
+# (kind, rank, select for user_id and token)
+backfill = [
+    ('buid', 0, 'SELECT id, buid FROM "user"'),
+    (
+        'fullname',
+        2,
+        'SELECT id, lower(trim(fullname)) FROM "user" WHERE trim(fullname) != \'\'',
+    ),
+    (
+        'word',
+        3,
+        'SELECT DISTINCT "user".id, words.word FROM "user", '
+        'regexp_split_to_table(lower(trim(fullname)), \'\\s+\') '
+        'WITH ORDINALITY AS words(word, n) WHERE words.n > 1 AND words.word != \'\'',
+    ),
+    (
+        'username',
+        1,
+        'SELECT user_id, lower(name) FROM account_name WHERE user_id IS NOT NULL',
+    ),
+    (
+        'email',
+        0,
+        'SELECT DISTINCT user_id, lower(email) FROM user_email '
+        'WHERE user_id IS NOT NULL',
+    ),
+]
+
+
+def upgrade():
+    op.create_table(
+        'user_autocomplete',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.Unicode(length=80), nullable=False),
+        sa.Column('token', sa.UnicodeText(), nullable=False),
+        sa.Column('rank', sa.SmallInteger(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'kind', 'token'),
+    )
+    op.create_index(
+        'ix_user_autocomplete_token',
+        'user_autocomplete',
+        ['token'],
+        unique=False,
+        postgresql_ops={'token': 'text_pattern_ops'},
+    )
+
+    for kind, rank, select in backfill:
+        op.execute(
+            sa.text(
+                'INSERT INTO user_autocomplete (user_id, kind, token, rank) '
+                'SELECT tokens.user_id, :kind, tokens.token, :rank '
+                'FROM ({select}) AS tokens(user_id, token)'.format(select=select)
+            ).bindparams(kind=kind, rank=rank)
+        )
+    op.execute(
+        sa.text(
+            'INSERT INTO user_autocomplete (user_id, kind, token, rank) '
+            'SELECT DISTINCT user_id, \'@\' || service, lower(username), 0 '
+            'FROM user_externalid WHERE username IS NOT NULL'
+        )
+    )
+
+
+def downgrade():
+    op.drop_index('ix_user_autocomplete_token', table_name='user_autocomplete')
+    op.drop_table('user_autocomplete')
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Parsed user agent for user sessions
+
+Revision ID: e83b5d1f2a97
+Revises: c4a7e2d93f58
+Create Date: 2026-10-17 01:12:05.371942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e83b5d1f2a97'
+down_revision = 'c4a7e2d93f58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Filled for existing sessions by `./manage.py useragents`
+    op.add_column(
+        'user_session', sa.Column('ua_browser', sa.Unicode(length=80), nullable=True)
+    )
+    op.add_column(
+        'user_session',
+        sa.Column('ua_browser_version', sa.Unicode(length=20), nullable=True),
+    )
+    op.add_column(
+        'user_session', sa.Column('ua_os', sa.Unicode(length=80), nullable=True)
+    )
+    op.add_column(
+        'user_session', sa.Column('ua_os_version', sa.Unicode(length=20), nullable=True)
+    )
+    op.add_column(
+        'user_session', sa.Column('ua_device', sa.Unicode(length=80), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column('user_session', 'ua_device')
+    op.drop_column('user_session', 'ua_os_version')
+    op.drop_column('user_session', 'ua_os')
+    op.drop_column('user_session', 'ua_browser_version')
+    op.drop_column('user_session', 'ua_browser')
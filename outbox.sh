@@ -0,0 +1,3 @@
+#!/bin/bash
+
+./manage.py outbox --loop
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from coaster.utils import utcnow
+from lastuser_core.activity import ActivityTracker
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestActivityTracker(TestDatabaseFixture):
+    def setUp(self):
+        super(TestActivityTracker, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        # Flush in the test instead of in a background thread
+        self.app.config['ACTIVITY_FLUSH_INTERVAL'] = 0
+        self.addCleanup(self.app.config.pop, 'ACTIVITY_FLUSH_INTERVAL', None)
+        self.tracker = ActivityTracker()
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestActivityTracker, self).tearDown()
+
+    def test_activitytracker_credential(self):
+        """Test that credential use is buffered and saved on flush"""
+        credential, secret = models.AuthClientCredential.new(self.fixtures.auth_client)
+        db.session.commit()
+        self.assertIsNone(credential.accessed_at)
+        self.tracker.credential_accessed(credential)
+        db.session.expire(credential)
+        self.assertIsNone(credential.accessed_at)
+        self.assertEqual(self.tracker.flush(), 1)
+        db.session.expire(credential)
+        self.assertIsNotNone(credential.accessed_at)
+        # Nothing is pending after a flush
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_activitytracker_window(self):
+        """Test that rows saved within the window are skipped"""
+        credential, secret = models.AuthClientCredential.new(self.fixtures.auth_client)
+        credential.accessed_at = utcnow()
+        db.session.commit()
+        self.tracker.credential_accessed(credential)
+        self.assertEqual(self.tracker.flush(), 0)
+
+        credential.accessed_at = utcnow() - timedelta(days=1)
+        db.session.commit()
+        self.tracker.credential_accessed(credential)
+        self.tracker.credential_accessed(credential)
+        self.assertEqual(self.tracker.flush(), 1)
+        # The second flush in the window is skipped even though the row is stale
+        # in this session
+        self.tracker.credential_accessed(credential)
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_activitytracker_flush_failed(self):
+        """Test that timestamps from a failed flush are kept for the next flush"""
+        credential, secret = models.AuthClientCredential.new(self.fixtures.auth_client)
+        db.session.commit()
+        self.tracker.credential_accessed(credential)
+        table = models.AuthClientCredential.__table__
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        try:
+            # Another transaction holds the row, so the flush times out
+            connection.execute(
+                db.select([table.c.id])
+                .where(table.c.id == credential.id)
+                .with_for_update()
+            )
+            with self.assertRaises(SQLAlchemyError):
+                self.tracker.flush()
+        finally:
+            transaction.rollback()
+            connection.close()
+        self.assertEqual(self.tracker.flush(), 1)
+        db.session.expire(credential)
+        self.assertIsNotNone(credential.accessed_at)
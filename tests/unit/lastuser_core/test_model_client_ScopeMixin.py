@@ -71,3 +71,15 @@ class TestScopeMixin(TestDatabaseFixture):
         db.session.add_all([neville, neville_token])
         neville_token.add_scope(scope2)
         self.assertEqual(neville_token.scope, (scope2, scope1))
+
+    def test_scopemixin_compiled_scope(self):
+        """Test that compiled scope is a frozenset shared between equal scopes"""
+        scope = ['id', 'email', 'phone']
+        auth_client = self.fixtures.auth_client
+        token1 = models.AuthToken(auth_client=auth_client, validity=0, scope=scope)
+        token2 = models.AuthToken(auth_client=auth_client, validity=0, scope=scope)
+        self.assertEqual(token1.compiled_scope, frozenset(scope))
+        self.assertIs(token1.compiled_scope, token2.compiled_scope)
+        self.assertEqual(
+            token1.compiled_effective_scope, frozenset(token1.effective_scope)
+        )
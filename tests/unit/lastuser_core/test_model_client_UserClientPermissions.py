@@ -29,6 +29,9 @@ class TestUserClientPermissions(TestDatabaseFixture):
         # scenario 1: when *only* olduser has UserClientPermissions instance
         old_crusoe = self.fixtures.crusoe
         new_crusoe = models.User(username='chef-crusoe')
+        # Permissions are moved in bulk, so both users must be saved
+        db.session.add(new_crusoe)
+        db.session.commit()
         models.AuthClientUserPermissions.migrate_user(old_crusoe, new_crusoe)
         for each in new_crusoe.client_permissions:
             self.assertIsInstance(each, models.AuthClientUserPermissions)
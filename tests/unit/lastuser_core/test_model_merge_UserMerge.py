@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from coaster.utils import utcnow
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestUserMerge(TestDatabaseFixture):
+    def test_usermerge_run(self):
+        """
+        Test that a merge run in small chunks moves all rows and completes
+        """
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        bathound = models.User(username="bathound", fullname="Bathound")
+        self.fixtures.dachshunds.users.append(bathound)
+        token = models.AuthToken(auth_client=auth_client, user=bathound, scope=['id'])
+        db.session.add_all([bathound, token])
+        db.session.commit()
+        user_merge = models.UserMerge.start(bathound, crusoe)
+        db.session.commit()
+        self.assertEqual(user_merge.keep_user, crusoe)
+        self.assertEqual(user_merge.merge_user, bathound)
+        self.assertEqual(user_merge.progress, 0)
+        # An unfinished merge of the same accounts is resumed, not repeated
+        self.assertEqual(models.UserMerge.start(crusoe, bathound), user_merge)
+
+        user_merge.run(limit=1)
+        self.assertTrue(user_merge.is_complete)
+        self.assertEqual(user_merge.progress, 1)
+        self.assertEqual(user_merge.step, user_merge.steps)
+        self.assertEqual(bathound.status, models.USER_STATUS.MERGED)
+        self.assertIn(crusoe, self.fixtures.dachshunds.users)
+        self.assertEqual(token.user, crusoe)
+        self.assertEqual(models.User.autocomplete('bathound'), [])
+        self.assertEqual(models.User.autocomplete('crusoe'), [crusoe])
+        # Completed merges are not run again
+        user_merge.run()
+        self.assertEqual(models.UserOldId.query.filter_by(user=crusoe).count(), 1)
+
+    def test_usermerge_tokens_chunked(self):
+        """
+        Test that tokens are moved in chunks, merging scopes, and are counted
+        """
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        bathound = models.User(username="bathound", fullname="Bathound")
+        crusoe_token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope=['id']
+        )
+        bathound_token = models.AuthToken(
+            auth_client=auth_client, user=bathound, scope=['email']
+        )
+        db.session.add_all([bathound, crusoe_token, bathound_token])
+        db.session.commit()
+        self.assertEqual(models.AuthToken.migrate_user(bathound, crusoe, limit=1), 1)
+        self.assertEqual(models.AuthToken.migrate_user(bathound, crusoe, limit=1), 0)
+        db.session.commit()
+        self.assertEqual(models.AuthToken.query.filter_by(user=bathound).count(), 0)
+        db.session.refresh(crusoe_token)
+        self.assertEqual(set(crusoe_token.scope), {'id', 'email'})
+
+        user_merge = models.UserMerge.start(bathound, crusoe)
+        db.session.commit()
+        user_merge.run(limit=1)
+        self.assertTrue(user_merge.is_complete)
+
+    def test_usermerge_needs_worker(self):
+        """Test that new, failed and stalled merges are queued again"""
+        crusoe = self.fixtures.crusoe
+        bathound = models.User(username="bathound", fullname="Bathound")
+        db.session.add(bathound)
+        db.session.commit()
+        user_merge = models.UserMerge.start(bathound, crusoe)
+        self.assertTrue(user_merge.needs_worker(600))
+        db.session.commit()
+        # Queued, and a worker has not stalled yet
+        self.assertFalse(user_merge.needs_worker(600))
+        user_merge.status = models.MERGE_STATUS.RUNNING
+        user_merge.updated_at = utcnow() - timedelta(minutes=11)
+        db.session.commit()
+        self.assertTrue(user_merge.needs_worker(600))
+        user_merge.fail("Error")
+        db.session.commit()
+        self.assertTrue(user_merge.needs_worker(600))
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from coaster.utils import utcnow
+from lastuser_core.models import rollup
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestRollups(TestDatabaseFixture):
+    def setUp(self):
+        super(TestRollups, self).setUp()
+        # Fold signups up to now, so that users created by the test are counted
+        self.addCleanup(setattr, rollup, 'ROLLUP_OVERLAP', rollup.ROLLUP_OVERLAP)
+        rollup.ROLLUP_OVERLAP = timedelta(0)
+
+    def signups(self):
+        return sum(count for month, count in models.rollup_users_by_month())
+
+    def test_fold_rollups(self):
+        """
+        Test that folded activity is counted once per user in every interval
+        """
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        for ipaddr in ('192.168.1.1', '192.168.1.2'):
+            user_session = models.UserSession(
+                user=crusoe, ipaddr=ipaddr, user_agent='', accessed_at=utcnow()
+            )
+            user_session.auth_clients.append(auth_client)
+            db.session.add(user_session)
+        db.session.commit()
+
+        models.fold_rollups()
+        # Folding again is harmless
+        models.fold_rollups()
+        db.session.commit()
+
+        rows = models.rollup_client_users()
+        self.assertEqual([row.auth_client_id for row in rows], [auth_client.id])
+        for label in ('hour', 'day', 'week', 'month', 'quarter', 'halfyear', 'year'):
+            self.assertEqual(getattr(rows[0], label), 1)
+        self.assertEqual(self.signups(), models.User.active_user_count())
+
+    def test_fold_rollups_signups(self):
+        """Test that signups are counted once, and corrected on status changes"""
+        models.fold_rollups()
+        db.session.commit()
+        active = models.User.active_user_count()
+        self.assertEqual(self.signups(), active)
+
+        # Only users created since the last fold are added
+        piglet = models.User(username='piglet', fullname="Piglet")
+        db.session.add(piglet)
+        db.session.commit()
+        models.fold_rollups()
+        db.session.commit()
+        self.assertEqual(self.signups(), active + 1)
+
+        crusoe = self.fixtures.crusoe
+        crusoe.status = models.USER_STATUS.SUSPENDED
+        db.session.commit()
+        self.assertEqual(self.signups(), active)
+        crusoe.status = models.USER_STATUS.ACTIVE
+        db.session.commit()
+        self.assertEqual(self.signups(), active + 1)
+        models.fold_rollups()
+        db.session.commit()
+        self.assertEqual(self.signups(), models.User.active_user_count())
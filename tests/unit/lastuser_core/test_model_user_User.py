@@ -350,6 +350,28 @@ class TestUser(TestDatabaseFixture):
         query_for_crusoe = models.User.autocomplete(queries[2])
         self.assertCountEqual(query_for_crusoe, [crusoe])
 
+    def test_user_autocomplete_ranked(self):
+        """
+        Test that autocomplete lists each user once, ranked by the kind of match,
+        and follows changes to names and email addresses
+        """
+        arya = models.User(username='aryastark', fullname="Arya Stark")
+        sansa = models.User(username='stark', fullname="Stark Sansa")
+        db.session.add_all([arya, sansa])
+        db.session.commit()
+        # Username match first, then fullname match for the same user is not
+        # repeated, then a match on a later word in the fullname
+        self.assertEqual(models.User.autocomplete('stark'), [sansa, arya])
+        self.assertEqual(models.User.autocomplete('Stark', limit=1), [sansa])
+        self.assertEqual(models.User.autocomplete(arya.buid), [arya])
+
+        arya.fullname = "No One"
+        db.session.add(models.UserEmail(email='arya@winterfell.north', user=arya))
+        db.session.commit()
+        self.assertEqual(models.User.autocomplete('stark'), [sansa])
+        self.assertEqual(models.User.autocomplete('no one'), [arya])
+        self.assertEqual(models.User.autocomplete('arya@winter'), [arya])
+
     def test_user_merged_user(self):
         """
         Test for checking if user had a old id
@@ -370,6 +392,29 @@ class TestUser(TestDatabaseFixture):
         self.assertIsInstance(merged_user.oldids, InstrumentedList)
         self.assertCountEqual(crusoe.oldids, merged_user.oldids)
 
+    def test_user_merged_user_chain(self):
+        """
+        Test that an account merged twice resolves to the live account in one hop
+        """
+        tweedledum = models.User(username='tweedledum')
+        db.session.add(tweedledum)
+        db.session.commit()
+        tweedledee = models.User(username='tweedledee')
+        db.session.add(tweedledee)
+        db.session.commit()
+        humpty = models.User(username='humpty')
+        db.session.add(humpty)
+        db.session.commit()
+        models.merge_users(tweedledee, humpty)
+        models.merge_users(tweedledum, tweedledee)
+        self.assertEqual(humpty.oldid.user, tweedledum)
+        self.assertEqual(humpty.merged_user(), tweedledum)
+        self.assertEqual(models.User.get(buid=humpty.buid), tweedledum)
+        self.assertEqual(models.User.all(buids=[humpty.buid]), [tweedledum])
+        self.assertCountEqual(
+            [oldid.olduser for oldid in tweedledum.oldids], [tweedledee, humpty]
+        )
+
     def test_user_get(self):
         """
         Test for User's get method
@@ -38,6 +38,52 @@ class TestModels(TestDatabaseFixture):
         self.assertEqual(tyrion.status, 0)
         self.assertEqual(subramanian.status, 2)
 
+    def test_merge_users_rows(self):
+        """
+        Test that merging moves team memberships and combines token scopes
+        """
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        dachshunds = self.fixtures.dachshunds
+        bathound = models.User(username="bathound", fullname="Bathound")
+        dachshunds.users.append(bathound)
+        crusoe_token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope=['id', 'email']
+        )
+        bathound_token = models.AuthToken(
+            auth_client=auth_client, user=bathound, scope=['id', 'phone']
+        )
+        db.session.add_all([bathound, crusoe_token, bathound_token])
+        db.session.commit()
+        crusoe_token_id = crusoe_token.id
+
+        merged = models.merge_users(crusoe, bathound)
+        self.assertEqual(merged, crusoe)
+        self.assertIn(crusoe, dachshunds.users)
+        self.assertNotIn(bathound, dachshunds.users)
+        tokens = models.AuthToken.query.filter_by(auth_client=auth_client).all()
+        self.assertEqual([token.id for token in tokens], [crusoe_token_id])
+        self.assertEqual(tokens[0].scope, ('email', 'id', 'phone'))
+        self.assertEqual(
+            models.UserOldId.query.filter_by(user=crusoe).one().id, bathound.uuid
+        )
+
+    def test_merge_users_autocomplete(self):
+        """
+        Test that the kept account is not matched by the merged account's names
+        """
+        crusoe = self.fixtures.crusoe
+        bathound = models.User(username="bathound", fullname="Bathound Baskerville")
+        db.session.add(bathound)
+        db.session.commit()
+        self.assertEqual(models.User.autocomplete('baskerville'), [bathound])
+
+        merged = models.merge_users(crusoe, bathound)
+        self.assertEqual(merged, crusoe)
+        self.assertEqual(models.User.autocomplete('bathound'), [])
+        self.assertEqual(models.User.autocomplete('baskerville'), [])
+        self.assertEqual(models.User.autocomplete('crusoe'), [crusoe])
+
     def test_getuser(self):
         """
         Test for retrieving username by prepending @
@@ -99,6 +145,65 @@ class TestModels(TestDatabaseFixture):
         result6 = models.getuser('cersei@thelannisters.co.uk')
         self.assertIsNone(result6)
 
+    def test_getuser_many(self):
+        """
+        Test for resolving multiple names in bulk
+        """
+        crusoe = self.fixtures.crusoe
+        externalid = models.UserExternalId(
+            service='twitter',
+            user=crusoe,
+            userid=crusoe.email.email,
+            username=crusoe.username,
+            oauth_token=environ.get('TWITTER_OAUTH_TOKEN'),
+            oauth_token_type='Bearer',  # NOQA: S106
+        )
+        j_email = 'jonsnow@nightswatch.co.uk'
+        jonsnow = models.User(username='jonsnow', fullname="Jon Snow")
+        jonsnow_email_claimed = models.UserEmailClaim(email=j_email, user=jonsnow)
+        arya = models.User(username='arya', fullname="Arya Stark")
+        db.session.add_all([externalid, jonsnow, jonsnow_email_claimed, arya])
+        db.session.commit()
+
+        names = [
+            '@crusoe',
+            j_email.upper(),
+            'arya',
+            'cersei@thelannisters.co.uk',
+            '@unknown',
+            crusoe.email.email,
+        ]
+        result = models.getuser_many(names)
+        self.assertEqual(
+            list(result.items()),
+            [
+                ('@crusoe', crusoe),
+                (j_email.upper(), jonsnow),
+                ('arya', arya),
+                (crusoe.email.email, crusoe),
+            ],
+        )
+        self.assertEqual(
+            result, {name: models.getuser(name) for name in names if name in result}
+        )
+
+    def test_getuser_many_inactive_email(self):
+        """
+        Test that an email address of an inactive user falls back to a claim, as in
+        getuser
+        """
+        email = 'ned@winterfell.co.uk'
+        ned = models.User(
+            username='ned', fullname="Eddard Stark", status=models.USER_STATUS.SUSPENDED
+        )
+        ned_email = models.UserEmail(email=email, user=ned)
+        bran = models.User(username='bran', fullname="Bran Stark")
+        bran_email_claimed = models.UserEmailClaim(email=email, user=bran)
+        db.session.add_all([ned, ned_email, bran, bran_email_claimed])
+        db.session.commit()
+        self.assertEqual(models.getuser(email), bran)
+        self.assertEqual(models.getuser_many([email]), {email: bran})
+
     def test_getextid(self):
         """
         Test for retrieving user given service and userid
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from coaster.utils import utcnow
+from lastuser_core.outbox import OutboxDispatcher
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestOutboxDispatcher(TestDatabaseFixture):
+    def setUp(self):
+        super(TestOutboxDispatcher, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.outbox = OutboxDispatcher()
+        self.dispatched = []
+
+        @self.outbox.handler('test')
+        def handler(value):
+            if value == 'fail' and not self.dispatched.count('retry'):
+                self.dispatched.append('retry')
+                raise ValueError("Failed")
+            self.dispatched.append(value)
+
+    def tearDown(self):
+        models.OutboxMessage.query.delete()
+        db.session.commit()
+        self.ctx.pop()
+        super(TestOutboxDispatcher, self).tearDown()
+
+    def test_outboxdispatcher_transaction(self):
+        """Test that only committed messages are dispatched"""
+        self.outbox.add('test', value='rolledback')
+        db.session.rollback()
+        self.outbox.add('test', value='committed')
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 1)
+        self.assertEqual(self.dispatched, ['committed'])
+        self.assertEqual(models.OutboxMessage.query.count(), 0)
+        self.assertEqual(self.outbox.drain(), 0)
+
+    def test_outboxdispatcher_order(self):
+        """
+        Test that a failure holds back later messages with its key, which are
+        dispatched in order once it is due again, and not messages with other keys
+        """
+        for value, key in (
+            ('first', 'crusoe'),
+            ('fail', 'crusoe'),
+            ('last', 'crusoe'),
+            ('other', 'oakley'),
+            ('unordered', None),
+        ):
+            self.outbox.add('test', ordering_key=key, value=value)
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 3)
+        self.assertEqual(self.dispatched, ['first', 'retry', 'other', 'unordered'])
+        message = models.OutboxMessage.query.order_by(models.OutboxMessage.id).first()
+        self.assertEqual(message.attempts, 1)
+        self.assertIn('Failed', message.error)
+        self.assertGreater(message.next_attempt_at, utcnow())
+        # The failed message and the message it holds back wait for the backoff
+        self.outbox.add('test', ordering_key='crusoe', value='later')
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 0)
+        self.assertEqual(self.dispatched, ['first', 'retry', 'other', 'unordered'])
+        message.next_attempt_at = utcnow()
+        db.session.commit()
+        self.assertEqual(self.outbox.drain(), 3)
+        self.assertEqual(
+            self.dispatched,
+            ['first', 'retry', 'other', 'unordered', 'fail', 'last', 'later'],
+        )
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+from werkzeug.security import generate_password_hash
+
+import bcrypt
+
+from lastuser_core.passwords import (
+    PasswordCheckBusy,
+    PasswordChecker,
+    hash_cost,
+    needs_rehash,
+)
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestPasswordChecker(TestDatabaseFixture):
+    def setUp(self):
+        super(TestPasswordChecker, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.checker = PasswordChecker()
+
+    def tearDown(self):
+        self.app.config.pop('PASSWORD_BCRYPT_ROUNDS', None)
+        self.ctx.pop()
+        super(TestPasswordChecker, self).tearDown()
+
+    def test_passwordchecker_check(self):
+        """Test that passwords are checked in the pool"""
+        user = models.User(username='checker', fullname='Checker', password='secret')
+        self.assertTrue(self.checker.check(user, 'secret'))
+        self.assertFalse(self.checker.check(user, 'wrong'))
+        self.assertFalse(self.checker.check(user, ''))
+        self.assertFalse(self.checker.check(models.User(fullname='No password'), 'x'))
+
+    def test_passwordchecker_busy(self):
+        """Test that a saturated pool fails fast with a retry hint"""
+        user = models.User(username='checker', fullname='Checker', password='secret')
+        executor, slots = self.checker._pool()
+        acquired = 0
+        while slots.acquire(blocking=False):
+            acquired += 1
+        self.assertEqual(
+            acquired,
+            self.app.config.get('PASSWORD_CHECK_WORKERS', 4)
+            + self.app.config.get('PASSWORD_CHECK_QUEUE', 16),
+        )
+        with self.assertRaises(PasswordCheckBusy) as cm:
+            self.checker.check(user, 'secret')
+        self.assertEqual(
+            cm.exception.retry_after,
+            self.app.config.get('PASSWORD_CHECK_RETRY_AFTER', 5),
+        )
+        slots.release()
+        self.assertTrue(self.checker.check(user, 'secret'))
+
+    def test_passwordchecker_hash_cost(self):
+        """Test that hash costs and legacy schemes are recognised"""
+        weak = bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode('ascii')
+        self.assertEqual(hash_cost(weak), 4)
+        self.assertIsNone(hash_cost(generate_password_hash('secret', 'sha1')))
+        self.assertTrue(needs_rehash(weak, 10))
+        self.assertFalse(needs_rehash(weak, 4))
+        self.assertTrue(needs_rehash(generate_password_hash('secret', 'sha1'), 4))
+
+    def test_passwordchecker_upgrade(self):
+        """Test that legacy and weak hashes are upgraded on a successful check"""
+        self.app.config['PASSWORD_BCRYPT_ROUNDS'] = 5
+        user = models.User(username='checker', fullname='Checker')
+        for legacy in (
+            generate_password_hash('secret', 'sha1'),
+            bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode('ascii'),
+        ):
+            user.pw_hash = legacy
+            self.assertFalse(self.checker.check(user, 'wrong'))
+            self.assertEqual(user.pw_hash, legacy)
+            self.assertTrue(self.checker.check(user, 'secret'))
+            self.assertEqual(hash_cost(user.pw_hash), 5)
+            self.assertTrue(self.checker.check(user, 'secret'))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from lastuser_core.registry import AuthClientRegistry
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestAuthClientRegistry(TestDatabaseFixture):
+    def setUp(self):
+        super(TestAuthClientRegistry, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.registry = AuthClientRegistry()
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestAuthClientRegistry, self).tearDown()
+
+    def test_authclientregistry_get_credential(self):
+        """Test that credentials are found with their client"""
+        auth_client = self.fixtures.auth_client
+        credential, secret = models.AuthClientCredential.new(auth_client)
+        db.session.commit()
+        name = credential.name
+        auth_client_id = auth_client.id
+        db.session.expunge_all()
+
+        result = self.registry.get_credential(name)
+        self.assertIsNotNone(result)
+        self.assertTrue(result.secret_is(secret))
+        self.assertEqual(result.auth_client.id, auth_client_id)
+        self.assertIn(result, db.session)
+        self.assertIsNone(self.registry.get_credential('unknown'))
+
+    def test_authclientregistry_reload(self):
+        """Test that changes are picked up after commit"""
+        auth_client = self.fixtures.auth_client
+        auth_client.namespace = 'com.example.registry'
+        db.session.commit()
+        self.assertEqual(
+            self.registry.get_client(namespace='com.example.registry'), auth_client
+        )
+
+        auth_client.active = False
+        db.session.commit()
+        self.assertIsNone(self.registry.get_client(namespace='com.example.registry'))
+
+        credential, secret = models.AuthClientCredential.new(auth_client)
+        db.session.commit()
+        self.assertIsNotNone(self.registry.get_credential(credential.name))
+        db.session.delete(credential)
+        db.session.commit()
+        self.assertIsNone(self.registry.get_credential(credential.name))
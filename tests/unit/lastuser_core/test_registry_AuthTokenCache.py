@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from baseframe import cache
+from lastuser_core.registry import CachedAuthToken, UnknownAuthToken, authtoken_cache
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestAuthTokenCache(TestDatabaseFixture):
+    def setUp(self):
+        super(TestAuthTokenCache, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        authtoken_cache.clear_local()
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestAuthTokenCache, self).tearDown()
+
+    def test_authtokencache_get(self):
+        """Test that the token cache returns an entry matching the token"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope='id email', validity=0
+        )
+        db.session.add(token)
+        db.session.commit()
+        entry = authtoken_cache.get(token.token)
+        self.assertEqual(entry['id'], token.id)
+        self.assertEqual(entry['user_id'], crusoe.id)
+        self.assertEqual(entry['auth_client_id'], auth_client.id)
+        self.assertEqual(entry['trusted'], auth_client.trusted)
+        self.assertEqual(entry['scope'], frozenset(token.effective_scope))
+        self.assertTrue(authtoken_cache.entry_is_valid(entry))
+
+    def test_authtokencache_unknown(self):
+        """Test that the token cache returns None for an unknown token"""
+        self.assertIsNone(authtoken_cache.get('this-is-not-a-token'))
+
+    def test_cachedauthtoken_deleted(self):
+        """Test that a token deleted after it was cached is treated as unknown"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope='id', validity=0
+        )
+        db.session.add(token)
+        db.session.commit()
+        # Another worker still has the entry in its local cache
+        authtoken = CachedAuthToken(token.token, authtoken_cache.get(token.token))
+        db.session.delete(token)
+        db.session.commit()
+        self.assertEqual(authtoken.compiled_effective_scope, frozenset(['id']))
+        with self.assertRaises(UnknownAuthToken):
+            authtoken.refresh_token
+        self.assertIsNone(authtoken_cache.get(authtoken.token))
+
+    def test_cachedauthtoken_user_client(self):
+        """Test that a cached token's user and client are found without the token"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope='id', validity=0
+        )
+        db.session.add(token)
+        db.session.commit()
+        authtoken = CachedAuthToken(token.token, authtoken_cache.get(token.token))
+        self.assertEqual(authtoken.user, crusoe)
+        self.assertEqual(authtoken.auth_client_id, auth_client.id)
+        self.assertEqual(authtoken.auth_client, auth_client)
+        self.assertNotIn('_authtoken', authtoken.__dict__)
+
+    def test_authtokencache_refresh(self):
+        """Test that a refreshed token is removed from the cache"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope='id', validity=0
+        )
+        db.session.add(token)
+        db.session.commit()
+        oldtoken = token.token
+        self.assertIsNotNone(authtoken_cache.get(oldtoken))
+        token.refresh()
+        db.session.commit()
+        self.assertIsNone(authtoken_cache.get(oldtoken))
+        self.assertIsNotNone(authtoken_cache.get(token.token))
+
+    def test_authtokencache_discard_after_commit(self):
+        """Test that an entry cached before the change commits is discarded"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        token = models.AuthToken(
+            auth_client=auth_client, user=crusoe, scope='id', validity=0
+        )
+        db.session.add(token)
+        db.session.commit()
+        stale = authtoken_cache.get(token.token)
+        token.scope = 'id email'
+        db.session.flush()
+        # Another request caches the old row before this transaction commits
+        cache.set(authtoken_cache._cache_key(token.token), stale)
+        authtoken_cache.clear_local()
+        db.session.commit()
+        self.assertEqual(
+            authtoken_cache.get(token.token)['scope'],
+            frozenset(token.effective_scope),
+        )
@@ -12,3 +12,16 @@ class TestResourceRegistry(TestDatabaseFixture):
         """Test for verifying creation of ResourceRegistry instance"""
         result = registry.ResourceRegistry()
         self.assertIsInstance(result, OrderedDict)
+
+    def test_resourceregistry_wildcard_resources(self):
+        """Test for the wildcard index of ResourceRegistry"""
+        result = registry.ResourceRegistry()
+        for name in ('teams', 'teams/new', 'teams/edit', 'teamsters', 'id'):
+            result[name] = {'name': name, 'trusted': False}
+        self.assertEqual(
+            result.wildcard_resources('teams'), ('teams', 'teams/new', 'teams/edit')
+        )
+        self.assertEqual(result.wildcard_resources('teams/new'), ('teams/new',))
+        self.assertEqual(result.wildcard_resources('unknown'), ())
+        result['teams/delete'] = {'name': 'teams/delete', 'trusted': True}
+        self.assertIn('teams/delete', result.wildcard_resources('teams'))
@@ -18,6 +18,13 @@ class TestUser(TestDatabaseFixture):
         ua = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.110 Safari/537.36'
         another_user_session = models.UserSession(user_agent=ua)
         self.assertIsInstance(another_user_session.ua, dict)
+        # Parsed fields are set with the user agent
+        self.assertEqual(another_user_session.ua_browser, 'Chrome')
+        self.assertEqual(another_user_session.ua_browser_version, '49')
+        self.assertEqual(another_user_session.ua_os, 'Mac OS X')
+        self.assertEqual(another_user_session.ua_os_version, '10.11')
+        self.assertEqual(another_user_session.ua['browser'], 'Chrome')
+        self.assertIs(models.parse_user_agent(ua), models.parse_user_agent(ua))
 
     def test_usersession_has_sudo(self):
         """Test to set sudo and test if UserSession instance has_sudo """
@@ -91,3 +98,31 @@ class TestUser(TestDatabaseFixture):
         result = models.UserSession.authenticate(chandler_buid)
         self.assertIsInstance(result, models.UserSession)
         self.assertEqual(result, chandler_session)
+
+    def test_usersession_authenticate_cached(self):
+        """Test that authenticate uses the cache and forgets revoked sessions"""
+        joey = models.User(username='joey', fullname='Joey Tribbiani')
+        joey_buid = buid()
+        joey_session = models.UserSession(
+            user=joey,
+            ipaddr='192.168.1.5',
+            buid=joey_buid,
+            user_agent='Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/49.0.2623.110 Safari/537.36',
+            accessed_at=utcnow(),
+        )
+        db.session.add_all([joey, joey_session])
+        db.session.commit()
+        with self.app.test_request_context():
+            result = models.UserSession.authenticate(joey_buid)
+            self.assertEqual(result, joey_session)
+            expected = (joey_session.id, joey.id, joey_session.sudo_enabled_at)
+            # A cached session is returned without a query, with the same data
+            db.session.expunge_all()
+            cached = models.UserSession.authenticate(joey_buid)
+            self.assertEqual(
+                (cached.id, cached.user_id, cached.sudo_enabled_at), expected
+            )
+            self.assertIn(cached, db.session)
+            cached.revoke()
+            db.session.commit()
+            self.assertIsNone(models.UserSession.authenticate(joey_buid))
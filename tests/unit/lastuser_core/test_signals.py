@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+from lastuser_core import signals
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestModelSignals(TestDatabaseFixture):
+    def setUp(self):
+        super(TestModelSignals, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.sent = []
+        self.batches = []
+        signals.model_team_edited.connect(self._receiver)
+        signals.connect_batch(signals.model_team_edited)(self._batch_receiver)
+
+    def tearDown(self):
+        signals.model_team_edited.disconnect(self._receiver)
+        signals.batch_receivers[signals.model_team_edited].remove(self._batch_receiver)
+        self.ctx.pop()
+        super(TestModelSignals, self).tearDown()
+
+    def _receiver(self, target):
+        self.sent.append(target)
+
+    def _batch_receiver(self, targets):
+        self.batches.append(targets)
+
+    def test_signals_sent_after_commit(self):
+        """Test that model signals are sent once per object after commit"""
+        dachshunds = self.fixtures.dachshunds
+        dachshunds.title = "Dachshunds of Hasgeek"
+        db.session.flush()
+        dachshunds.title = "Dachshunds"
+        db.session.flush()
+        # Nothing is sent during the transaction
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.batches, [])
+        db.session.commit()
+        self.assertEqual(self.sent, [dachshunds])
+        self.assertEqual(self.batches, [[dachshunds]])
+
+    def test_signals_discarded_on_rollback(self):
+        """Test that model signals are not sent when the transaction rolls back"""
+        self.fixtures.dachshunds.title = "Dachshunds of Hasgeek"
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.batches, [])
+
+    def test_signals_sent_by_flushing_session(self):
+        """Test that model signals are sent when the session that flushed commits"""
+        other = db.session.session_factory()
+        team = other.query(models.Team).get(self.fixtures.dachshunds.id)
+        try:
+            team.title = "Dachshunds of Hasgeek"
+            other.flush()
+            # Another session's transaction does not carry the change
+            db.session.commit()
+            self.assertEqual(self.sent, [])
+            other.commit()
+            self.assertEqual(self.sent, [team])
+        finally:
+            team.title = "Dachshunds"
+            other.commit()
+            other.close()
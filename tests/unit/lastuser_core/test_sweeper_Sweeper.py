@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from coaster.utils import utcnow
+from lastuser_core.sweeper import Sweeper, sweeper
+from lastuserapp import db
+import lastuser_core.models as models
+
+from .test_db import TestDatabaseFixture
+
+
+class TestSweeper(TestDatabaseFixture):
+    def setUp(self):
+        super(TestSweeper, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.app.config['SWEEP_BATCH_SIZE'] = 2
+        self.app.config['SWEEP_PAUSE'] = 0
+
+    def tearDown(self):
+        for key in ('SWEEP_BATCH_SIZE', 'SWEEP_PAUSE', 'SWEEP_RETENTION'):
+            self.app.config.pop(key, None)
+        self.ctx.pop()
+        super(TestSweeper, self).tearDown()
+
+    def test_sweeper_batches(self):
+        """Test that rows past retention are removed in batches, and others kept"""
+        old = utcnow() - timedelta(days=100)
+        messages = [
+            models.SMSMessage(
+                phone_number='+919999999999',
+                message='Message {index}'.format(index=index),
+                created_at=old if index < 5 else utcnow(),
+            )
+            for index in range(7)
+        ]
+        db.session.add_all(messages)
+        db.session.commit()
+        kept_ids = {message.id for message in messages[5:]}
+
+        self.assertEqual(sweeper.sweep(['sms_message']), {'sms_message': 5})
+        self.assertEqual(
+            {message.id for message in models.SMSMessage.query.all()} & kept_ids,
+            kept_ids,
+        )
+        self.assertEqual(sweeper.sweep(['sms_message']), {'sms_message': 0})
+
+    def test_sweeper_dependents(self):
+        """Test that revoked sessions are removed with the tokens issued in them"""
+        crusoe = self.fixtures.crusoe
+        auth_client = self.fixtures.auth_client
+        user_session = models.UserSession(
+            user=crusoe, ipaddr='', user_agent='', accessed_at=utcnow()
+        )
+        user_session.auth_clients.append(auth_client)
+        token = models.AuthToken(
+            auth_client=auth_client,
+            user=crusoe,
+            scope=['id'],
+            user_session=user_session,
+        )
+        db.session.add_all([user_session, token])
+        db.session.commit()
+        self.assertEqual(sweeper.sweep(['user_session']), {'user_session': 0})
+
+        user_session.revoked_at = utcnow() - timedelta(days=31)
+        db.session.commit()
+        session_id = user_session.id
+        token_value = token.token
+        self.assertEqual(sweeper.sweep(['user_session']), {'user_session': 1})
+        db.session.expunge_all()
+        self.assertIsNone(models.UserSession.query.get(session_id))
+        self.assertIsNone(models.AuthToken.get(token_value))
+
+    def test_sweeper_retention(self):
+        """Test that retention can be changed in config"""
+        local_sweeper = Sweeper()
+        local_sweeper.policy(
+            'sms_message',
+            models.SMSMessage,
+            timedelta(days=90),
+            lambda table, cutoff: table.c.created_at < cutoff,
+        )
+        db.session.add(
+            models.SMSMessage(
+                phone_number='+919999999999',
+                message='Recent',
+                created_at=utcnow() - timedelta(hours=2),
+            )
+        )
+        db.session.commit()
+        self.assertEqual(local_sweeper.sweep(), {'sms_message': 0})
+        self.app.config['SWEEP_RETENTION'] = {'sms_message': 3600}
+        self.assertEqual(local_sweeper.sweep(), {'sms_message': 1})
+
+    def test_sweeper_outbox(self):
+        """Test that only outbox messages that were given up are removed"""
+        old = utcnow() - timedelta(days=31)
+        given_up = models.OutboxMessage(
+            kind='test', payload={}, attempts=10, updated_at=old
+        )
+        pending = models.OutboxMessage(
+            kind='test', payload={}, attempts=1, updated_at=old
+        )
+        recent = models.OutboxMessage(kind='test', payload={}, attempts=10)
+        db.session.add_all([given_up, pending, recent])
+        db.session.commit()
+        kept_ids = {pending.id, recent.id}
+        self.assertEqual(sweeper.sweep(['outbox_message']), {'outbox_message': 1})
+        self.assertEqual(
+            {message.id for message in models.OutboxMessage.query.all()}, kept_ids
+        )
+        models.OutboxMessage.query.delete()
+        db.session.commit()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from lastuser_oauth.authcodes import AuthCodeStore, RedisAuthCodeStore
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestAuthCodeStore(TestDatabaseFixture):
+    def setUp(self):
+        super(TestAuthCodeStore, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.user = self.fixtures.crusoe
+        self.auth_client = self.fixtures.auth_client
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestAuthCodeStore, self).tearDown()
+
+    def check_store(self, store):
+        code = store.issue(
+            self.user, None, self.auth_client, ['id', 'email'], 'http://localhost/'
+        )
+        db.session.commit()
+        authcode = store.consume(self.auth_client, code)
+        db.session.commit()
+        self.assertIsNotNone(authcode)
+        self.assertTrue(authcode.is_valid())
+        self.assertEqual(authcode.user, self.user)
+        self.assertIsNone(authcode.user_session)
+        self.assertEqual(authcode.scope, ('email', 'id'))
+        self.assertEqual(authcode.redirect_uri, 'http://localhost/')
+        # Codes can only be used once
+        self.assertIsNone(store.consume(self.auth_client, code))
+
+    def test_authcodestore_sql(self):
+        """Test that the SQL store issues and consumes codes"""
+        self.check_store(AuthCodeStore())
+
+    def test_authcodestore_redis(self):
+        """Test that the Redis store issues and consumes codes without rows"""
+        self.check_store(RedisAuthCodeStore())
+        self.assertEqual(models.AuthCode.query.count(), 0)
+
+    def test_authcodestore_redis_fallback(self):
+        """Test that the Redis store takes codes issued by the SQL store"""
+        code = AuthCodeStore().issue(
+            self.user, None, self.auth_client, ['id'], 'http://localhost/'
+        )
+        db.session.commit()
+        authcode = RedisAuthCodeStore().consume(self.auth_client, code)
+        self.assertIsInstance(authcode, models.AuthCode)
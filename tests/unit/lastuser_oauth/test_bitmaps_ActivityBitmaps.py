@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+
+from coaster.utils import utcnow
+from lastuser_oauth import rq
+from lastuser_oauth.bitmaps import ActivityBitmaps, activity_bitmaps
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestActivityBitmaps(TestDatabaseFixture):
+    def setUp(self):
+        super(TestActivityBitmaps, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.bitmaps = ActivityBitmaps()
+        self.bitmaps.key = 'lastuser/test/activity/'
+        self.today = utcnow().date()
+
+    def tearDown(self):
+        keys = rq.connection.keys(self.bitmaps.key + '*')
+        if keys:
+            rq.connection.delete(*keys)
+        self.ctx.pop()
+        super(TestActivityBitmaps, self).tearDown()
+
+    def test_activitybitmaps_mark(self):
+        """Test that users are marked once per day and counted once"""
+        self.assertTrue(self.bitmaps.mark(1))
+        self.assertFalse(self.bitmaps.mark(1))
+        self.assertTrue(self.bitmaps.mark(1000))
+        self.assertEqual(self.bitmaps.active_users(1), 2)
+        self.bitmaps.backfill(self.today - timedelta(days=3), [1, 2])
+        self.assertEqual(self.bitmaps.active_users(1), 2)
+        self.assertEqual(self.bitmaps.active_users(7), 3)
+
+    def test_activitybitmaps_retention(self):
+        """Test week over week retention"""
+        last_week = self.today - timedelta(weeks=1)
+        self.bitmaps.backfill(last_week - timedelta(days=1), [1, 2, 3, 4])
+        self.bitmaps.backfill(self.today, [2, 4, 5])
+        cohorts = self.bitmaps.retention(2)
+        self.assertEqual(len(cohorts), 2)
+        self.assertEqual(
+            cohorts[-1],
+            {'week': last_week - timedelta(days=6), 'active': 4, 'retained': 2},
+        )
+        self.assertEqual(cohorts[0]['active'], 0)
+
+    def test_activitybitmaps_clear(self):
+        """Test that cleared users are not counted on any day"""
+        self.bitmaps.backfill(self.today - timedelta(days=3), [1, 2])
+        self.bitmaps.backfill(self.today, [2, 3])
+        self.bitmaps.clear([2])
+        self.assertEqual(self.bitmaps.active_users(1), 1)
+        self.assertEqual(self.bitmaps.active_users(7), 2)
+        # Days without activity are not created
+        self.assertFalse(
+            rq.connection.exists(self.bitmaps.day_key(self.today - timedelta(days=1)))
+        )
+
+    def test_activitybitmaps_suspended(self):
+        """Test that a suspended user is cleared after commit"""
+        piglet = self.fixtures.piglet
+        key = activity_bitmaps.day_key(self.today)
+        activity_bitmaps.backfill(self.today, [piglet.id])
+        piglet.status = models.USER_STATUS.SUSPENDED
+        db.session.flush()
+        self.assertEqual(rq.connection.getbit(key, piglet.id), 1)
+        db.session.commit()
+        self.assertEqual(rq.connection.getbit(key, piglet.id), 0)
+        piglet.status = models.USER_STATUS.ACTIVE
+        db.session.commit()
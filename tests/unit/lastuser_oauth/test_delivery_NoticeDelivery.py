@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from urllib.parse import parse_qs
+import json
+import time
+
+from lastuser_oauth import rq
+from lastuser_oauth.delivery import NoticeDelivery
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Responds with the status code in the request path, and records requests"""
+
+    protocol_version = 'HTTP/1.1'
+    received = []
+
+    def do_POST(self):  # NOQA: N802
+        body = self.rfile.read(int(self.headers['Content-Length'] or 0))
+        if self.headers['Content-Type'] == 'application/json':
+            self.received.append(json.loads(body.decode('utf-8')))
+        else:
+            self.received.append(parse_qs(body.decode('utf-8')))
+        self.send_response(int(self.path.strip('/')))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):  # NOQA: A002
+        pass
+
+
+class TestNoticeDelivery(TestDatabaseFixture):
+    @classmethod
+    def setUpClass(cls):
+        super(TestNoticeDelivery, cls).setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(TestNoticeDelivery, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestNoticeDelivery, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.delivery = NoticeDelivery()
+        self.host = '127.0.0.1:{port}'.format(port=self.server.server_port)
+        StubHandler.received = []
+
+    def tearDown(self):
+        rq.connection.delete(
+            self.delivery.stats_key + self.host, self.delivery.slots_key + self.host
+        )
+        self.ctx.pop()
+        super(TestNoticeDelivery, self).tearDown()
+
+    def url(self, status_code):
+        return 'http://{host}/{status}'.format(host=self.host, status=status_code)
+
+    def test_noticedelivery_outcomes(self):
+        """Test that responses are classified, and retries counted"""
+        self.assertEqual(
+            self.delivery.send(self.url(200), data={'buid': 'abc'}), 'sent'
+        )
+        self.assertEqual(StubHandler.received, [{'buid': ['abc']}])
+        self.assertEqual(self.delivery.send(self.url(503)), 'retry')
+        self.assertEqual(self.delivery.send(self.url(429)), 'retry')
+        self.assertEqual(self.delivery.send(self.url(404)), 'failed')
+        stats = self.delivery.stats(self.host)
+        self.assertEqual(stats['retry'], '2')
+        self.assertEqual(stats['last_outcome'], 'failed')
+        self.assertEqual(stats['last_status'], '404')
+        # Deliveries are counted by the caller, once they are sent or failed
+        self.assertNotIn('sent', stats)
+        self.assertNotIn('failed', stats)
+        # The session is reused for the host
+        self.assertIs(
+            self.delivery.session(self.host), self.delivery.session(self.host)
+        )
+
+    def test_noticedelivery_batch(self):
+        """Test that batches are sent as a JSON array"""
+        batch = [{'buid': 'abc', 'changes': ['profile']}, {'buid': 'def'}]
+        self.assertEqual(self.delivery.send(self.url(200), json=batch), 'sent')
+        self.assertEqual(StubHandler.received, [batch])
+
+    def test_noticedelivery_unreachable(self):
+        """Test that connection errors are retried"""
+        closed = HTTPServer(('127.0.0.1', 0), StubHandler)
+        port = closed.server_port
+        closed.server_close()
+        host = '127.0.0.1:{port}'.format(port=port)
+        try:
+            self.assertEqual(
+                self.delivery.send('http://{host}/200'.format(host=host)), 'retry'
+            )
+            self.assertIn('ConnectionError', self.delivery.stats(host)['last_error'])
+        finally:
+            rq.connection.delete(self.delivery.stats_key + host)
+
+    def test_noticedelivery_concurrency(self):
+        """Test that a host at its concurrency limit is deferred"""
+        limit = self.app.config.get('NOTICE_HOST_CONCURRENCY', 4)
+        holders = [self.delivery.acquire(self.host) for slot in range(limit)]
+        self.assertNotIn(None, holders)
+        self.assertEqual(self.delivery.send(self.url(200)), 'deferred')
+        self.assertEqual(StubHandler.received, [])
+        # A busy host is a retry once the notice can't be deferred any more
+        self.assertEqual(self.delivery.send(self.url(200), can_defer=False), 'retry')
+        self.assertEqual(StubHandler.received, [])
+        self.delivery.release(self.host, holders.pop())
+        self.assertEqual(self.delivery.send(self.url(200)), 'sent')
+
+    def test_noticedelivery_slot_expiry(self):
+        """Test that slots left behind by killed workers expire"""
+        limit = self.app.config.get('NOTICE_HOST_CONCURRENCY', 4)
+        rq.connection.zadd(
+            self.delivery.slots_key + self.host,
+            {
+                'killed{slot}'.format(slot=slot): time.time() - 1
+                for slot in range(limit)
+            },
+        )
+        holder = self.delivery.acquire(self.host)
+        self.assertIsNotNone(holder)
+        self.assertEqual(
+            rq.connection.zrange(self.delivery.slots_key + self.host, 0, -1),
+            [holder.encode('utf-8')],
+        )
+        self.delivery.release(self.host, holder)
+        self.assertEqual(rq.connection.zcard(self.delivery.slots_key + self.host), 0)
+
+    def test_noticedelivery_final(self):
+        """Test that the final attempt is failed, and not counted as a retry"""
+        self.assertEqual(self.delivery.send(self.url(503), final=True), 'failed')
+        stats = self.delivery.stats(self.host)
+        self.assertEqual(stats['last_outcome'], 'failed')
+        self.assertNotIn('retry', stats)
+
+    def test_noticedelivery_retry_delay(self):
+        """Test that retry delays grow and are capped"""
+        base = self.app.config.get('NOTICE_RETRY_DELAY', 30)
+        cap = self.app.config.get('NOTICE_RETRY_MAX_DELAY', 3600)
+        for attempt in range(1, 12):
+            delay = self.delivery.retry_delay(attempt).total_seconds()
+            expected = min(base * 2 ** (attempt - 1), cap)
+            self.assertTrue(expected / 2 <= delay <= expected)
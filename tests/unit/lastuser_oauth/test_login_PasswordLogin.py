@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from base64 import b64encode
+import json
+
+from lastuser_core.passwords import password_checker
+from lastuser_oauth.forms import LoginForm, login as login_forms
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestPasswordLogin(TestDatabaseFixture):
+    def setUp(self):
+        super(TestPasswordLogin, self).setUp()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+        self.app.config.pop('WTF_CSRF_ENABLED', None)
+        super(TestPasswordLogin, self).tearDown()
+
+    def make_user(self, username):
+        user = models.User(username=username, fullname="Login", password='secret')
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def saturate(self):
+        """Take every slot in the password checker's pool until the test ends"""
+        executor, slots = password_checker._pool()
+        acquired = 0
+        while slots.acquire(blocking=False):
+            acquired += 1
+        for counter in range(acquired):
+            self.addCleanup(slots.release)
+
+    def test_loginform_user_resolved_once(self):
+        """Test that the form looks up the user once for both fields"""
+        user = self.make_user('loginonce')
+        calls = []
+        getuser = login_forms.getuser
+
+        def counting_getuser(name):
+            calls.append(name)
+            return getuser(name)
+
+        login_forms.getuser = counting_getuser
+        self.addCleanup(setattr, login_forms, 'getuser', getuser)
+        with self.app.test_request_context(
+            method='POST', data={'username': 'loginonce', 'password': 'secret'}
+        ):
+            form = LoginForm()
+            self.assertTrue(form.validate())
+            self.assertEqual(form.user, user)
+        self.assertEqual(calls, ['loginonce'])
+
+        calls[:] = []
+        with self.app.test_request_context(
+            method='POST', data={'username': 'loginonce', 'password': 'wrong'}
+        ):
+            form = LoginForm()
+            self.assertFalse(form.validate())
+            self.assertIn('password', form.errors)
+        self.assertEqual(calls, ['loginonce'])
+
+    def test_login_busy(self):
+        """Test that /login answers 503 with Retry-After when the pool is full"""
+        self.make_user('loginbusy')
+        self.saturate()
+        response = self.app.test_client().post(
+            '/login',
+            data={
+                'form.id': 'passwordlogin',
+                'username': 'loginbusy',
+                'password': 'secret',
+            },
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            response.headers['Retry-After'],
+            str(self.app.config.get('PASSWORD_CHECK_RETRY_AFTER', 5)),
+        )
+
+    def test_password_grant_busy(self):
+        """Test that the password grant is temporarily unavailable when busy"""
+        self.make_user('grantbusy')
+        auth_client = self.fixtures.auth_client
+        auth_client.trusted = True
+        credential, secret = models.AuthClientCredential.new(auth_client)
+        db.session.commit()
+        self.saturate()
+        try:
+            response = self.app.test_client().post(
+                '/api/1/token',
+                data={
+                    'grant_type': 'password',
+                    'username': 'grantbusy',
+                    'password': 'secret',
+                    'scope': 'id',
+                },
+                headers={
+                    'Authorization': 'Basic '
+                    + b64encode(
+                        '{name}:{secret}'.format(
+                            name=credential.name, secret=secret
+                        ).encode()
+                    ).decode()
+                },
+            )
+        finally:
+            auth_client.trusted = False
+            db.session.commit()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            json.loads(response.get_data(as_text=True))['error'],
+            'temporarily_unavailable',
+        )
+        self.assertIn('Retry-After', response.headers)
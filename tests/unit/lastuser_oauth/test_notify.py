@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+from http.server import HTTPServer
+from threading import Thread
+
+from lastuser_oauth import rq
+from lastuser_oauth.delivery import notice_delivery
+from lastuser_oauth.views import notify
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+from .test_delivery_NoticeDelivery import StubHandler
+
+
+class NoticeTestCase(TestDatabaseFixture):
+    """Runs jobs by calling them, and inspects the jobs they queue and schedule"""
+
+    url = 'http://127.0.0.1/notify'
+
+    def setUp(self):
+        super(NoticeTestCase, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.clear()
+
+    def tearDown(self):
+        self.clear()
+        for key in ('NOTICE_COALESCE_WINDOW', 'NOTICE_BATCH_SIZE'):
+            self.app.config.pop(key, None)
+        self.ctx.pop()
+        super(NoticeTestCase, self).tearDown()
+
+    def clear(self):
+        # Also removes delivery stats, which are kept under the same prefix
+        rq.get_queue('lastuser').empty()
+        scheduler = rq.get_scheduler()
+        for job in scheduler.get_jobs():
+            scheduler.cancel(job)
+        keys = rq.connection.keys('lastuser/notice/*')
+        if keys:
+            rq.connection.delete(*keys)
+
+    def func_name(self, job):
+        return '{job.__module__}.{job.__name__}'.format(job=job)
+
+    def queued(self, job):
+        return [
+            queued_job
+            for queued_job in rq.get_queue('lastuser').jobs
+            if queued_job.func_name == self.func_name(job)
+        ]
+
+    def scheduled(self, job):
+        return [
+            (scheduled_job, time)
+            for scheduled_job, time in rq.get_scheduler().get_jobs(with_times=True)
+            if scheduled_job.func_name == self.func_name(job)
+        ]
+
+
+class TestUserNotice(NoticeTestCase):
+    def setUp(self):
+        super(TestUserNotice, self).setUp()
+        self.app.config['NOTICE_COALESCE_WINDOW'] = 5
+        self.auth_client_id = self.fixtures.auth_client.id
+
+    def notice(self, user, changes):
+        notify.coalesce_user_notice(
+            self.url, self.auth_client_id, False, user.buid, changes
+        )
+
+    def test_user_notice_coalesced(self):
+        """Test that changes within the window are sent as one notice"""
+        crusoe = self.fixtures.crusoe
+        self.notice(crusoe, ['profile'])
+        self.notice(crusoe, ['email', 'profile'])
+        self.notice(crusoe, ['phone'])
+        scheduled = self.scheduled(notify.send_user_notice)
+        self.assertEqual(len(scheduled), 1)
+        self.assertEqual(self.queued(notify.send_notice), [])
+
+        job = scheduled[0][0]
+        notify.send_user_notice(*job.args, **job.kwargs)
+        (sent,) = self.queued(notify.send_notice)
+        self.assertEqual(sent.args, (self.url,))
+        self.assertEqual(
+            sent.kwargs['data'],
+            notify.user_notice_data(crusoe.buid, ['email', 'phone', 'profile']),
+        )
+        # The next change opens a new window
+        self.notice(crusoe, ['profile'])
+        self.assertEqual(len(self.scheduled(notify.send_user_notice)), 2)
+
+    def test_user_notice_separate_keys(self):
+        """Test that changes for different users or clients are sent separately"""
+        crusoe = self.fixtures.crusoe
+        oakley = self.fixtures.oakley
+        other_client_id = self.auth_client_id + 1
+        self.notice(crusoe, ['profile'])
+        self.notice(oakley, ['email'])
+        notify.coalesce_user_notice(
+            self.url, other_client_id, False, crusoe.buid, ['phone']
+        )
+        scheduled = self.scheduled(notify.send_user_notice)
+        self.assertEqual(len(scheduled), 3)
+        sent = {}
+        for job, time in scheduled:
+            auth_client_id, buid = job.args[1:]
+            notify.send_user_notice(*job.args, **job.kwargs)
+            (notice,) = self.queued(notify.send_notice)
+            sent[(auth_client_id, buid)] = notice.kwargs['data']['changes']
+            rq.get_queue('lastuser').empty()
+        self.assertEqual(
+            sent,
+            {
+                (self.auth_client_id, crusoe.buid): ['profile'],
+                (self.auth_client_id, oakley.buid): ['email'],
+                (other_client_id, crusoe.buid): ['phone'],
+            },
+        )
+
+    def test_user_notice_no_window(self):
+        """Test that a window of 0 sends each change right away"""
+        self.app.config['NOTICE_COALESCE_WINDOW'] = 0
+        crusoe = self.fixtures.crusoe
+        self.notice(crusoe, ['profile'])
+        self.notice(crusoe, ['email'])
+        self.assertEqual(self.scheduled(notify.send_user_notice), [])
+        self.assertEqual(len(self.queued(notify.send_notice)), 2)
+
+
+class TestNoticeBatch(NoticeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestNoticeBatch, cls).setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(TestNoticeBatch, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestNoticeBatch, self).setUp()
+        self.app.config['NOTICE_BATCH_SIZE'] = 3
+        self.auth_client_id = self.fixtures.auth_client.id
+        self.batch_key = notify.notice_batch_key.format(
+            auth_client_id=self.auth_client_id
+        )
+        self.host = '127.0.0.1:{port}'.format(port=self.server.server_port)
+        self.url = 'http://{host}/200'.format(host=self.host)
+        StubHandler.received = []
+
+    def notice(self, number):
+        notify.queue_notice(self.url, self.auth_client_id, {'number': number})
+
+    def flush(self, job):
+        notify.send_notice_batch(*job.args, **job.kwargs)
+        (sent,) = self.queued(notify.send_notice)
+        rq.get_queue('lastuser').empty()
+        return sent
+
+    def test_notice_batch_size(self):
+        """Test that a full batch is sent right away"""
+        self.notice(0)
+        self.notice(1)
+        self.assertEqual(self.queued(notify.send_notice_batch), [])
+        self.assertEqual(len(self.scheduled(notify.send_notice_batch)), 1)
+        self.notice(2)
+        (job,) = self.queued(notify.send_notice_batch)
+        sent = self.flush(job)
+        self.assertEqual(
+            sent.kwargs['json'], [{'number': 0}, {'number': 1}, {'number': 2}]
+        )
+        self.assertEqual(rq.connection.llen(self.batch_key), 0)
+
+    def test_notice_batch_interval(self):
+        """Test that a partial batch is sent by the job scheduled for the interval"""
+        self.notice(0)
+        self.notice(1)
+        (scheduled,) = self.scheduled(notify.send_notice_batch)
+        self.assertEqual(self.queued(notify.send_notice_batch), [])
+        sent = self.flush(scheduled[0])
+        self.assertEqual(sent.kwargs['json'], [{'number': 0}, {'number': 1}])
+        # The next notice schedules another batch
+        self.notice(2)
+        self.assertEqual(len(self.scheduled(notify.send_notice_batch)), 2)
+
+    def test_notice_batch_post(self):
+        """Test that each batch is sent in a single POST of a JSON array"""
+        for number in range(4):
+            self.notice(number)
+        (job,) = self.queued(notify.send_notice_batch)
+        sent = self.flush(job)
+        self.assertEqual(notify.send_notice(*sent.args, **sent.kwargs), 'sent')
+        self.assertEqual(
+            StubHandler.received, [[{'number': 0}, {'number': 1}, {'number': 2}]]
+        )
+        # The notice that did not fit is left for the next batch
+        self.assertEqual(rq.connection.llen(self.batch_key), 1)
+
+
+class TestSendNotice(NoticeTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(TestSendNotice, cls).setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        cls.thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(TestSendNotice, cls).tearDownClass()
+
+    def setUp(self):
+        super(TestSendNotice, self).setUp()
+        self.host = '127.0.0.1:{port}'.format(port=self.server.server_port)
+        StubHandler.received = []
+
+    def url(self, status_code):
+        return 'http://{host}/{status}'.format(host=self.host, status=status_code)
+
+    def rescheduled(self):
+        """Take the retry that send_notice scheduled, and return its kwargs"""
+        ((job, time),) = self.scheduled(notify.send_notice)
+        rq.get_scheduler().cancel(job)
+        return job.kwargs
+
+    def test_send_notice_retried(self):
+        """Test that a notice retried until it is sent is counted once"""
+        self.assertEqual(notify.send_notice(self.url(503), data={'n': 1}), 'retry')
+        retry = self.rescheduled()
+        self.assertEqual(retry['attempt'], 1)
+        self.assertEqual(notify.send_notice(self.url(503), **retry), 'retry')
+        retry = self.rescheduled()
+        self.assertEqual(retry['attempt'], 2)
+        # The client recovers
+        self.assertEqual(notify.send_notice(self.url(200), **retry), 'sent')
+        self.assertEqual(self.scheduled(notify.send_notice), [])
+        stats = notice_delivery.stats(self.host)
+        self.assertEqual(stats['sent'], '1')
+        self.assertEqual(stats['retry'], '2')
+        self.assertNotIn('failed', stats)
+
+    def test_send_notice_failed(self):
+        """Test that a notice that runs out of retries is counted once, as failed"""
+        self.app.config['NOTICE_MAX_ATTEMPTS'] = 2
+        self.addCleanup(self.app.config.pop, 'NOTICE_MAX_ATTEMPTS', None)
+        self.assertEqual(notify.send_notice(self.url(503)), 'retry')
+        retry = self.rescheduled()
+        self.assertEqual(notify.send_notice(self.url(503), **retry), 'failed')
+        self.assertEqual(self.scheduled(notify.send_notice), [])
+        stats = notice_delivery.stats(self.host)
+        self.assertEqual(stats['failed'], '1')
+        self.assertEqual(stats['retry'], '1')
+        self.assertNotIn('sent', stats)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from lastuser_oauth.views import resource
+from lastuser_oauth.views.resource import userinfo_cache
+from lastuserapp import db
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestUserinfoCache(TestDatabaseFixture):
+    def setUp(self):
+        super(TestUserinfoCache, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        # Start from a new generation, so that entries from other tests are missed
+        userinfo_cache.invalidate(everything=True)
+        self.crusoe = self.fixtures.crusoe
+        self.oakley = self.fixtures.oakley
+        self.auth_client = self.fixtures.auth_client
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestUserinfoCache, self).tearDown()
+
+    def lookup(self, user, scope=('id',)):
+        ((key, userinfo),) = userinfo_cache.get_many(
+            [(user, self.auth_client, frozenset(scope), True)]
+        )
+        return key, userinfo
+
+    def fill(self, user):
+        key, userinfo = self.lookup(user)
+        self.assertIsNone(userinfo)
+        userinfo_cache.set(key, {'username': user.username})
+
+    def assert_cached(self, user):
+        self.assertEqual(self.lookup(user)[1], {'username': user.username})
+
+    def assert_not_cached(self, user):
+        self.assertIsNone(self.lookup(user)[1])
+
+    def test_userinfocache_hit(self):
+        """Test that a cached entry is found for the same user, client and scope"""
+        self.fill(self.crusoe)
+        self.assert_cached(self.crusoe)
+        self.assertIsNone(self.lookup(self.crusoe, scope=('id', 'email'))[1])
+        self.assert_not_cached(self.oakley)
+
+    def test_userinfocache_invalidate_user(self):
+        """Test that invalidating a user drops only that user's entries"""
+        self.fill(self.crusoe)
+        self.fill(self.oakley)
+        userinfo_cache.invalidate(user_ids=[self.crusoe.id])
+        self.assert_not_cached(self.crusoe)
+        self.assert_cached(self.oakley)
+
+    def test_userinfocache_invalidate_client(self):
+        """Test that invalidating a client drops the entries of all its users"""
+        self.fill(self.crusoe)
+        self.fill(self.oakley)
+        userinfo_cache.invalidate(auth_client_ids=[self.auth_client.id])
+        self.assert_not_cached(self.crusoe)
+        self.assert_not_cached(self.oakley)
+
+    def test_userinfocache_invalidate_everything(self):
+        """Test that invalidating everything drops all entries"""
+        self.fill(self.crusoe)
+        self.fill(self.oakley)
+        userinfo_cache.invalidate(everything=True)
+        self.assert_not_cached(self.crusoe)
+        self.assert_not_cached(self.oakley)
+
+    def test_userinfocache_invalidate_after_commit(self):
+        """Test that staged invalidations are applied after commit"""
+        self.fill(self.crusoe)
+        resource._userinfo_stale(user_ids=[self.crusoe.id])
+        self.assert_cached(self.crusoe)
+        db.session.commit()
+        self.assert_not_cached(self.crusoe)
+
+    def test_userinfocache_model_signal(self):
+        """Test that a user edit invalidates the user's entries after commit"""
+        self.fill(self.crusoe)
+        self.crusoe.fullname = "Crusoe"
+        db.session.flush()
+        self.assert_cached(self.crusoe)
+        db.session.commit()
+        self.assert_not_cached(self.crusoe)
+        self.crusoe.fullname = "Crusoe Celebrity Dachshund"
+        db.session.commit()
+
+    def test_userinfocache_rollback(self):
+        """Test that nothing is invalidated when the transaction rolls back"""
+        self.fill(self.crusoe)
+        resource._userinfo_stale(user_ids=[self.crusoe.id])
+        self.crusoe.fullname = "Crusoe"
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assert_cached(self.crusoe)
+
+    def test_userinfocache_org_changed(self):
+        """Test that an organization edit invalidates only its members' entries"""
+        self.fill(self.crusoe)
+        self.fill(self.oakley)
+        batdog = self.fixtures.batdog
+        batdog.title = "Batdog Adventures"
+        db.session.commit()
+        self.assert_not_cached(self.crusoe)
+        self.assert_cached(self.oakley)
+        batdog.title = "Batdog"
+        db.session.commit()
+
+    def test_userinfocache_team_changed(self):
+        """
+        Test that a team edit invalidates the entries of the organization's owners,
+        and a membership change those of the users added or removed
+        """
+        piglet = self.fixtures.piglet
+        dachshunds = self.fixtures.dachshunds
+        self.fill(self.crusoe)
+        self.fill(self.oakley)
+        self.fill(piglet)
+        dachshunds.title = "Dachshunds of Batdog"
+        db.session.commit()
+        self.assert_not_cached(self.crusoe)
+        self.assert_cached(self.oakley)
+        self.assert_cached(piglet)
+
+        self.fill(self.crusoe)
+        dachshunds.users.append(piglet)
+        db.session.commit()
+        self.assert_not_cached(piglet)
+        self.assert_cached(self.crusoe)
+        self.assert_cached(self.oakley)
+
+        self.fill(piglet)
+        dachshunds.users.remove(piglet)
+        dachshunds.title = "Dachshunds"
+        db.session.commit()
+        self.assert_not_cached(piglet)
+        self.assert_not_cached(self.crusoe)
+        self.assert_cached(self.oakley)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from lastuser_oauth.views.resource import (
+    build_userinfo,
+    get_userinfo,
+    prefetch_userinfo,
+    userinfo_cache,
+)
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+def orginfo(org):
+    return {
+        'userid': org.buid,
+        'buid': org.buid,
+        'uuid': org.uuid,
+        'name': org.name,
+        'title': org.title,
+    }
+
+
+def teaminfo(team, member):
+    return {
+        'userid': team.buid,
+        'buid': team.buid,
+        'uuid': team.uuid,
+        'title': team.title,
+        'org': team.organization.buid,
+        'org_uuid': team.organization.uuid,
+        'owners': team == team.organization.owners,
+        'member': member,
+    }
+
+
+def expected_userinfo(user, auth_client, scope):
+    """
+    Userinfo for the organizations and teams scopes, from the user's relationships,
+    one user at a time, as it was built before data was prefetched
+    """
+    userinfo = {}
+    teams = {}
+    if scope & {'*', 'organizations'}:
+        userinfo['organizations'] = {
+            'owner': [orginfo(org) for org in user.organizations_owned()],
+            'member': [orginfo(org) for org in user.organizations_memberof()],
+            'all': [orginfo(org) for org in user.organizations()],
+        }
+    if scope & {'*', 'organizations', 'teams'}:
+        for team in user.teams:
+            teams[team.buid] = teaminfo(team, member=True)
+    if scope & {'*', 'teams'}:
+        for org in user.organizations_owned():
+            for team in org.teams:
+                if team.buid not in teams:
+                    teams[team.buid] = teaminfo(team, member=False)
+    if teams:
+        userinfo['teams'] = list(teams.values())
+    permissions = set()
+    for perms in models.AuthClientTeamPermissions.all_for(
+        auth_client=auth_client, user=user
+    ):
+        permissions.update(perms.access_permissions.split(' '))
+    userinfo['permissions'] = sorted(permissions)
+    return userinfo
+
+
+class TestGetUserinfo(TestDatabaseFixture):
+    def setUp(self):
+        super(TestGetUserinfo, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        userinfo_cache.invalidate(everything=True)
+        self.auth_client = self.fixtures.auth_client
+        self.users = [self.fixtures.crusoe, self.fixtures.oakley, self.fixtures.piglet]
+        # Crusoe owns batdog and is also in one of its teams, Oakley owns another
+        # organization, and Piglet is only in a team
+        dachshunds = self.fixtures.dachshunds
+        dachshunds.users.append(self.fixtures.crusoe)
+        dachshunds.users.append(self.fixtures.piglet)
+        db.session.commit()
+
+    def tearDown(self):
+        dachshunds = self.fixtures.dachshunds
+        dachshunds.users.remove(self.fixtures.crusoe)
+        dachshunds.users.remove(self.fixtures.piglet)
+        db.session.commit()
+        self.ctx.pop()
+        super(TestGetUserinfo, self).tearDown()
+
+    def assert_userinfo_equal(self, userinfo, expected, sections=None):
+        # Teams are not in a defined order
+        if sections is not None:
+            userinfo = {key: userinfo[key] for key in sections if key in userinfo}
+            expected = {key: expected[key] for key in sections if key in expected}
+        userinfo = dict(userinfo)
+        expected = dict(expected)
+        self.assertEqual(
+            sorted(userinfo.pop('teams', []), key=lambda team: team['buid']),
+            sorted(expected.pop('teams', []), key=lambda team: team['buid']),
+        )
+        self.assertEqual(userinfo, expected)
+
+    def test_get_userinfo_prefetched(self):
+        """
+        Test that userinfo built from data prefetched for several users matches
+        userinfo built from each user's relationships, for the organizations,
+        teams and * scopes
+        """
+        for scope in (['organizations'], ['teams'], ['*']):
+            data = prefetch_userinfo(self.users, self.auth_client, scope)
+            for user in self.users:
+                userinfo = build_userinfo(
+                    user, self.auth_client, scope, data=data[user.id]
+                )
+                self.assert_userinfo_equal(
+                    userinfo,
+                    expected_userinfo(user, self.auth_client, set(scope)),
+                    sections=('organizations', 'teams', 'permissions'),
+                )
+                # Data loaded for one user, and cached userinfo, are the same
+                self.assert_userinfo_equal(
+                    build_userinfo(user, self.auth_client, scope), userinfo
+                )
+                self.assert_userinfo_equal(
+                    get_userinfo(user, self.auth_client, scope, data=data[user.id]),
+                    userinfo,
+                )
+                self.assert_userinfo_equal(
+                    get_userinfo(user, self.auth_client, scope), userinfo
+                )
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from base64 import b64encode
+import json
+
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestUserAutocomplete(TestDatabaseFixture):
+    def setUp(self):
+        super(TestUserAutocomplete, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        credential, secret = models.AuthClientCredential.new(
+            self.fixtures.auth_client
+        )
+        db.session.commit()
+        self.headers = {
+            'Authorization': 'Basic '
+            + b64encode(
+                '{name}:{secret}'.format(name=credential.name, secret=secret).encode()
+            ).decode()
+        }
+
+    def tearDown(self):
+        self.ctx.pop()
+        super(TestUserAutocomplete, self).tearDown()
+
+    def autocomplete(self, q):
+        response = self.app.test_client().post(
+            '/api/1/user/autocomplete', data={'q': q}, headers=self.headers
+        )
+        data = json.loads(response.get_data(as_text=True))
+        return [user['buid'] for user in data['users']]
+
+    def test_user_autocomplete_status_change(self):
+        """Test that a cached result no longer lists a user who was suspended"""
+        bathound = models.User(username="bathound", fullname="Bathound")
+        db.session.add(bathound)
+        db.session.commit()
+        self.assertEqual(self.autocomplete('bathou'), [bathound.buid])
+
+        bathound.status = models.USER_STATUS.SUSPENDED
+        db.session.commit()
+        self.assertEqual(self.autocomplete('bathou'), [])
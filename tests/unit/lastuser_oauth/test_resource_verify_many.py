@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from base64 import b64encode
+from datetime import timedelta
+import json
+
+from coaster.utils import utcnow
+from lastuserapp import db
+import lastuser_core.models as models
+
+from ..lastuser_core.test_db import TestDatabaseFixture
+
+
+class TestTokenVerifyMany(TestDatabaseFixture):
+    def setUp(self):
+        super(TestTokenVerifyMany, self).setUp()
+        self.ctx = self.app.test_request_context()
+        self.ctx.push()
+        self.auth_client = self.fixtures.auth_client
+        self.resource_scope = self.auth_client.namespace + ':*'
+        credential, secret = models.AuthClientCredential.new(self.auth_client)
+        db.session.commit()
+        self.headers = {
+            'Authorization': 'Basic '
+            + b64encode(
+                '{name}:{secret}'.format(name=credential.name, secret=secret).encode()
+            ).decode()
+        }
+        self.tokens = []
+
+    def tearDown(self):
+        for token in self.tokens:
+            db.session.delete(token)
+        db.session.commit()
+        self.ctx.pop()
+        super(TestTokenVerifyMany, self).tearDown()
+
+    def make_token(self, user, scope, **kwargs):
+        token = models.AuthToken(
+            auth_client=self.auth_client, user=user, scope=scope, **kwargs
+        )
+        db.session.add(token)
+        self.tokens.append(token)
+        return token
+
+    def verify_many(self, tokens):
+        response = self.app.test_client().post(
+            '/api/1/token/verify_many',
+            data={'resource': '*', 'access_token[]': tokens},
+            headers=self.headers,
+        )
+        return response.status_code, json.loads(response.get_data(as_text=True))
+
+    def test_verify_many_mixed(self):
+        """Test that each token gets its own result, with userinfo and clientinfo"""
+        crusoe = self.make_token(self.fixtures.crusoe, ['id', self.resource_scope])
+        oakley = self.make_token(
+            self.fixtures.oakley, ['id', 'email', self.resource_scope]
+        )
+        expired = self.make_token(
+            self.fixtures.piglet,
+            ['id', self.resource_scope],
+            validity=60,
+            created_at=utcnow() - timedelta(minutes=5),
+        )
+        denied = self.make_token(self.fixtures.piglet, ['id'])
+        db.session.commit()
+
+        status_code, data = self.verify_many(
+            [crusoe.token, oakley.token, expired.token, denied.token, 'unknown']
+        )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(data['status'], 'ok')
+        results = data['results']
+        self.assertEqual(results['unknown'], {'status': 'error', 'error': 'no_token'})
+        self.assertEqual(results[expired.token]['error'], 'token_expired')
+        self.assertEqual(results[denied.token]['error'], 'access_denied')
+
+        for token, user in (
+            (crusoe, self.fixtures.crusoe),
+            (oakley, self.fixtures.oakley),
+        ):
+            result = results[token.token]
+            self.assertEqual(result['status'], 'ok')
+            self.assertEqual(result['userinfo']['buid'], user.buid)
+            self.assertEqual(result['clientinfo']['title'], self.auth_client.title)
+        # Userinfo follows each token's own scope
+        self.assertNotIn('email', results[crusoe.token]['userinfo'])
+        self.assertIn('email', results[oakley.token]['userinfo'])
+
+    def test_verify_many_limit(self):
+        """Test that requests over TOKEN_VERIFY_MANY_LIMIT are refused"""
+        self.app.config['TOKEN_VERIFY_MANY_LIMIT'] = 2
+        self.addCleanup(self.app.config.pop, 'TOKEN_VERIFY_MANY_LIMIT', None)
+        status_code, data = self.verify_many(['one', 'two'])
+        self.assertEqual(status_code, 200)
+        status_code, data = self.verify_many(['one', 'two', 'three'])
+        self.assertEqual(status_code, 400)
+        self.assertEqual(data['error'], 'too_many_tokens')